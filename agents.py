@@ -1,6 +1,8 @@
 from utils import *
 from tools import *
 from inference import *
+import score_cascade
+from batch_api import LLMBatch
 
 
 def extract_json_between_markers(llm_output):
@@ -32,13 +34,25 @@ def extract_json_between_markers(llm_output):
 
 
 
-def get_score(outlined_plan, latex, reward_model_llm, reviewer_type=None, attempts=3, openai_api_key=None):
-    e = str()
-    for _attempt in range(attempts):
-        try:
-            # todo: have a reward function here
-            # template inherited from the AI Scientist (good work on this prompt Sakana AI team :D)
-            template_instructions = """
+def get_score(outlined_plan, latex, reward_model_llm, reviewer_type=None, attempts=3, openai_api_key=None, best_score=None):
+    """
+    Review score of a paper on a 0-10 scale, through the cheap-first score cascade if it is configured
+    @param best_score: (float) score of the current best paper, used to decide whether to escalate
+    @return: (tuple) score, review text, whether the review was valid
+    """
+    return score_cascade.SCORE_CASCADE.run(
+        lambda model_str: _get_score(outlined_plan, latex, model_str, reviewer_type, attempts, openai_api_key),
+        reward_model_llm, best_score=best_score, score_range=10.0)
+
+
+def review_prompts(outlined_plan, latex, reviewer_type=None):
+    """
+    System prompt and prompt asking a reviewer model for a NeurIPS-style review
+    @return: (tuple) system prompt, prompt
+    """
+    # todo: have a reward function here
+    # template inherited from the AI Scientist (good work on this prompt Sakana AI team :D)
+    template_instructions = """
             Respond in the following format:
 
             THOUGHT:
@@ -75,7 +89,7 @@ def get_score(outlined_plan, latex, reward_model_llm, reviewer_type=None, attemp
             For the "Decision" field, don't use Weak Accept, Borderline Accept, Borderline Reject, or Strong Reject. Instead, only use Accept or Reject.
             This JSON will be automatically parsed, so ensure the format is precise.
             """
-            neurips_form = ("""
+    neurips_form = ("""
                 ## Review Form
                 Below is a description of the questions you will be asked on the review form for each paper and some guidelines on what to consider when answering these questions.
                 When writing your review, please keep in mind that after decisions have been made, reviews and meta-reviews of accepted papers and opted-in rejected papers will be made public. 
@@ -133,47 +147,65 @@ def get_score(outlined_plan, latex, reward_model_llm, reviewer_type=None, attemp
 
                   You must make sure that all sections are properly created: abstract, introduction, methods, results, and discussion. Points must be reduced from your scores if any of these are missing.
                 """ + template_instructions)
-            if reviewer_type is None: reviewer_type = ""
-            sys = (
-                      "You are an AI researcher who is reviewing a paper that was submitted to a prestigious ML venue. "
-                      f"Be critical and cautious in your decision. {reviewer_type}\n"
-                  ) + neurips_form
+    if reviewer_type is None: reviewer_type = ""
+    sys = (
+              "You are an AI researcher who is reviewing a paper that was submitted to a prestigious ML venue. "
+              f"Be critical and cautious in your decision. {reviewer_type}\n"
+          ) + neurips_form
+    prompt = (
+        f"Outlined in the following text is the research plan that the machine learning engineer was tasked with building: {outlined_plan}\n\n"
+        f"The following text is the research latex that the model produced: \n{latex}\n\n")
+    return sys, prompt
+
+
+def score_review(scoring):
+    """
+    Weighted 0-10 score of a review produced for review_prompts
+    @param scoring: (str) reviewer model response
+    @return: (tuple) score, review text, True (raises if the review json cannot be parsed)
+    """
+    review_json = extract_json_between_markers(scoring)
+
+    overall = int(review_json["Overall"]) / 10
+    soundness = int(review_json["Soundness"]) / 4
+    confidence = int(review_json["Confidence"]) / 5
+    contribution = int(review_json["Contribution"]) / 4
+    presentation = int(review_json["Presentation"]) / 4
+    clarity = int(review_json["Clarity"]) / 4
+    originality = int(review_json["Originality"]) / 4
+    quality = int(review_json["Quality"]) / 4
+    significance = int(review_json["Significance"]) / 4
+
+    clarity_weight = 0.1
+    quality_weight = 0.1
+    overall_weight = 1.0
+    soundness_weight = 0.1
+    confidence_weight = 0.1
+    originality_weight = 0.1
+    significance_weight = 0.1
+    contribution_weight = 0.4
+    presentation_weight = 0.2
+
+    # max possible
+    max_score = (
+        clarity_weight + quality_weight + overall_weight + soundness_weight + confidence_weight + originality_weight + significance_weight + contribution_weight + presentation_weight)
+
+    performance = ((
+       soundness_weight * soundness + presentation_weight * presentation + confidence_weight * confidence + contribution_weight * contribution + overall_weight * overall + originality_weight * originality + significance * significance_weight + clarity_weight * clarity + quality_weight * quality) / max_score) * 10
+    return performance, f"The performance of your submission is: {performance}" + scoring, True
+
+
+def _get_score(outlined_plan, latex, reward_model_llm, reviewer_type=None, attempts=3, openai_api_key=None):
+    e = str()
+    for _attempt in range(attempts):
+        try:
+            sys, prompt = review_prompts(outlined_plan, latex, reviewer_type)
             scoring = query_model(
                 model_str=f"{reward_model_llm}",
                 system_prompt=sys,
                 openai_api_key=openai_api_key,
-                prompt=(
-                    f"Outlined in the following text is the research plan that the machine learning engineer was tasked with building: {outlined_plan}\n\n"
-                    f"The following text is the research latex that the model produced: \n{latex}\n\n"), temp=0.0)
-            review_json = extract_json_between_markers(scoring)
-
-            overall = int(review_json["Overall"]) / 10
-            soundness = int(review_json["Soundness"]) / 4
-            confidence = int(review_json["Confidence"]) / 5
-            contribution = int(review_json["Contribution"]) / 4
-            presentation = int(review_json["Presentation"]) / 4
-            clarity = int(review_json["Clarity"]) / 4
-            originality = int(review_json["Originality"]) / 4
-            quality = int(review_json["Quality"]) / 4
-            significance = int(review_json["Significance"]) / 4
-
-            clarity_weight = 0.1
-            quality_weight = 0.1
-            overall_weight = 1.0
-            soundness_weight = 0.1
-            confidence_weight = 0.1
-            originality_weight = 0.1
-            significance_weight = 0.1
-            contribution_weight = 0.4
-            presentation_weight = 0.2
-
-            # max possible
-            max_score = (
-                clarity_weight + quality_weight + overall_weight + soundness_weight + confidence_weight + originality_weight + significance_weight + contribution_weight + presentation_weight)
-
-            performance = ((
-               soundness_weight * soundness + presentation_weight * presentation + confidence_weight * confidence + contribution_weight * contribution + overall_weight * overall + originality_weight * originality + significance * significance_weight + clarity_weight * clarity + quality_weight * quality) / max_score) * 10
-            return performance, f"The performance of your submission is: {performance}" + scoring, True
+                prompt=prompt, temp=0.0, stop_on=FencedBlockStop("json"))
+            return score_review(scoring)
         except Exception as e:
             print(e)
             return None, str(e), False
@@ -188,14 +220,29 @@ class ReviewersAgent:
         self.openai_api_key = openai_api_key
 
     def inference(self, plan, report):
-        reviewer_1 = "You are a harsh but fair reviewer and expect good experiments that lead to insights for the research topic."
-        review_1 = get_score(outlined_plan=plan, latex=report, reward_model_llm=self.model, reviewer_type=reviewer_1, openai_api_key=self.openai_api_key)
+        with accounting_scope(agent=type(self).__name__):
+            return self._inference(plan, report)
 
+    def _inference(self, plan, report):
+        # the reviews themselves are the output here, so they always come from the main model
+        reviewer_1 = "You are a harsh but fair reviewer and expect good experiments that lead to insights for the research topic."
         reviewer_2 = "You are a harsh and critical but fair fair reviewer who is looking for idea that would be impactful in the field."
-        review_2 = get_score(outlined_plan=plan, latex=report, reward_model_llm=self.model, reviewer_type=reviewer_2, openai_api_key=self.openai_api_key)
-
         reviewer_3 = "You are a harsh but fair open-minded reviewer that is looking for novel ideas that have not been proposed before."
-        review_3 = get_score(outlined_plan=plan, latex=report, reward_model_llm=self.model, reviewer_type=reviewer_3, openai_api_key=self.openai_api_key)
+        # the three reviews are independent, send them as one batch
+        batch = LLMBatch()
+        futures = list()
+        for reviewer_type in [reviewer_1, reviewer_2, reviewer_3]:
+            sys, prompt = review_prompts(outlined_plan=plan, latex=report, reviewer_type=reviewer_type)
+            futures.append(batch.submit(model_str=self.model, system_prompt=sys, prompt=prompt, openai_api_key=self.openai_api_key, temp=0.0, stop_on=FencedBlockStop("json")))
+        batch.flush()
+        reviews = list()
+        for future in futures:
+            try:
+                reviews.append(score_review(future.result()))
+            except Exception as e:
+                print(e)
+                reviews.append((None, str(e), False))
+        review_1, review_2, review_3 = reviews
 
         return f"Reviewer #1:\n{review_1}, \nReviewer #2:\n{review_2}, \nReviewer #3:\n{review_3}"
 
@@ -251,7 +298,8 @@ class BaseAgent:
             f"Current Step #{step}, Phase: {phase}\n{complete_str}\n"
             f"[Objective] Your goal is to perform research on the following topic: {research_topic}\n"
             f"Feedback: {feedback}\nNotes: {notes_str}\nYour previous command was: {self.prev_comm}. Make sure your new output is very different.\nPlease produce a single command below:\n")
-        model_resp = query_model(model_str=self.model, system_prompt=sys_prompt, prompt=prompt, temp=temp, openai_api_key=self.openai_api_key)
+        with accounting_scope(agent=type(self).__name__):
+            model_resp = query_model(model_str=self.model, system_prompt=sys_prompt, prompt=prompt, temp=temp, openai_api_key=self.openai_api_key)
         print("^"*50, phase, "^"*50)
         model_resp = self.clean_text(model_resp)
         self.prev_comm = model_resp
@@ -301,6 +349,7 @@ class ProfessorAgent(BaseAgent):
         prompt = (
             f"""History: {history_str}\n{'~' * 10}\n"""
             f"Please produce the readme below in markdown:\n")
+        # a single call that is waited on, the batch path would only add the Batch API turnaround
         model_resp = query_model(model_str=self.model, system_prompt=sys_prompt, prompt=prompt, openai_api_key=self.openai_api_key)
         return model_resp.replace("```markdown", "")
 
@@ -477,7 +526,7 @@ class MLEngineerAgent(BaseAgent):
             return (
                 "You can produce code using the following command: ```python\ncode here\n```\n where code here is the actual code you will execute in a Python terminal, and python is just the word python. Try to incorporate some print functions. Do not use any classes or functions. If your code returns any errors, they will be provided to you, and you are also able to see print statements. You will receive all print statement results from the code. Make sure function variables are created inside the function or passed as a function parameter.\n"  # Try to avoid creating functions. 
                 "You can produce dialogue using the following command: ```DIALOGUE\ndialogue here\n```\n where dialogue here is the actual dialogue you will send, and DIALOGUE is just the word DIALOGUE.\n"
-                "You also have access to HuggingFace datasets. You can search the datasets repository using the following command: ```SEARCH_HF\nsearch query here\n``` where search query here is the query used to search HuggingFace datasets, and SEARCH_HF is the word SEARCH_HF. This will return a list of HuggingFace dataset descriptions which can be loaded into Python using the datasets library. Your code MUST use an external HuggingFace directory.\n"
+                "You also have access to HuggingFace datasets. You can search the datasets repository using the following command: ```SEARCH_HF\nsearch query here\n``` where search query here is the query used to search HuggingFace datasets, and SEARCH_HF is the word SEARCH_HF. You can search several reformulations of a query at once by writing one query per line. This will return a list of HuggingFace dataset descriptions which can be loaded into Python using the datasets library. Your code MUST use an external HuggingFace directory.\n"
                 "You MUST use a HuggingFace dataset in your code. DO NOT CREATE A MAIN FUNCTION. Try to make the code very simple.\n"
                 "You can only use a SINGLE command per inference turn. Do not use more than one command per inference. If you use multiple commands, then only one of them will be executed, NOT BOTH.\n"
                 "When performing a command, make sure to include the three ticks (```) at the top and bottom ```COMMAND\ntext\n``` where COMMAND is the specific command you want to run (e.g. python, DIALOGUE, SEARCH_HF).\n")
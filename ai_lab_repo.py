@@ -2,6 +2,16 @@ from agents import *
 from copy import copy
 from common_imports import *
 from mlesolver import MLESolver
+from score_cascade import configure_score_cascade
+from batch_api import BATCH_BACKENDS, configure_llm_batch
+from retry_scheduler import PROVIDER_LIMITS, configure_rate_limits
+from code_executor import configure_code_executor, execution_stats
+from resource_limits import configure_resource_limits
+from profiler import configure_profiling
+from output_capture import configure_output_capture
+from split_metadata import configure_split_metadata
+from tools import configure_hf_search
+from preflight import preflight_check
 from torch.backends.mkl import verbose
 
 import argparse
@@ -11,7 +21,7 @@ DEFAULT_LLM_BACKBONE = "o1-mini"
 
 
 class LaboratoryWorkflow:
-    def __init__(self, research_topic, openai_api_key, max_steps=100, num_papers_lit_review=5, agent_model_backbone=f"{DEFAULT_LLM_BACKBONE}", notes=list(), human_in_loop_flag=None, compile_pdf=True, mlesolver_max_steps=3, papersolver_max_steps=5):
+    def __init__(self, research_topic, openai_api_key, max_steps=100, num_papers_lit_review=5, agent_model_backbone=f"{DEFAULT_LLM_BACKBONE}", notes=list(), human_in_loop_flag=None, compile_pdf=True, mlesolver_max_steps=3, papersolver_max_steps=5, mlesolver_fanout=1):
         """
         Initialize laboratory workflow
         @param research_topic: (str) description of research idea to explore
@@ -42,6 +52,7 @@ class LaboratoryWorkflow:
         self.review_total_steps = 0 # num steps to take if overridden
         self.arxiv_num_summaries = 5
         self.mlesolver_max_steps = mlesolver_max_steps
+        self.mlesolver_fanout = mlesolver_fanout
         self.papersolver_max_steps = papersolver_max_steps
 
         self.phases = [
@@ -141,6 +152,7 @@ class LaboratoryWorkflow:
             if self.verbose: print(f"{'*'*50}\nBeginning phase: {phase}\n{'*'*50}")
             for subtask in subtasks:
                 if self.verbose: print(f"{'&'*30}\nBeginning subtask: {subtask}\n{'&'*30}")
+                set_accounting_phase(subtask)
                 if type(self.phase_models) == dict:
                     if subtask in self.phase_models:
                         self.set_model(self.phase_models[subtask])
@@ -241,11 +253,12 @@ class LaboratoryWorkflow:
         from papersolver import PaperSolver
         self.reference_papers = []
         solver = PaperSolver(notes=report_notes, max_steps=self.papersolver_max_steps, plan=lab.phd.plan, exp_code=lab.phd.results_code, exp_results=lab.phd.exp_results, insights=lab.phd.interpretation, lit_review=lab.phd.lit_review, ref_papers=self.reference_papers, topic=research_topic, openai_api_key=self.openai_api_key, llm_str=self.model_backbone["report writing"], compile_pdf=compile_pdf)
-        # run initialization for solver
-        solver.initial_solve()
-        # run solver for N mle optimization steps
-        for _ in range(self.papersolver_max_steps):
-            solver.solve()
+        with accounting_scope(agent=type(solver).__name__):
+            # run initialization for solver
+            solver.initial_solve()
+            # run solver for N mle optimization steps
+            for _ in range(self.papersolver_max_steps):
+                solver.solve()
         # get best report results
         report = "\n".join(solver.best_report[0][0])
         score = solver.best_report[0][1]
@@ -304,12 +317,14 @@ class LaboratoryWorkflow:
         experiment_notes = [_note["note"] for _note in self.ml_engineer.notes if "running experiments" in _note["phases"]]
         experiment_notes = f"Notes for the task objective: {experiment_notes}\n" if len(experiment_notes) > 0 else ""
         # instantiate mle-solver
-        solver = MLESolver(dataset_code=self.ml_engineer.dataset_code, notes=experiment_notes, insights=self.ml_engineer.lit_review_sum, max_steps=self.mlesolver_max_steps, plan=self.ml_engineer.plan, openai_api_key=self.openai_api_key, llm_str=self.model_backbone["running experiments"])
-        # run initialization for solver
-        solver.initial_solve()
-        # run solver for N mle optimization steps
-        for _ in range(self.mlesolver_max_steps-1):
-            solver.solve()
+        solver = MLESolver(dataset_code=self.ml_engineer.dataset_code, notes=experiment_notes, insights=self.ml_engineer.lit_review_sum, max_steps=self.mlesolver_max_steps, plan=self.ml_engineer.plan, openai_api_key=self.openai_api_key, llm_str=self.model_backbone["running experiments"], fanout=self.mlesolver_fanout)
+        with accounting_scope(agent=type(solver).__name__):
+            # run initialization for solver
+            solver.initial_solve()
+            # run solver for N mle optimization steps
+            for _ in range(self.mlesolver_max_steps-1):
+                solver.solve()
+        if self.verbose: print(f"mle-solver candidate memo: {solver.memo.summary()}")
         # get best code results
         code = "\n".join(solver.best_codes[0][0])
         # regenerate figures from top code
@@ -337,7 +352,7 @@ class LaboratoryWorkflow:
         ml_dialogue = str()
         phd_feedback = str()
         ml_command = str()
-        hf_engine = HFDataSearch()
+        hf_engine = hf_data_search()
         # iterate until max num tries to complete task is exhausted
         for _i in range(max_tries):
             if ml_feedback != "":
@@ -353,7 +368,7 @@ class LaboratoryWorkflow:
                 if self.verbose: print("#"*40, f"\nThe following is dialogue produced by the PhD Student: {dialogue}", "\n", "#"*40)
             if "```SUBMIT_CODE" in resp:
                 final_code = extract_prompt(resp, "SUBMIT_CODE")
-                code_resp = execute_code(final_code, timeout=60)
+                code_resp = preflight_check(final_code) or execute_code(final_code, timeout=60)
                 if self.verbose: print("!"*100, "\n", f"CODE RESPONSE: {code_resp}")#print("!"*100, "\n", self.phd.dataset_code, "\n", "$"*100, "\n", final_code, "\n", "!"*100, "\n", f"CODE RESPONSE: {code_resp}")
                 phd_feedback += f"\nCode Response: {code_resp}\n"
                 if "[CODE EXECUTION ERROR]" in code_resp:
@@ -387,13 +402,19 @@ class LaboratoryWorkflow:
             if "```python" in resp:
                 code = extract_prompt(resp, "python")
                 code = self.ml_engineer.dataset_code + "\n" + code
-                code_resp = execute_code(code, timeout=120)
+                code_resp = preflight_check(code) or execute_code(code, timeout=120)
                 ml_command = f"Code produced by the ML agent:\n{code}"
                 ml_feedback += f"\nCode Response: {code_resp}\n"
                 if self.verbose: print("!"*100, "\n", f"CODE RESPONSE: {code_resp}")
             if "```SEARCH_HF" in resp:
                 hf_query = extract_prompt(resp, "SEARCH_HF")
-                hf_res = "\n".join(hf_engine.results_str(hf_engine.retrieve_ds(hf_query)))
+                # one query per line, reformulations are searched together
+                hf_queries = [_q.strip() for _q in hf_query.split("\n") if _q.strip()] or [hf_query]
+                if len(hf_queries) == 1:
+                    hf_res = "\n".join(hf_engine.results_str(hf_engine.retrieve_ds(hf_queries[0])))
+                else:
+                    hf_res = "\n".join([f"Results for query '{_q}':\n" + "\n".join(hf_engine.results_str(_r))
+                                        for _q, _r in zip(hf_queries, hf_engine.retrieve_many(hf_queries, N=max(3, 10 // len(hf_queries))))])
                 ml_command = f"HF search command produced by the ML agent:\n{hf_query}"
                 ml_feedback += f"Huggingface results: {hf_res}\n"
         raise Exception("Max tries during phase: Data Preparation")
@@ -596,6 +617,13 @@ def parse_arguments():
         help='Total number of mle-solver steps'
     )
 
+    parser.add_argument(
+        '--mlesolver-fanout',
+        type=str,
+        default="1",
+        help='Number of mle-solver candidates proposed, executed and scored concurrently per step'
+    )
+
     parser.add_argument(
         '--papersolver-max-steps',
         type=str,
@@ -603,6 +631,160 @@ def parse_arguments():
         help='Total number of paper-solver steps'
     )
 
+    parser.add_argument(
+        '--llm-max-inflight',
+        type=str,
+        default="8",
+        help='Maximum number of LLM requests in flight at the same time.'
+    )
+
+    parser.add_argument(
+        '--llm-rate-limit',
+        type=str,
+        default=None,
+        help='Requests and tokens per minute admitted per provider as provider:rpm:tpm, comma-separated (e.g. "openai:500:200000,anthropic:50:40000"); an empty rpm or tpm is unlimited.'
+    )
+
+    parser.add_argument(
+        '--llm-cache',
+        type=str,
+        default="off",
+        help='Cache LLM responses on disk for re-runs: "off", "deterministic" (temperature 0 or unset only), or "all".'
+    )
+
+    parser.add_argument(
+        '--llm-offline-latency',
+        type=str,
+        default="0.0",
+        help='Seconds of latency added to every call when --llm-backend is "offline".'
+    )
+
+    parser.add_argument(
+        '--llm-offline-script',
+        type=str,
+        default=None,
+        help='JSON file of scripted responses [{"match": regex, "response": text}] for the "offline" backend.'
+    )
+
+    parser.add_argument(
+        '--llm-hedge-percentile',
+        type=str,
+        default=None,
+        help='Send a duplicate LLM request when a call is slower than this latency percentile (e.g. 0.95). Disabled by default.'
+    )
+
+    parser.add_argument(
+        '--llm-hedge-fallback',
+        type=str,
+        default=None,
+        help='Model that receives the duplicate of a hedged request, defaults to the same model.'
+    )
+
+    parser.add_argument(
+        '--score-cascade-model',
+        type=str,
+        default=None,
+        help='Cheap model that scores solver candidates first (e.g. gpt-4o-mini), the backbone is only asked for candidates near the current best.'
+    )
+
+    parser.add_argument(
+        '--score-cascade-margin',
+        type=str,
+        default="0.1",
+        help='Fraction of the score range below the current best within which a cheap score is escalated to the backbone.'
+    )
+
+    parser.add_argument(
+        '--llm-batch',
+        type=str,
+        default="local",
+        help='How independent calls (reviews, section search queries, readme) are batched: "local" sends them concurrently, "openai" uses the discounted OpenAI Batch API (can take hours).'
+    )
+
+    parser.add_argument(
+        '--code-exec-workers',
+        type=str,
+        default="2",
+        help='Number of pre-warmed worker processes that execute generated code.'
+    )
+
+    parser.add_argument(
+        '--code-exec-snapshot',
+        type=str,
+        default="true",
+        help='Run the dataset code once and fork it for every mle-solver candidate instead of re-running it.'
+    )
+
+    parser.add_argument(
+        '--code-exec-checkpoints',
+        type=str,
+        default="8",
+        help='Interpreter states checkpointed after slow top-level statements, so that an edited candidate resumes from its first changed statement (0 disables).'
+    )
+
+    parser.add_argument(
+        '--code-exec-memory-mb',
+        type=str,
+        default=None,
+        help='Address space limit of each generated code execution in MB (unlimited by default).'
+    )
+
+    parser.add_argument(
+        '--code-exec-cpu-seconds',
+        type=str,
+        default=None,
+        help='CPU time limit of each generated code execution in seconds (unlimited by default).'
+    )
+
+    parser.add_argument(
+        '--code-exec-file-size-mb',
+        type=str,
+        default=None,
+        help='Largest file generated code may write in MB (unlimited by default).'
+    )
+
+    parser.add_argument(
+        '--code-exec-cgroup',
+        type=str,
+        default=None,
+        help='Existing cgroup v2 directory the code execution processes join, e.g. to cap the memory and CPUs of one lab on a shared host.'
+    )
+
+    parser.add_argument(
+        '--code-exec-profile',
+        type=str,
+        default="false",
+        help='Run generated code under a sampling profiler, append its hotspots to the feedback and save the profiles in research_dir/profiles.'
+    )
+
+    parser.add_argument(
+        '--code-exec-profile-top-n',
+        type=str,
+        default="10",
+        help='Rows of the hotspot table appended to the output of profiled code.'
+    )
+
+    parser.add_argument(
+        '--code-exec-output-log',
+        type=str,
+        default="true",
+        help='Stream the full output of every code execution to research_dir/exec_logs, the agent only sees its head and tail.'
+    )
+
+    parser.add_argument(
+        '--hf-search-offline',
+        type=str,
+        default="false",
+        help='Answer HF searches from local caches only: dataset split information is not queried from the hub and the saved search index is not checked for a new snapshot.'
+    )
+
+    parser.add_argument(
+        '--hf-search-mode',
+        type=str,
+        default="tfidf",
+        help='Ranking of HF dataset searches: "tfidf" (cosine similarity) or "hybrid" (BM25 blended with latent-semantic similarity, built locally once).'
+    )
+
 
     return parser.parse_args()
 
@@ -626,8 +808,110 @@ if __name__ == "__main__":
         mlesolver_max_steps = int(args.mlesolver_max_steps.lower())
     except Exception:
         raise Exception("args.papersolver_max_steps must be a valid integer!")
+    try:
+        mlesolver_fanout = int(args.mlesolver_fanout.lower())
+    except Exception:
+        raise Exception("args.mlesolver_fanout must be a valid integer!")
 
 
+    try:
+        set_max_inflight(int(args.llm_max_inflight.lower()))
+    except Exception:
+        raise Exception("args.llm_max_inflight must be a valid integer!")
+
+    if args.llm_rate_limit is not None:
+        for limit in args.llm_rate_limit.split(","):
+            parts = limit.strip().split(":")
+            if len(parts) != 3 or parts[0].lower() not in PROVIDER_LIMITS:
+                raise Exception(f"args.llm_rate_limit must be provider:rpm:tpm with a provider in {list(PROVIDER_LIMITS)}!")
+            try:
+                rpm, tpm = [int(_p) if _p.strip() else None for _p in parts[1:]]
+            except Exception:
+                raise Exception("args.llm_rate_limit rpm and tpm must be valid integers!")
+            if (rpm is not None and rpm < 1) or (tpm is not None and tpm < 1):
+                raise Exception("args.llm_rate_limit rpm and tpm must be positive!")
+            configure_rate_limits(parts[0].lower(), rpm=rpm, tpm=tpm)
+
+    llm_cache = args.llm_cache.lower()
+    if llm_cache not in CACHE_POLICIES:
+        raise Exception(f"args.llm_cache must be one of {CACHE_POLICIES}!")
+    response_cache = None
+    if llm_cache != "off":
+        response_cache = configure_response_cache(policy=llm_cache)
+
+    if llm_backend in OFFLINE_MODELS:
+        try:
+            offline_latency = float(args.llm_offline_latency)
+        except Exception:
+            raise Exception("args.llm_offline_latency must be a valid number!")
+        configure_offline_llm(latency=offline_latency, script_path=args.llm_offline_script)
+
+    if args.llm_hedge_percentile is not None:
+        try:
+            hedge_percentile = float(args.llm_hedge_percentile)
+        except Exception:
+            raise Exception("args.llm_hedge_percentile must be a valid number!")
+        if not 0.0 < hedge_percentile < 1.0:
+            raise Exception("args.llm_hedge_percentile must be between 0 and 1!")
+        hedge_fallbacks = dict()
+        if args.llm_hedge_fallback is not None:
+            if MODEL_ALIASES.get(args.llm_hedge_fallback, args.llm_hedge_fallback) not in MODEL_ENDPOINTS:
+                raise Exception(f"args.llm_hedge_fallback must be one of {list(MODEL_ENDPOINTS)}!")
+            hedge_fallbacks[MODEL_ALIASES.get(llm_backend, llm_backend)] = args.llm_hedge_fallback
+        configure_hedging(percentile=hedge_percentile, fallbacks=hedge_fallbacks)
+
+    llm_batch = args.llm_batch.lower()
+    if llm_batch not in BATCH_BACKENDS:
+        raise Exception(f"args.llm_batch must be one of {BATCH_BACKENDS}!")
+    configure_llm_batch(backend=llm_batch)
+
+    try:
+        code_exec_workers = int(args.code_exec_workers.lower())
+    except Exception:
+        raise Exception("args.code_exec_workers must be a valid integer!")
+    if code_exec_workers < 1:
+        raise Exception("args.code_exec_workers must be at least 1!")
+    try:
+        code_exec_checkpoints = int(args.code_exec_checkpoints.lower())
+    except Exception:
+        raise Exception("args.code_exec_checkpoints must be a valid integer!")
+    code_exec_limits = dict()
+    for name in ["code_exec_memory_mb", "code_exec_cpu_seconds", "code_exec_file_size_mb"]:
+        if getattr(args, name) is None:
+            code_exec_limits[name] = None
+            continue
+        try:
+            code_exec_limits[name] = float(getattr(args, name))
+        except Exception:
+            raise Exception(f"args.{name} must be a valid number!")
+        if code_exec_limits[name] <= 0:
+            raise Exception(f"args.{name} must be positive!")
+    # before configure_code_executor, which restarts the executors with these limits
+    configure_resource_limits(memory_mb=code_exec_limits["code_exec_memory_mb"], cpu_seconds=code_exec_limits["code_exec_cpu_seconds"],
+                              file_size_mb=code_exec_limits["code_exec_file_size_mb"], cgroup=args.code_exec_cgroup)
+    try:
+        code_exec_profile_top_n = int(args.code_exec_profile_top_n.lower())
+    except Exception:
+        raise Exception("args.code_exec_profile_top_n must be a valid integer!")
+    configure_profiling(enabled=args.code_exec_profile.lower() == "true", top_n=code_exec_profile_top_n)
+    configure_output_capture(log=args.code_exec_output_log.lower() == "true")
+    hf_search_mode = args.hf_search_mode.lower()
+    if hf_search_mode not in ["tfidf", "hybrid"]:
+        raise Exception("args.hf_search_mode must be one of ['tfidf', 'hybrid']!")
+    if hf_search_mode == "hybrid":
+        configure_hf_search(sim_w=0.0, bm25_w=0.5, lsa_w=0.5)
+    configure_split_metadata(offline=args.hf_search_offline.lower() == "true" or os.environ.get("HF_HUB_OFFLINE", "0").lower() in ("1", "true", "yes"))
+    configure_code_executor(workers=code_exec_workers, snapshot=args.code_exec_snapshot.lower() == "true", checkpoints=code_exec_checkpoints)
+
+    if args.score_cascade_model is not None:
+        if MODEL_ALIASES.get(args.score_cascade_model, args.score_cascade_model) not in MODEL_ENDPOINTS:
+            raise Exception(f"args.score_cascade_model must be one of {list(MODEL_ENDPOINTS)}!")
+        try:
+            score_cascade_margin = float(args.score_cascade_margin)
+        except Exception:
+            raise Exception("args.score_cascade_margin must be a valid number!")
+        configure_score_cascade(args.score_cascade_model, margin=score_cascade_margin)
+
     api_key = os.getenv('OPENAI_API_KEY') or args.api_key or "your-default-api-key"
     if not api_key:
         raise ValueError("API key must be provided via --api-key or the OPENAI_API_KEY environment variable.")
@@ -700,6 +984,7 @@ if __name__ == "__main__":
             raise ValueError("Please provide path to load existing state.")
         with open(load_path, "rb") as f:
             lab = pickle.load(f)
+        lab.mlesolver_fanout = mlesolver_fanout
     else:
         lab = LaboratoryWorkflow(
             research_topic=research_topic,
@@ -711,10 +996,21 @@ if __name__ == "__main__":
             num_papers_lit_review=num_papers_lit_review,
             papersolver_max_steps=papersolver_max_steps,
             mlesolver_max_steps=mlesolver_max_steps,
+            mlesolver_fanout=mlesolver_fanout,
         )
 
     lab.perform_research()
 
+    print(f"Token usage: {TOKEN_ACCOUNTING.summary()}")
+    if response_cache is not None:
+        print(f"LLM response cache: {response_cache.stats()}")
+    if args.llm_hedge_percentile is not None:
+        print(f"Hedged LLM requests: {hedging.HEDGE_POLICY.stats}")
+    if args.score_cascade_model is not None:
+        print(f"Score cascade: {score_cascade.SCORE_CASCADE.summary()}")
+    if len(execution_stats()) > 0:
+        print(f"Incremental code execution: {execution_stats()}")
+
 
 
 
@@ -0,0 +1,152 @@
+import os
+import json
+import asyncio
+import concurrent.futures
+
+from inference import MODEL_ALIASES, MODEL_ENDPOINTS, aquery_model, submit_coroutine, provider_client, openai_chat_request
+from token_accounting import TOKEN_ACCOUNTING, BATCH_PRICE_FACTOR, accounting_scope, current_scope
+
+
+BATCH_BACKENDS = ["local", "openai"]
+BATCH_BACKEND = "local"
+BATCH_POLL_INTERVAL = 30.0
+BATCH_COMPLETION_WINDOW = "24h"
+
+
+def configure_llm_batch(backend="local", poll_interval=30.0):
+    """
+    Select how LLMBatch requests are sent
+    @param backend: (str) "local" (concurrent regular calls) or "openai" (OpenAI Batch API, discounted, slow)
+    @param poll_interval: (float) seconds between batch status checks
+    @return: None
+    """
+    global BATCH_BACKEND, BATCH_POLL_INTERVAL
+    if backend not in BATCH_BACKENDS:
+        raise Exception(f"Unknown batch backend: {backend}")
+    BATCH_BACKEND = backend
+    BATCH_POLL_INTERVAL = poll_interval
+
+
+class LLMBatch:
+    def __init__(self, backend=None, poll_interval=None) -> None:
+        """
+        Collect independent, latency-tolerant LLM calls and send them together
+        @param backend: (str) "local" or "openai", defaults to the configured BATCH_BACKEND
+        @param poll_interval: (float) seconds between batch status checks, defaults to BATCH_POLL_INTERVAL
+        """
+        self.backend = BATCH_BACKEND if backend is None else backend
+        self.poll_interval = BATCH_POLL_INTERVAL if poll_interval is None else poll_interval
+        self.requests = list()
+
+    def submit(self, model_str, prompt, system_prompt, openai_api_key=None, temp=None, max_tokens=None, stop_on=None, print_cost=True):
+        """
+        Queue a request, it is sent on flush()
+        @param stop_on: (callable) optional stop condition applied to the returned text
+        @return: (concurrent.futures.Future) future of the model response (str)
+        """
+        future = concurrent.futures.Future()
+        self.requests.append({
+            "custom_id": f"request-{len(self.requests)}",
+            "model_str": MODEL_ALIASES.get(model_str, model_str),
+            "prompt": prompt,
+            "system_prompt": system_prompt,
+            "openai_api_key": openai_api_key,
+            "temp": temp,
+            "max_tokens": max_tokens,
+            "stop_on": stop_on,
+            "print_cost": print_cost,
+            # scope of the submitting code, the batch runs on the inference loop
+            "scope": current_scope(),
+            "future": future,
+        })
+        return future
+
+    def flush(self):
+        """
+        Send all queued requests without waiting for the answers
+        @return: (concurrent.futures.Future) future that is done once every request is resolved
+        """
+        requests, self.requests = self.requests, list()
+        return submit_coroutine(self._run(requests))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if len(self.requests) > 0:
+            self.flush()
+
+    async def _run(self, requests):
+        provider_batch, direct = list(), list()
+        for request in requests:
+            provider = MODEL_ENDPOINTS.get(request["model_str"], (None,))[0]
+            if self.backend == "openai" and provider == "openai":
+                provider_batch.append(request)
+            else:
+                direct.append(request)
+        await asyncio.gather(self._run_openai(provider_batch), *[self._run_direct(_r) for _r in direct])
+
+    @staticmethod
+    async def _run_direct(request):
+        try:
+            with accounting_scope(phase=request["scope"][0], agent=request["scope"][1]):
+                answer = await aquery_model(
+                    model_str=request["model_str"], prompt=request["prompt"], system_prompt=request["system_prompt"],
+                    openai_api_key=request["openai_api_key"], temp=request["temp"], max_tokens=request["max_tokens"],
+                    stop_on=request["stop_on"], print_cost=request["print_cost"])
+            request["future"].set_result(answer)
+        except Exception as e:
+            request["future"].set_exception(e)
+
+    async def _run_openai(self, requests):
+        if len(requests) == 0:
+            return
+        try:
+            results = await self._openai_batch(requests)
+        except Exception as e:
+            print(f"OpenAI batch failed, sending requests directly: {e}")
+            results = dict()
+        retry = list()
+        for request in requests:
+            result = results.get(request["custom_id"])
+            if result is None or result.get("error") is not None or result["response"]["status_code"] != 200:
+                # expired or failed inside the batch
+                retry.append(request)
+                continue
+            body = result["response"]["body"]
+            answer = body["choices"][0]["message"]["content"]
+            usage = body.get("usage", dict())
+            cached = (usage.get("prompt_tokens_details") or dict()).get("cached_tokens", 0) or 0
+            TOKEN_ACCOUNTING.record(request["model_str"], usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0), cached,
+                                    phase=request["scope"][0], agent=request["scope"][1], price_factor=BATCH_PRICE_FACTOR)
+            if request["stop_on"] is not None and request["stop_on"](answer) is not None:
+                answer = answer[:request["stop_on"](answer)]
+            request["future"].set_result(answer)
+        await asyncio.gather(*[self._run_direct(_r) for _r in retry])
+
+    async def _openai_batch(self, requests):
+        """
+        Submit requests through the OpenAI Batch API and poll until the batch ends
+        @return: (dict) custom_id -> result line
+        """
+        if requests[0]["openai_api_key"] is not None:
+            os.environ["OPENAI_API_KEY"] = requests[0]["openai_api_key"]
+        client = provider_client("openai")
+        lines = list()
+        for request in requests:
+            body = openai_chat_request(request["model_str"], request["prompt"], request["system_prompt"], request["temp"], request["max_tokens"])
+            lines.append(json.dumps({"custom_id": request["custom_id"], "method": "POST", "url": "/v1/chat/completions", "body": body}))
+        batch_file = await client.files.create(file=("batch.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch")
+        batch = await client.batches.create(input_file_id=batch_file.id, endpoint="/v1/chat/completions", completion_window=BATCH_COMPLETION_WINDOW)
+        print(f"Submitted OpenAI batch {batch.id} with {len(requests)} requests")
+        while batch.status not in ["completed", "failed", "expired", "cancelled"]:
+            await asyncio.sleep(self.poll_interval)
+            batch = await client.batches.retrieve(batch.id)
+        results = dict()
+        if batch.output_file_id is not None:
+            content = await client.files.content(batch.output_file_id)
+            for line in content.text.splitlines():
+                if len(line.strip()) == 0: continue
+                result = json.loads(line)
+                results[result["custom_id"]] = result
+        return results
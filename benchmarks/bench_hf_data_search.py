@@ -0,0 +1,80 @@
+"""
+Benchmark of HFDataSearch construction time versus corpus size, on synthetic huggingface datasets metadata.
+
+    python benchmarks/bench_hf_data_search.py --sizes 10000,100000,1000000
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+from datasets import Dataset
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools import HFDataSearch, filter_hf_datasets
+
+
+def synthetic_metadata(size, seed=0):
+    rng = np.random.default_rng(seed)
+    words = [f"word{_i}" for _i in range(5000)]
+    lengths = rng.integers(0, 60, size)
+    # heavy-tailed like the real counts, with missing values and blank descriptions
+    likes = rng.zipf(1.8, size).astype(object)
+    downloads = rng.zipf(1.3, size).astype(object)
+    likes[rng.random(size) < 0.05] = None
+    downloads[rng.random(size) < 0.05] = None
+    descriptions = [" ".join(rng.choice(words, _n)) if _n > 0 else " " for _n in lengths]
+    return Dataset.from_dict({"id": [f"user/dataset-{_i}" for _i in range(size)], "description": descriptions,
+                              "likes": [None if _l is None else min(int(_l), 10 ** 6) for _l in likes],
+                              "downloads": [None if _d is None else min(int(_d), 10 ** 9) for _d in downloads]})
+
+
+def row_filter(ds, like_thr, dwn_thr):
+    """
+    Per-row filter HFDataSearch used before the vectorized one, for comparison
+    """
+    filtered_indices = []
+    for idx, item in enumerate(ds):
+        likes = int(item['likes']) if item['likes'] is not None else 0
+        downloads = int(item['downloads']) if item['downloads'] is not None else 0
+        if likes >= like_thr and downloads >= dwn_thr:
+            description = item['description']
+            if isinstance(description, str) and description.strip():
+                filtered_indices.append(idx)
+    return filtered_indices
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HFDataSearch construction benchmark")
+    parser.add_argument("--sizes", type=str, default="10000,100000,1000000", help="Comma separated corpus sizes.")
+    parser.add_argument("--like-thr", type=str, default="3")
+    parser.add_argument("--dwn-thr", type=str, default="50")
+    parser.add_argument("--skip-row-filter", type=str, default="false", help="Skip the slow per-row reference filter.")
+    args = parser.parse_args()
+    like_thr, dwn_thr = int(args.like_thr), int(args.dwn_thr)
+    print(f"{'rows':>10} {'kept':>8} {'row filter':>11} {'vectorized':>11} {'build':>8} {'load':>8}")
+    for size in [int(_s) for _s in args.sizes.split(",")]:
+        ds = synthetic_metadata(size)
+        row_seconds = None
+        if args.skip_row_filter.lower() != "true":
+            row_seconds, row_indices = timed(lambda: row_filter(ds, like_thr, dwn_thr))
+        vec_seconds, (indices, _, _) = timed(lambda: filter_hf_datasets(ds.data, like_thr, dwn_thr))
+        if row_seconds is not None and list(indices) != row_indices:
+            raise Exception("Vectorized filter disagrees with the per-row filter!")
+        with tempfile.TemporaryDirectory() as index_dir:
+            build_seconds, _ = timed(lambda: HFDataSearch(like_thr=like_thr, dwn_thr=dwn_thr, index_dir=index_dir, source=ds))
+            load_seconds, _ = timed(lambda: HFDataSearch(like_thr=like_thr, dwn_thr=dwn_thr, index_dir=index_dir, source=ds))
+        row_str = f"{row_seconds:>10.3f}s" if row_seconds is not None else f"{'-':>11}"
+        print(f"{size:>10} {len(indices):>8} {row_str} {vec_seconds:>10.3f}s {build_seconds:>7.2f}s {load_seconds:>7.3f}s")
+
+
+if __name__ == "__main__":
+    main()
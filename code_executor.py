@@ -0,0 +1,528 @@
+import os
+import sys
+import time
+import queue
+import shutil
+import socket
+import hashlib
+import tempfile
+import signal
+import atexit
+import itertools
+import importlib
+import selectors
+import threading
+import traceback
+import multiprocessing
+import multiprocessing.util
+from collections import OrderedDict
+
+import incremental_exec
+from incremental_exec import FrameBuffer, fork, split_cells, prefix_keys, send_frame, run_cells, files_intact, cuda_initialized
+from resource_limits import ResourceMeter, current_limits, set_limits, setup_executor_process
+from profiler import SamplingProfiler
+from output_capture import BoundedCapture
+
+
+# imported once per worker instead of once per execution
+PREWARM_MODULES = ["numpy", "pandas", "matplotlib.pyplot", "sklearn", "torch", "datasets"]
+EXECUTION_WORKERS = 2
+WORKER_STARTUP_TIMEOUT = 300
+# run the dataset code once and fork a child per candidate (POSIX only)
+SNAPSHOT_ENABLED = True
+SNAPSHOT_SETUP_TIMEOUT = 600
+# forked executions that may run at once, e.g. concurrent solver candidates
+SNAPSHOT_CONCURRENCY = os.cpu_count() or 1
+
+
+def timeout_message(timeout):
+    return f"[CODE EXECUTION ERROR]: Code execution exceeded the timeout limit of {timeout} seconds. You must reduce the time complexity of your code."
+
+
+def run_in_namespace(code_str, namespace, max_len, log_path=None):
+    """
+    Execute code in a namespace and capture what it prints (only called inside worker processes)
+    @param code_str: (str) code to execute
+    @param namespace: (dict) globals for exec
+    @param max_len: (int) length of the returned output, longer output keeps its head and tail
+    @param log_path: (str) file the full output is streamed to
+    @return: (str) captured output, with "[CODE EXECUTION ERROR]" and the traceback on failure
+    """
+    output_capture = BoundedCapture(max_len, log_path)
+    sys.stdout = output_capture
+    try:
+        exec(code_str, namespace)
+    except BaseException as e:
+        # SystemExit and KeyboardInterrupt must not take the worker down
+        output_capture.write(f"[CODE EXECUTION ERROR]: {str(e)}\n")
+        traceback.print_exc(file=output_capture)
+    finally:
+        sys.stdout = sys.__stdout__
+        try:
+            import matplotlib.pyplot as plt
+            plt.close("all")
+        except Exception:
+            pass
+    output_capture.close_log()
+    return output_capture.getvalue()
+
+
+def _prepare_worker(prewarm, limits):
+    # spawned, the configuration of the orchestrator is not inherited
+    set_limits(limits)
+    if hasattr(os, "setpgrp"):
+        # own process group, so that a timeout also kills the processes the code started
+        os.setpgrp()
+    try:
+        import matplotlib
+        matplotlib.use("Agg")  # prevent plotting errors
+    except ImportError:
+        pass
+    for module in prewarm:
+        try:
+            importlib.import_module(module)
+        except Exception:
+            pass
+    setup_executor_process()
+
+
+def _worker_main(conn, prewarm, limits):
+    """
+    Worker loop: pre-import the heavy modules once, then run one code string per request in a fresh namespace
+    under the configured resource limits
+    """
+    _prepare_worker(prewarm, limits)
+    conn.send("ready")
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        code_str, cwd, max_len, profile_path, log_path = task
+        os.chdir(cwd)
+        profiler = SamplingProfiler(profile_path).start() if profile_path is not None else None
+        meter = ResourceMeter().start()
+        output = run_in_namespace(code_str, {"__name__": "__main__"}, max_len, log_path)
+        meter.stop()
+        if profiler is not None:
+            profiler.stop()
+        conn.send(output + meter.summary())
+
+
+class _Worker:
+    def __init__(self, ctx, prewarm, limits) -> None:
+        self.conn, child_conn = ctx.Pipe()
+        # not a daemon, generated code may start its own processes (e.g. DataLoader workers)
+        self.process = ctx.Process(target=_worker_main, args=(child_conn, prewarm, limits), name="code-executor")
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+
+    def wait_ready(self):
+        if not self.ready:
+            if not self.conn.poll(WORKER_STARTUP_TIMEOUT) or self.conn.recv() != "ready":
+                raise Exception("Code execution worker did not start")
+            self.ready = True
+
+    def kill(self):
+        try:
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except (AttributeError, OSError):
+                self.process.kill()
+            self.process.join()
+        finally:
+            self.conn.close()
+
+
+class ExecutionPool:
+    def __init__(self, workers=2, prewarm=None) -> None:
+        """
+        Pool of pre-warmed worker processes that execute generated code
+        @param workers: (int) number of worker processes, i.e. executions that can run at once
+        @param prewarm: (list) modules imported by each worker at startup, defaults to PREWARM_MODULES
+        """
+        # spawn: the orchestrator runs threads (e.g. the inference loop) that must not be forked
+        self.ctx = multiprocessing.get_context("spawn")
+        self.prewarm = PREWARM_MODULES if prewarm is None else prewarm
+        self.limits = current_limits()
+        self.workers = workers
+        self._idle = queue.Queue()
+        for _ in range(workers):
+            self._idle.put(_Worker(self.ctx, self.prewarm, self.limits))
+
+    def run(self, code_str, timeout=60, max_len=1000, cwd=None, profile_path=None, log_path=None):
+        """
+        Execute code in the next idle worker, killing and replacing the worker on timeout
+        @param code_str: (str) code to execute
+        @param timeout: (float) seconds before the execution is killed
+        @param max_len: (int) length of the returned output, longer output keeps its head and tail
+        @param cwd: (str) working directory for the execution, defaults to the current one
+        @param profile_path: (str) run under the sampling profiler and write the profile here
+        @param log_path: (str) file the full output is streamed to
+        @return: (str) captured output followed by the resource usage of the execution
+        """
+        worker = self._idle.get()
+        try:
+            worker.wait_ready()
+            worker.conn.send((code_str, os.getcwd() if cwd is None else cwd, max_len, profile_path, log_path))
+            if not worker.conn.poll(timeout):
+                worker.kill()
+                worker = _Worker(self.ctx, self.prewarm, self.limits)
+                return timeout_message(timeout)
+            return worker.conn.recv()
+        except (EOFError, OSError) as e:
+            # the worker died, e.g. segfault or out of memory
+            worker.kill()
+            worker = _Worker(self.ctx, self.prewarm, self.limits)
+            return f"[CODE EXECUTION ERROR]: Code execution process crashed: {str(e)}"
+        finally:
+            self._idle.put(worker)
+
+    def shutdown(self):
+        while not self._idle.empty():
+            worker = self._idle.get()
+            try:
+                worker.conn.send(None)
+                worker.process.join(5)
+            except Exception:
+                pass
+            if worker.process.is_alive():
+                worker.kill()
+
+
+def _snapshot_main(conn, setup_code, cwd, prewarm, limits, checkpoint_max, checkpoint_min_seconds):
+    """
+    Snapshot parent: run the setup code once, then fork a copy-on-write runner for every request, so each
+    candidate starts from the already loaded namespace. Runners checkpoint their state after slow top-level
+    cells and a later request resumes from the checkpoint of its longest unchanged prefix of cells.
+    Runners execute concurrently, each under the configured resource limits (the setup code is not limited).
+    """
+    _prepare_worker(prewarm, limits)
+    incremental_exec.CHECKPOINT_MAX = checkpoint_max
+    incremental_exec.CHECKPOINT_MIN_SECONDS = checkpoint_min_seconds
+    os.chdir(cwd)
+    namespace = {"__name__": "__main__"}
+    setup_output = run_in_namespace(setup_code, namespace, max_len=None)
+    if "[CODE EXECUTION ERROR]" in setup_output:
+        conn.send(("failed", setup_output))
+        return
+    if cuda_initialized():
+        # every fork of this process would fail on CUDA
+        conn.send(("cuda", setup_output))
+        return
+    conn.send(("ready", setup_output))
+    # runners report through their sockets, their exit status is not needed
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    root_key = hashlib.sha256(setup_code.encode("utf-8")).hexdigest()
+    checkpoint_dir = tempfile.mkdtemp(prefix="agentlab-checkpoints-")
+    checkpoints = OrderedDict()
+    stats = {"runs": 0, "cells": 0, "cells_reused": 0, "checkpoint_hits": 0, "seconds_saved": 0.0}
+    selector = selectors.DefaultSelector()
+    selector.register(conn.fileno(), selectors.EVENT_READ, None)
+    runners = dict()
+
+    def drop_checkpoint(key):
+        checkpoint = checkpoints.pop(key)
+        try:
+            os.killpg(checkpoint["pid"], signal.SIGKILL)
+        except OSError:
+            pass
+        if os.path.exists(checkpoint["path"]):
+            os.unlink(checkpoint["path"])
+
+    def start_runner(task_id, code_str, task_cwd, max_len, timeout, profile_path, log_path):
+        cells = split_cells(code_str)
+        # the state after a prefix of cells includes the files it wrote, which are only there in its own cwd
+        keys = prefix_keys(hashlib.sha256(f"{root_key}\n{task_cwd}".encode("utf-8")).hexdigest(), cells)
+        stats["runs"] += 1
+        stats["cells"] += len(cells)
+        # resume from the longest prefix that has a live checkpoint
+        for start in reversed(range(1, len(cells))):
+            if keys[start] not in checkpoints:
+                continue
+            if not files_intact(task_cwd, checkpoints[keys[start]]["written"]):
+                # e.g. figures removed since, they would be missing if the cells that wrote them were skipped
+                continue
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(checkpoints[keys[start]]["path"])
+                send_frame(sock, (cells, keys, start, task_cwd, max_len, profile_path, log_path))
+            except OSError:
+                sock.close()
+                drop_checkpoint(keys[start])
+                continue
+            checkpoints.move_to_end(keys[start])
+            stats["cells_reused"] += start
+            stats["checkpoint_hits"] += 1
+            stats["seconds_saved"] += checkpoints[keys[start]]["seconds"]
+            break
+        else:
+            sock, runner_sock = socket.socketpair()
+            if fork() == 0:
+                sock.close()
+                # the capture starts with the setup output, so head and tail are taken as if both ran together
+                run_cells(runner_sock, namespace, cells, keys, 0, setup_output, 0.0, task_cwd, max_len, checkpoint_dir, os.getppid(), profile_path, log_path)
+            runner_sock.close()
+        sock.setblocking(False)
+        runners[sock] = {"id": task_id, "pid": None, "deadline": time.monotonic() + timeout, "timeout": timeout, "frames": FrameBuffer(), "output": None, "usage": str()}
+        selector.register(sock, selectors.EVENT_READ, sock)
+
+    def finish_runner(sock, output, usage=str()):
+        selector.unregister(sock)
+        sock.close()
+        runner = runners.pop(sock)
+        if runner["pid"] is not None:
+            try:
+                os.killpg(runner["pid"], signal.SIGKILL)
+            except OSError:
+                pass
+        conn.send((runner["id"], output, usage, dict(stats)))
+
+    try:
+        while True:
+            deadlines = [_r["deadline"] for _r in runners.values()]
+            wait = max(0.0, min(deadlines) - time.monotonic()) if len(deadlines) > 0 else None
+            for key, _ in selector.select(wait):
+                if key.data is None:
+                    try:
+                        task = conn.recv()
+                    except EOFError:
+                        task = None
+                    if task is None:
+                        for sock in list(runners):
+                            finish_runner(sock, "[CODE EXECUTION ERROR]: Code execution was cancelled")
+                        return
+                    start_runner(*task)
+                    continue
+                sock = key.data
+                if sock not in runners:
+                    continue
+                runner = runners[sock]
+                try:
+                    chunk = sock.recv(65536)
+                except BlockingIOError:
+                    continue
+                except OSError:
+                    chunk = b""
+                if len(chunk) == 0:
+                    # the runner exited, e.g. killed by the OOM killer if it sent no output
+                    finish_runner(sock, runner["output"] if runner["output"] is not None else "[CODE EXECUTION ERROR]: Code execution process crashed", runner["usage"])
+                    continue
+                for frame in runner["frames"].feed(chunk):
+                    if frame[0] == "pid":
+                        runner["pid"] = frame[1]
+                    elif frame[0] == "checkpoint":
+                        _, checkpoint_key, pid, path, seconds, written = frame
+                        if checkpoint_key in checkpoints:
+                            drop_checkpoint(checkpoint_key)
+                        checkpoints[checkpoint_key] = {"pid": pid, "path": path, "seconds": seconds, "written": written}
+                        while len(checkpoints) > checkpoint_max:
+                            drop_checkpoint(next(iter(checkpoints)))
+                    elif frame[0] == "output":
+                        runner["output"], runner["usage"] = frame[1], frame[2]
+            now = time.monotonic()
+            for sock, runner in list(runners.items()):
+                if runner["deadline"] <= now:
+                    finish_runner(sock, timeout_message(runner["timeout"]))
+    finally:
+        for checkpoint_key in list(checkpoints):
+            drop_checkpoint(checkpoint_key)
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+
+
+class SnapshotExecutor:
+    def __init__(self, setup_code, cwd=None, prewarm=None) -> None:
+        """
+        Run setup code (e.g. dataset loading) once in a worker process, then execute each code string in a
+        forked copy of that process, so the setup is not repeated for every candidate
+        @param setup_code: (str) code run once, its variables are visible to every execution
+        @param cwd: (str) working directory of the setup code, defaults to the current one
+        @param prewarm: (list) modules imported before the setup code, defaults to PREWARM_MODULES
+        """
+        self.setup_code = setup_code
+        self.cwd = os.getcwd() if cwd is None else cwd
+        self.available = False
+        self.setup_output = str()
+        self.stats = dict()
+        self._ids = itertools.count()
+        self._futures = dict()
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(SNAPSHOT_CONCURRENCY)
+        ctx = multiprocessing.get_context("spawn")
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_snapshot_main, name="code-snapshot",
+                                   args=(child_conn, setup_code, self.cwd, PREWARM_MODULES if prewarm is None else prewarm, current_limits(),
+                                         incremental_exec.CHECKPOINT_MAX, incremental_exec.CHECKPOINT_MIN_SECONDS))
+        self.process.start()
+        child_conn.close()
+        if self.conn.poll(SNAPSHOT_SETUP_TIMEOUT + WORKER_STARTUP_TIMEOUT):
+            try:
+                status, self.setup_output = self.conn.recv()
+                self.available = status == "ready"
+                if status == "cuda":
+                    print("The dataset code initializes CUDA, which forked processes cannot use: code runs in the execution pool instead of a snapshot.")
+            except EOFError:
+                pass
+        if not self.available:
+            self.shutdown()
+            return
+        threading.Thread(target=self._read_results, name="code-snapshot-reader", daemon=True).start()
+
+    def _read_results(self):
+        while True:
+            try:
+                task_id, output, usage, stats = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                self.stats = stats
+                future = self._futures.pop(task_id, None)
+            if future is not None:
+                future.put((output, usage))
+        # the snapshot process is gone, release everything still waiting on it
+        with self._lock:
+            self.available = False
+            futures, self._futures = self._futures, dict()
+        for future in futures.values():
+            future.put(("[CODE EXECUTION ERROR]: Code execution process crashed", str()))
+
+    def run(self, code_str, timeout=60, max_len=1000, cwd=None, profile_path=None, log_path=None):
+        """
+        Execute code against the setup namespace in a fresh fork, killed on timeout. Execution resumes
+        from the checkpoint of the longest unchanged prefix of top-level statements, if there is one
+        @param code_str: (str) code to execute after the setup code
+        @param timeout: (float) seconds before the fork is killed
+        @param max_len: (int) length of the returned output, longer output keeps its head and tail
+        @param cwd: (str) working directory for the execution, defaults to the current one
+        @param profile_path: (str) run under the sampling profiler and write the profile here
+        @param log_path: (str) file the full output is streamed to
+        @return: (str) setup output followed by the captured output, as if both were run together, and the resource usage
+        """
+        result = queue.Queue(maxsize=1)
+        with self._slots:
+            with self._lock:
+                if not self.available:
+                    raise Exception("Snapshot executor is not running")
+                task_id = next(self._ids)
+                self._futures[task_id] = result
+                self.conn.send((task_id, code_str, os.getcwd() if cwd is None else cwd, max_len, timeout, profile_path, log_path))
+            try:
+                output, usage = result.get(timeout=timeout + 30)
+            except queue.Empty:
+                output, usage = timeout_message(timeout), str()
+        return output + usage
+
+    def shutdown(self):
+        with self._lock:
+            self.available = False
+        try:
+            self.conn.send(None)
+        except Exception:
+            pass
+        self.process.join(5)
+        if self.process.is_alive():
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except (AttributeError, OSError):
+                self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+_pool = None
+_snapshot = None
+_pool_lock = threading.Lock()
+# held while a snapshot executor runs its setup code, which can take minutes, _pool_lock only guards the globals
+_snapshot_lock = threading.Lock()
+
+
+def _shutdown_executors():
+    """
+    Shut down the current execution pool and snapshot executor at exit
+    @return: None
+    """
+    with _pool_lock:
+        pool, snapshot = _pool, _snapshot
+    if snapshot is not None:
+        snapshot.shutdown()
+    if pool is not None:
+        pool.shutdown()
+
+
+# multiprocessing.util registers its exit handler on import, this one is registered later and runs before it joins the children
+atexit.register(_shutdown_executors)
+
+
+def execution_pool():
+    """
+    @return: (ExecutionPool) process-wide pool, started on first use
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ExecutionPool(workers=EXECUTION_WORKERS, prewarm=PREWARM_MODULES)
+    return _pool
+
+
+def snapshot_executor(setup_code):
+    """
+    Snapshot executor for a setup code, the previous one is shut down when the setup code changes
+    @param setup_code: (str) code run once before every execution, e.g. the dataset code
+    @return: (SnapshotExecutor) running executor, or None if snapshots are disabled, unsupported, the setup code fails
+        or initializes CUDA (the execution pool is used instead)
+    """
+    global _snapshot
+    if not SNAPSHOT_ENABLED or not hasattr(os, "fork"):
+        return None
+    with _snapshot_lock:
+        snapshot = _snapshot
+        if snapshot is None or snapshot.setup_code != setup_code or snapshot.cwd != os.getcwd():
+            if snapshot is not None:
+                snapshot.shutdown()
+            # a failed setup is kept as well, so that it is not re-run for every candidate
+            snapshot = SnapshotExecutor(setup_code)
+            with _pool_lock:
+                _snapshot = snapshot
+    return snapshot if snapshot.available else None
+
+
+def execution_stats():
+    """
+    @return: (dict) reuse statistics of the incremental execution of the current snapshot
+    """
+    with _pool_lock:
+        snapshot = _snapshot
+    if snapshot is None:
+        return dict()
+    stats = dict(snapshot.stats)
+    if stats.get("cells", 0) > 0:
+        stats["cell_reuse"] = stats["cells_reused"] / stats["cells"]
+    return stats
+
+
+def configure_code_executor(workers=2, prewarm=None, snapshot=True, checkpoints=8, checkpoint_min_seconds=1.0):
+    """
+    Set the size of the execution pool and the modules its workers pre-import
+    @param workers: (int) number of worker processes
+    @param prewarm: (list) module names, defaults to PREWARM_MODULES
+    @param snapshot: (bool) run the dataset code once and fork it for every candidate
+    @param checkpoints: (int) checkpointed interpreter states kept for incremental execution, 0 disables it
+    @param checkpoint_min_seconds: (float) only statements that ran at least this long are checkpointed
+    @return: None
+    """
+    global _pool, _snapshot, EXECUTION_WORKERS, PREWARM_MODULES, SNAPSHOT_ENABLED
+    with _snapshot_lock, _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
+        if _snapshot is not None:
+            _snapshot.shutdown()
+            _snapshot = None
+        EXECUTION_WORKERS = workers
+        SNAPSHOT_ENABLED = snapshot
+        incremental_exec.CHECKPOINT_MAX = checkpoints
+        incremental_exec.CHECKPOINT_MIN_SECONDS = checkpoint_min_seconds
+        if prewarm is not None: PREWARM_MODULES = prewarm
@@ -0,0 +1,84 @@
+import threading
+from collections import deque
+
+
+class LatencyTracker:
+    def __init__(self, window=200) -> None:
+        """
+        Sliding window of end-to-end query latencies per model
+        @param window: (int) number of recent calls kept per model
+        """
+        self.window = window
+        self._lock = threading.Lock()
+        self.latencies = dict()
+
+    def observe(self, model_str, seconds):
+        with self._lock:
+            if model_str not in self.latencies:
+                self.latencies[model_str] = deque(maxlen=self.window)
+            self.latencies[model_str].append(seconds)
+
+    def percentile(self, model_str, q, min_samples=1):
+        """
+        @param model_str: (str) canonical model name
+        @param q: (float) percentile in [0, 1]
+        @param min_samples: (int) samples required before a value is returned
+        @return: (float) latency in seconds or None if not enough samples
+        """
+        with self._lock:
+            samples = sorted(self.latencies.get(model_str, list()))
+        if len(samples) == 0 or len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class HedgePolicy:
+    def __init__(self, percentile=None, fallbacks=None, min_samples=20, window=200) -> None:
+        """
+        When to send a duplicate of a slow LLM call, and to which model
+        @param percentile: (float) hedge once a call is slower than this latency percentile, None disables hedging
+        @param fallbacks: (dict) model_str -> model used for the duplicate, defaults to the same model
+        @param min_samples: (int) latencies observed for a model before it is hedged
+        @param window: (int) latencies kept per model
+        """
+        self.percentile = percentile
+        self.fallbacks = dict() if fallbacks is None else fallbacks
+        self.min_samples = min_samples
+        self.latency = LatencyTracker(window=window)
+        self.stats = {"hedged": 0, "hedge_won": 0, "primary_won": 0}
+
+    @property
+    def enabled(self):
+        return self.percentile is not None
+
+    def hedge_after(self, model_str):
+        """
+        @param model_str: (str) canonical model name
+        @return: (float) seconds to wait before hedging or None to never hedge
+        """
+        if not self.enabled:
+            return None
+        return self.latency.percentile(model_str, self.percentile, min_samples=self.min_samples)
+
+    def hedge_model(self, model_str):
+        return self.fallbacks.get(model_str, model_str)
+
+    def record_race(self, hedge_won):
+        self.stats["hedged"] += 1
+        self.stats["hedge_won" if hedge_won else "primary_won"] += 1
+
+
+HEDGE_POLICY = HedgePolicy()
+
+
+def configure_hedging(percentile=0.95, fallbacks=None, min_samples=20):
+    """
+    Enable hedged requests for every query_model call
+    @param percentile: (float) latency percentile after which a duplicate is sent, None to disable
+    @param fallbacks: (dict) model_str -> model used for the duplicate, e.g. {"o1-mini": "gpt-4o"}
+    @param min_samples: (int) latencies observed for a model before it is hedged
+    @return: (HedgePolicy) the new policy
+    """
+    global HEDGE_POLICY
+    HEDGE_POLICY = HedgePolicy(percentile=percentile, fallbacks=fallbacks, min_samples=min_samples)
+    return HEDGE_POLICY
@@ -0,0 +1,213 @@
+import os
+import json
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.decomposition import TruncatedSVD
+
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+LSA_COMPONENTS = 128
+# terms in fewer descriptions carry no latent structure and would only inflate the projection
+LSA_MIN_DF = 2
+# inverted lists probed per query, of about sqrt(datasets) lists
+IVF_NPROBE = 8
+IVF_KMEANS_ITERATIONS = 10
+IVF_KMEANS_SAMPLE = 20000
+HYBRID_FILES = ["bm25_data", "bm25_indices", "bm25_indptr", "lsa_columns", "lsa_components", "lsa_vectors", "ivf_centroids", "ivf_order", "ivf_offsets"]
+
+
+def bm25_matrix(counts, k1=BM25_K1, b=BM25_B):
+    """
+    Document side of BM25: the score of a query is the product of this matrix with the query's term counts
+    @param counts: (csr_matrix) term counts, one row per document
+    @return: (csr_matrix) BM25 weight of every (document, term) pair
+    """
+    counts = csr_matrix(counts, dtype=np.float64)
+    doc_len = np.asarray(counts.sum(axis=1)).ravel()
+    avg_len = doc_len.mean() if len(doc_len) > 0 and doc_len.mean() > 0 else 1.0
+    n_docs = counts.shape[0]
+    df = np.bincount(counts.indices, minlength=counts.shape[1])
+    idf = np.log(1.0 + (n_docs - df + 0.5) / (df + 0.5))
+    # document length of every stored entry
+    row_len = np.repeat(doc_len, np.diff(counts.indptr))
+    tf = counts.data
+    weights = idf[counts.indices] * tf * (k1 + 1) / (tf + k1 * (1 - b + b * row_len / avg_len))
+    return csr_matrix((weights.astype(np.float32), counts.indices, counts.indptr), shape=counts.shape)
+
+
+def _normalize_rows(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+
+def fit_lsa(tfidf, n_components=LSA_COMPONENTS, min_df=LSA_MIN_DF, seed=0):
+    """
+    Latent semantic analysis of the TF-IDF matrix, computed locally with a truncated SVD
+    @param tfidf: (csr_matrix) TF-IDF vectors of the descriptions
+    @return: (tuple) columns used, components (n_components x columns) and l2-normalized document vectors
+    """
+    columns = np.flatnonzero(np.bincount(tfidf.indices, minlength=tfidf.shape[1]) >= min_df)
+    reduced = tfidf[:, columns]
+    n_components = max(1, min(n_components, min(reduced.shape) - 1))
+    svd = TruncatedSVD(n_components=n_components, random_state=seed)
+    vectors = svd.fit_transform(reduced)
+    return columns, svd.components_.astype(np.float32), _normalize_rows(vectors).astype(np.float32)
+
+
+def lsa_project(query_tfidf, columns, components):
+    """
+    @param query_tfidf: (csr_matrix) TF-IDF vectors of queries
+    @return: (np.ndarray) l2-normalized latent vectors of the queries
+    """
+    return _normalize_rows(np.asarray(query_tfidf[:, columns] @ components.T, dtype=np.float32))
+
+
+def _index_fingerprint(path):
+    """
+    @return: (str) fingerprint in the meta.json of a persisted search index directory, None if there is none
+    """
+    try:
+        with open(os.path.join(path, "meta.json")) as f:
+            return json.load(f)["fingerprint"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+class IVFIndex:
+    def __init__(self, vectors, centroids, order, offsets) -> None:
+        """
+        Inverted file index for approximate nearest neighbours by cosine: vectors are clustered with spherical
+        k-means and a query only scores the vectors of the clusters whose centroids are closest to it
+        @param vectors: (np.ndarray) l2-normalized vectors
+        @param centroids: (np.ndarray) l2-normalized cluster centroids
+        @param order: (np.ndarray) vector ids sorted by cluster
+        @param offsets: (np.ndarray) cluster c holds order[offsets[c]:offsets[c + 1]]
+        """
+        self.vectors = vectors
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+
+    @staticmethod
+    def build(vectors, n_lists=None, iterations=IVF_KMEANS_ITERATIONS, sample=IVF_KMEANS_SAMPLE, seed=0):
+        """
+        @param vectors: (np.ndarray) l2-normalized vectors
+        @param n_lists: (int) number of clusters, defaults to sqrt(len(vectors))
+        @return: (IVFIndex) index over the vectors
+        """
+        rng = np.random.default_rng(seed)
+        n_lists = max(1, min(len(vectors), int(np.sqrt(len(vectors))) if n_lists is None else n_lists))
+        # centroids are fitted on a sample, then every vector is assigned
+        train = vectors[np.sort(rng.choice(len(vectors), min(len(vectors), max(sample, n_lists)), replace=False))]
+        centroids = train[rng.choice(len(train), n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assign = np.argmax(train @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assign, train)
+            filled = np.bincount(assign, minlength=n_lists) > 0
+            # empty clusters keep their centroid
+            centroids[filled] = _normalize_rows(sums[filled])
+        assign = np.concatenate([np.argmax(vectors[_i:_i + 65536] @ centroids.T, axis=1) for _i in range(0, len(vectors), 65536)])
+        order = np.argsort(assign, kind="stable")
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=n_lists))])
+        return IVFIndex(vectors, centroids.astype(np.float32), order, offsets)
+
+    def search(self, queries, nprobe=IVF_NPROBE):
+        """
+        @param queries: (np.ndarray) l2-normalized query vectors
+        @param nprobe: (int) clusters scored per query
+        @return: (list) (candidate ids, cosine similarities) per query
+        """
+        nprobe = min(nprobe, len(self.centroids))
+        probes = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+        results = list()
+        for query, clusters in zip(queries, probes):
+            candidates = np.concatenate([self.order[self.offsets[_c]:self.offsets[_c + 1]] for _c in clusters])
+            results.append((candidates, self.vectors[candidates] @ query))
+        return results
+
+
+class HybridIndex:
+    def __init__(self, bm25, lsa_columns, lsa_components, ivf) -> None:
+        """
+        Lexical (BM25) and latent-semantic (LSA with an IVF index) sides of the hybrid dataset search
+        """
+        self.bm25 = bm25
+        self.lsa_columns = lsa_columns
+        self.lsa_components = lsa_components
+        self.ivf = ivf
+
+    @staticmethod
+    def build(counts, tfidf):
+        """
+        @param counts: (csr_matrix) term counts of the descriptions
+        @param tfidf: (csr_matrix) TF-IDF vectors of the descriptions, with the same vocabulary
+        @return: (HybridIndex)
+        """
+        columns, components, vectors = fit_lsa(tfidf)
+        return HybridIndex(bm25_matrix(counts), columns, components, IVFIndex.build(vectors))
+
+    def save(self, path, fingerprint):
+        """
+        Add the hybrid index to a persisted search index directory, hybrid.json is written last and marks it complete
+        @param path: (str) directory of the TF-IDF search index the hybrid index was built from
+        @param fingerprint: (str) fingerprint of the metadata snapshot both were built from
+        @return: (bool) whether it was saved, not if the directory holds the index of another snapshot
+        """
+        if _index_fingerprint(path) != fingerprint:
+            return False
+        arrays = {"bm25_data": self.bm25.data, "bm25_indices": self.bm25.indices, "bm25_indptr": self.bm25.indptr,
+                  "lsa_columns": self.lsa_columns, "lsa_components": self.lsa_components, "lsa_vectors": self.ivf.vectors,
+                  "ivf_centroids": self.ivf.centroids, "ivf_order": self.ivf.order, "ivf_offsets": self.ivf.offsets}
+        for name, array in arrays.items():
+            np.save(os.path.join(path, f"{name}.tmp.npy"), array)
+            os.replace(os.path.join(path, f"{name}.tmp.npy"), os.path.join(path, f"{name}.npy"))
+        with open(os.path.join(path, "hybrid.json"), "w") as f:
+            json.dump({"bm25_k1": BM25_K1, "bm25_b": BM25_B, "fingerprint": fingerprint, "shape": list(self.bm25.shape),
+                       "datasets": self.bm25.shape[0], "lsa_components": LSA_COMPONENTS, "lsa_rank": self.lsa_components.shape[0]}, f)
+        return True
+
+    @staticmethod
+    def load(path, fingerprint, shape):
+        """
+        @param path: (str) directory of the TF-IDF search index in use
+        @param fingerprint: (str) fingerprint of the metadata snapshot of the TF-IDF index in use
+        @param shape: (tuple) shape of its TF-IDF matrix, (datasets, vocabulary)
+        @return: (HybridIndex) memory-mapped index, or None if the directory has none for the current parameters
+            and TF-IDF index
+        """
+        try:
+            with open(os.path.join(path, "hybrid.json")) as f:
+                meta = json.load(f)
+            if meta["bm25_k1"] != BM25_K1 or meta["bm25_b"] != BM25_B or meta["lsa_components"] != LSA_COMPONENTS:
+                return None
+            # built from another snapshot than the TF-IDF index in use, or than the one saved next to it
+            if meta["fingerprint"] != fingerprint or _index_fingerprint(path) != fingerprint:
+                return None
+            if meta["shape"] != list(shape) or meta["datasets"] != shape[0]:
+                return None
+            arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in HYBRID_FILES}
+        except (OSError, ValueError, KeyError):
+            return None
+        if arrays["lsa_components"].shape[0] != meta["lsa_rank"] or arrays["lsa_vectors"].shape != (shape[0], meta["lsa_rank"]):
+            return None
+        bm25 = csr_matrix((arrays["bm25_data"], arrays["bm25_indices"], arrays["bm25_indptr"]), shape=tuple(meta["shape"]), copy=False)
+        ivf = IVFIndex(arrays["lsa_vectors"], np.asarray(arrays["ivf_centroids"]), arrays["ivf_order"], arrays["ivf_offsets"])
+        return HybridIndex(bm25, arrays["lsa_columns"], np.asarray(arrays["lsa_components"]), ivf)
+
+    def scores(self, query_counts, query_tfidf, nprobe=IVF_NPROBE):
+        """
+        @param query_counts: (csr_matrix) term counts of the queries
+        @param query_tfidf: (csr_matrix) TF-IDF vectors of the queries
+        @return: (tuple) BM25 scores and LSA cosine similarities, dense (queries x datasets). Datasets outside the
+            probed clusters get the lowest similarity found for the query.
+        """
+        # (datasets x queries), multiplying this way around does not copy the transposed matrix
+        bm25 = (self.bm25 @ csr_matrix((query_counts > 0).astype(np.float32)).T).toarray().T
+        lsa = np.zeros(bm25.shape, dtype=np.float32)
+        for row, (candidates, similarities) in enumerate(self.ivf.search(lsa_project(query_tfidf, self.lsa_columns, self.lsa_components), nprobe)):
+            if len(candidates) > 0:
+                lsa[row] = similarities.min()
+                lsa[row, candidates] = similarities
+        return bm25, lsa
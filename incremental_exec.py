@@ -0,0 +1,279 @@
+import os
+import ast
+import sys
+import time
+import pickle
+import random
+import socket
+import signal
+import struct
+import hashlib
+import traceback
+
+from resource_limits import ResourceMeter
+from profiler import SamplingProfiler
+from output_capture import BoundedCapture
+
+
+# checkpointed interpreter states kept per snapshot, 0 disables incremental execution
+CHECKPOINT_MAX = 8
+# cells faster than this are cheaper to re-run than to checkpoint
+CHECKPOINT_MIN_SECONDS = 1.0
+CHECKPOINT_OUTPUT_CAP = 100000
+CHECKPOINT_WATCHDOG_INTERVAL = 5.0
+
+
+def split_cells(code_str):
+    """
+    Split code into cells of top-level statements
+    @param code_str: (str) code
+    @return: (list) (source, first line number, cell key) per cell, a single cell if the code does not parse
+    """
+    try:
+        tree = ast.parse(code_str)
+    except SyntaxError:
+        return [(code_str, 1, hashlib.sha256(code_str.encode("utf-8")).hexdigest())]
+    lines = code_str.split("\n")
+    spans = list()
+    for node in tree.body:
+        start = min([node.lineno] + [_d.lineno for _d in getattr(node, "decorator_list", list())])
+        if len(spans) > 0 and start <= spans[-1][1]:
+            # several statements on one line, e.g. "import os; import sys"
+            spans[-1] = (spans[-1][0], max(spans[-1][1], node.end_lineno), spans[-1][2] + [node])
+        else:
+            spans.append((start, node.end_lineno, [node]))
+    cells = list()
+    for start, end, nodes in spans:
+        # keyed by the syntax tree, so comments, blank lines and moved line numbers do not invalidate a cell
+        key = hashlib.sha256("\n".join([ast.dump(_n) for _n in nodes]).encode("utf-8")).hexdigest()
+        cells.append(("\n".join(lines[start - 1:end]), start, key))
+    return cells
+
+
+def prefix_keys(root_key, cells):
+    """
+    @param root_key: (str) key of the state before the first cell (e.g. hash of the setup code)
+    @param cells: (list) output of split_cells
+    @return: (list) len(cells) + 1 keys, key i identifies the state after running cells[:i]
+    """
+    keys = [root_key]
+    for _, _, cell_key in cells:
+        keys.append(hashlib.sha256((keys[-1] + cell_key).encode("utf-8")).hexdigest())
+    return keys
+
+
+def cuda_initialized():
+    """
+    A process forked after CUDA was initialized cannot use CUDA, forking such a process only produces crashing children
+    @return: (bool) whether this process initialized CUDA through torch (torch is not imported to find out)
+    """
+    torch = sys.modules.get("torch")
+    if torch is None:
+        return False
+    try:
+        return torch.cuda.is_initialized()
+    except Exception:
+        return False
+
+
+def cwd_files(cwd):
+    """
+    @param cwd: (str) working directory
+    @return: (dict) name -> [mtime_ns, size] of the files directly in the directory
+    """
+    files = dict()
+    try:
+        with os.scandir(cwd) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    files[entry.name] = [stat.st_mtime_ns, stat.st_size]
+    except OSError:
+        pass
+    return files
+
+
+def files_intact(cwd, written):
+    """
+    @param cwd: (str) working directory of a new run
+    @param written: (dict) files a checkpointed prefix of cells wrote, as returned by cwd_files
+    @return: (bool) whether all of them are still there unchanged, i.e. the prefix can be skipped
+    """
+    for name, stat in written.items():
+        try:
+            current = os.stat(os.path.join(cwd, name), follow_symlinks=False)
+        except OSError:
+            return False
+        if [current.st_mtime_ns, current.st_size] != stat:
+            return False
+    return True
+
+
+def fork():
+    """
+    os.fork that keeps the state of the random module, Python reseeds it in forked children
+    and code that seeded it in an earlier cell must see the same numbers after a resume
+    @return: (int) pid, 0 in the child
+    """
+    state = random.getstate()
+    pid = os.fork()
+    if pid == 0:
+        random.setstate(state)
+    return pid
+
+
+def send_frame(sock, obj):
+    data = pickle.dumps(obj)
+    sock.sendall(struct.pack("!I", len(data)) + data)
+
+
+def recv_frame(sock):
+    """
+    Blocking read of one frame
+    @return: (object) frame or None on EOF
+    """
+    header = _recv_exact(sock, 4)
+    if header is None:
+        return None
+    return pickle.loads(_recv_exact(sock, struct.unpack("!I", header)[0]))
+
+
+def _recv_exact(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if len(chunk) == 0:
+            return None
+        data += chunk
+    return data
+
+
+class FrameBuffer:
+    def __init__(self) -> None:
+        """
+        Incremental decoder for frames read from a non-blocking socket
+        """
+        self.data = b""
+
+    def feed(self, chunk):
+        """
+        @param chunk: (bytes) data read from the socket
+        @return: (list) frames completed by this chunk
+        """
+        self.data += chunk
+        frames = list()
+        while len(self.data) >= 4:
+            size = struct.unpack("!I", self.data[:4])[0]
+            if len(self.data) < 4 + size:
+                break
+            frames.append(pickle.loads(self.data[4:4 + size]))
+            self.data = self.data[4 + size:]
+        return frames
+
+
+def run_cells(sock, namespace, cells, keys, start, output, seconds, cwd, max_len, checkpoint_dir, root_pid, profile_path=None, log_path=None, written=None):
+    """
+    Runner process: execute cells[start:] against the namespace, checkpoint after slow cells and report
+    over the socket: ("pid", pid), then ("checkpoint", key, pid, path, seconds, written files) for each
+    checkpoint and ("output", str, resource usage) at the end. Never returns.
+    @param output: (str) output printed by cells[:start]
+    @param seconds: (float) execution time of cells[:start]
+    @param profile_path: (str) run under the sampling profiler and write the profile here
+    @param log_path: (str) file the full output is streamed to
+    @param written: (dict) files in cwd written by cells[:start], see cwd_files
+    """
+    try:
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        os.setpgid(0, 0)
+        os.chdir(cwd)
+        send_frame(sock, ("pid", os.getpid()))
+        # files the cells write (figures, submission files) are part of the state a checkpoint stands for
+        written = dict() if written is None else dict(written)
+        files_before = cwd_files(cwd)
+        own_files = {os.path.basename(_p) for _p in (profile_path, log_path) if _p is not None and os.path.dirname(os.path.abspath(_p)) == os.path.abspath(cwd)}
+        output_capture = BoundedCapture(max_len, log_path)
+        output_capture.write(output)
+        sys.stdout = output_capture
+        # measures and limits this run only, cells resumed from a checkpoint are not counted again
+        meter = ResourceMeter().start()
+        profiler = SamplingProfiler(profile_path).start() if profile_path is not None else None
+        for i in range(start, len(cells)):
+            source, first_line, _ = cells[i]
+            cell_start = time.monotonic()
+            try:
+                # pad so that tracebacks report the line numbers of the full code
+                exec(compile("\n" * (first_line - 1) + source, "<string>", "exec"), namespace)
+            except BaseException as e:
+                output_capture.write(f"[CODE EXECUTION ERROR]: {str(e)}\n")
+                traceback.print_exc(file=output_capture)
+                break
+            elapsed = time.monotonic() - cell_start
+            seconds += elapsed
+            if CHECKPOINT_MAX > 0 and i + 1 < len(cells) and elapsed >= CHECKPOINT_MIN_SECONDS and not cuda_initialized():
+                written.update({_name: _stat for _name, _stat in cwd_files(cwd).items() if files_before.get(_name) != _stat and _name not in own_files})
+                # no thread may run across the fork
+                if profiler is not None:
+                    profiler.stop()
+                _fork_checkpoint(sock, namespace, keys[i + 1], output_capture.getvalue()[:CHECKPOINT_OUTPUT_CAP], seconds, checkpoint_dir, root_pid, written)
+                if profiler is not None:
+                    profiler.start()
+        if profiler is not None:
+            profiler.stop()
+        meter.stop()
+        sys.stdout = sys.__stdout__
+        output_capture.close_log()
+        send_frame(sock, ("output", output_capture.getvalue(), meter.summary()))
+    finally:
+        os._exit(0)
+
+
+def _fork_checkpoint(sock, namespace, key, output, seconds, checkpoint_dir, root_pid, written):
+    path = os.path.join(checkpoint_dir, f"{key[:24]}.sock")
+    if os.path.exists(path):
+        os.unlink(path)
+    # bound before the fork, so the announced checkpoint accepts connections right away
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(8)
+    pid = fork()
+    if pid == 0:
+        sys.stdout = sys.__stdout__
+        sock.close()
+        _serve_checkpoint(listener, namespace, output, seconds, checkpoint_dir, root_pid, written)
+    try:
+        # also set here, the runner's process group is killed when it finishes
+        os.setpgid(pid, pid)
+    except OSError:
+        pass
+    listener.close()
+    send_frame(sock, ("checkpoint", key, pid, path, seconds, written))
+
+
+def _serve_checkpoint(listener, namespace, output, seconds, checkpoint_dir, root_pid, written):
+    """
+    Checkpoint process: hold the interpreter state and fork a runner from it for every connection. Never returns.
+    """
+    try:
+        os.setpgid(0, 0)
+        # runners are not waited for, their results go straight to the snapshot process
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        listener.settimeout(CHECKPOINT_WATCHDOG_INTERVAL)
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except socket.timeout:
+                try:
+                    os.kill(root_pid, 0)
+                    continue
+                except OSError:
+                    # the snapshot process is gone, nobody will use this checkpoint again
+                    break
+            conn.settimeout(None)
+            task = recv_frame(conn)
+            if task is not None and fork() == 0:
+                listener.close()
+                cells, keys, start, cwd, max_len, profile_path, log_path = task
+                run_cells(conn, namespace, cells, keys, start, output, seconds, cwd, max_len, checkpoint_dir, root_pid, profile_path, log_path, written)
+            conn.close()
+    finally:
+        os._exit(0)
@@ -1,31 +1,341 @@
-import time, tiktoken
-from openai import OpenAI
+import time
+import asyncio, threading
+from openai import OpenAI, AsyncOpenAI
 import openai
-import os, anthropic, json
+import os, re, anthropic, json
+from response_cache import ResponseCache, CACHE_POLICIES
+from retry_scheduler import provider_admission, configure_rate_limits, classify_error, retry_delay
+import hedging
+import offline_llm
+from hedging import configure_hedging
+from offline_llm import OFFLINE_MODELS, configure_offline_llm
+from prompt_assembly import SystemPrompt, assemble_prompt, anthropic_system_blocks
+from token_accounting import TOKEN_ACCOUNTING, accounting_scope, set_accounting_phase, current_scope, count_text_tokens, usage_from_response
 
-TOKENS_IN = dict()
-TOKENS_OUT = dict()
+MODEL_ALIASES = {
+    "gpt4omini": "gpt-4o-mini",
+    "gpt-4omini": "gpt-4o-mini",
+    "gpt4o-mini": "gpt-4o-mini",
+    "gpt4o": "gpt-4o",
+}
 
-encoding = tiktoken.get_encoding("cl100k_base")
+RESPONSE_CACHE = ResponseCache(policy="off")
+
+
+def configure_response_cache(policy="deterministic", path="state_saves/llm_cache.sqlite", max_bytes=512 * 1024 * 1024, max_age=30 * 24 * 3600):
+    """
+    Replace the process-wide response cache used by query_model
+    @param policy: (str) "off", "deterministic" (temp 0 or None only) or "all"
+    @return: (ResponseCache) the new cache
+    """
+    global RESPONSE_CACHE
+    RESPONSE_CACHE.close()
+    RESPONSE_CACHE = ResponseCache(path=path, policy=policy, max_bytes=max_bytes, max_age=max_age)
+    return RESPONSE_CACHE
 
 def curr_cost_est():
-    costmap_in = {
-        "gpt-4o": 2.50 / 1000000,
-        "gpt-4o-mini": 0.150 / 1000000,
-        "o1-preview": 15.00 / 1000000,
-        "o1-mini": 3.00 / 1000000,
-        "claude-3-5-sonnet": 3.00 / 1000000,
-    }
-    costmap_out = {
-        "gpt-4o": 10.00/ 1000000,
-        "gpt-4o-mini": 0.6 / 1000000,
-        "o1-preview": 60.00 / 1000000,
-        "o1-mini": 12.00 / 1000000,
-        "claude-3-5-sonnet": 12.00 / 1000000,
-    }
-    return sum([costmap_in[_]*TOKENS_IN[_] for _ in TOKENS_IN]) + sum([costmap_out[_]*TOKENS_OUT[_] for _ in TOKENS_OUT])
-
-def query_model(model_str, prompt, system_prompt, openai_api_key=None, anthropic_api_key=None, tries=5, timeout=5.0, temp=None, print_cost=True, version="1.5"):
+    return TOKEN_ACCOUNTING.cost()
+
+
+MODEL_ENDPOINTS = {
+    # model_str: (provider, provider model name, accepts system prompt and temperature)
+    "gpt-4o-mini": ("openai", "gpt-4o-mini-2024-07-18", True),
+    "gpt-4o": ("openai", "gpt-4o-2024-08-06", True),
+    "o1-mini": ("openai", "o1-mini-2024-09-12", False),
+    "o1-preview": ("openai", "o1-preview", False),
+    "claude-3.5-sonnet": ("anthropic", "claude-3-5-sonnet-latest", True),
+    # in-process stand-in, see offline_llm.py
+    "offline": ("offline", "offline", True),
+}
+
+ANTHROPIC_MAX_TOKENS = 8192
+MAX_INFLIGHT_REQUESTS = 8
+
+_loop = None
+_loop_lock = threading.Lock()
+_clients = dict()
+_inflight = None
+
+
+def _event_loop():
+    """
+    Background event loop that owns the pooled provider clients
+    @return: (asyncio.AbstractEventLoop) running loop
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="inference-loop", daemon=True).start()
+    return _loop
+
+
+def run_coroutine(coro):
+    """
+    Run a coroutine on the inference loop and block until it finishes
+    @param coro: (coroutine) coroutine to run
+    @return: coroutine result
+    """
+    loop = _event_loop()
+    if threading.current_thread().name == "inference-loop":
+        raise Exception("Blocking inference call made from inside the inference loop, use aquery_model instead")
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+
+def submit_coroutine(coro):
+    """
+    Schedule a coroutine on the inference loop without waiting for it
+    @param coro: (coroutine) coroutine to run
+    @return: (concurrent.futures.Future) future of the coroutine result
+    """
+    return asyncio.run_coroutine_threadsafe(coro, _event_loop())
+
+
+def set_max_inflight(max_inflight):
+    """
+    Set the maximum number of concurrent provider requests
+    @param max_inflight: (int) in-flight limit
+    @return: None
+    """
+    global MAX_INFLIGHT_REQUESTS, _inflight
+    MAX_INFLIGHT_REQUESTS = max_inflight
+    _inflight = None
+
+
+def _client(provider, api_key):
+    """
+    Long-lived, connection-pooled async client per provider and key (only called on the inference loop)
+    """
+    if (provider, api_key) not in _clients:
+        if provider == "openai":
+            _clients[(provider, api_key)] = AsyncOpenAI(api_key=api_key, max_retries=0)
+        else:
+            _clients[(provider, api_key)] = anthropic.AsyncAnthropic(api_key=api_key, max_retries=0)
+    return _clients[(provider, api_key)]
+
+
+def provider_client(provider):
+    """
+    Pooled async client for a provider, using the key set by query_model (only called on the inference loop)
+    @param provider: (str) "openai" or "anthropic"
+    @return: async provider client
+    """
+    return _client(provider, os.environ["OPENAI_API_KEY" if provider == "openai" else "ANTHROPIC_API_KEY"])
+
+
+def openai_chat_request(model_str, prompt, system_prompt, temp=None, max_tokens=None, stop=None):
+    """
+    Chat completion arguments for an OpenAI model
+    @param model_str: (str) canonical model name
+    @return: (dict) keyword arguments for chat.completions.create
+    """
+    provider, provider_model, has_system = MODEL_ENDPOINTS[model_str]
+    if has_system:
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": prompt}]
+    else:
+        messages = [{"role": "user", "content": system_prompt + prompt}]
+    # openai caches prompt prefixes automatically, static segments of a SystemPrompt come first
+    kwargs = dict(model=provider_model, messages=messages)
+    if has_system and temp is not None: kwargs["temperature"] = temp
+    # o1 models do not accept stop sequences and count reasoning tokens in max_completion_tokens
+    if has_system and stop is not None: kwargs["stop"] = stop
+    if max_tokens is not None:
+        kwargs["max_tokens" if has_system else "max_completion_tokens"] = max_tokens
+    return kwargs
+
+
+class FencedBlockStop:
+    def __init__(self, *words) -> None:
+        """
+        Stop condition that ends a completion once the first fenced command block is closed
+        @param words: (str) accepted block types, e.g. "EDIT", "REPLACE"
+        """
+        self.words = words
+        self.pattern = re.compile(r"```(?:" + "|".join(re.escape(_w) for _w in words) + r")\b.*?```", re.DOTALL)
+
+    def __call__(self, text):
+        """
+        @param text: (str) completion text so far
+        @return: (int) length of text to keep, or None if the block is not complete yet
+        """
+        match = self.pattern.search(text)
+        return match.end() if match is not None else None
+
+    def __repr__(self):
+        return f"FencedBlockStop{self.words}"
+
+
+async def _stream_openai(client, stop_on, **kwargs):
+    stream = await client.chat.completions.create(stream=True, stream_options={"include_usage": True}, **kwargs)
+    answer, usage = str(), None
+    try:
+        async for chunk in stream:
+            if chunk.usage is not None:
+                usage = usage_from_response(chunk)
+            if len(chunk.choices) == 0 or not chunk.choices[0].delta.content:
+                continue
+            answer += chunk.choices[0].delta.content
+            if "`" in chunk.choices[0].delta.content and stop_on(answer) is not None:
+                # usage is only sent at the end of the stream, it is counted locally instead
+                return answer, None
+    finally:
+        await stream.close()
+    return answer, usage
+
+
+async def _stream_anthropic(client, stop_on, **kwargs):
+    stream = await client.messages.create(stream=True, **kwargs)
+    answer, usage, tokens_out = str(), None, None
+    try:
+        async for event in stream:
+            if event.type == "message_start":
+                usage = usage_from_response(event.message)
+            elif event.type == "message_delta":
+                tokens_out = event.usage.output_tokens
+            elif event.type == "content_block_delta" and event.delta.type == "text_delta":
+                answer += event.delta.text
+                if "`" in event.delta.text and stop_on(answer) is not None:
+                    return answer, None
+    finally:
+        await stream.close()
+    if usage is None or tokens_out is None:
+        return answer, None
+    return answer, (usage[0], tokens_out, usage[2])
+
+
+async def _completion(model_str, prompt, system_prompt, temp, version, max_tokens=None, stop=None, stop_on=None):
+    provider, provider_model, has_system = MODEL_ENDPOINTS[model_str]
+    if provider == "offline":
+        return await offline_llm.OFFLINE_LLM.acomplete(system_prompt, prompt, stop_on=stop_on)
+    if provider == "anthropic":
+        client = _client("anthropic", os.environ["ANTHROPIC_API_KEY"])
+        kwargs = dict()
+        if temp is not None: kwargs["temperature"] = temp
+        if stop is not None: kwargs["stop_sequences"] = stop
+        kwargs.update(dict(
+            model=provider_model,
+            # static system prompt prefix is marked for provider-side caching
+            system=anthropic_system_blocks(system_prompt),
+            extra_headers={"anthropic-beta": "prompt-caching-2024-07-31"},
+            max_tokens=max_tokens if max_tokens is not None else ANTHROPIC_MAX_TOKENS,
+            messages=[{"role": "user", "content": prompt}]))
+        if stop_on is not None:
+            return await _stream_anthropic(client, stop_on, **kwargs)
+        message = await client.messages.create(**kwargs)
+        return json.loads(message.to_json())["content"][0]["text"], usage_from_response(message)
+    kwargs = openai_chat_request(model_str, prompt, system_prompt, temp, max_tokens, stop)
+    if version == "0.28":
+        # legacy client has no async api
+        kwargs["model"] = f"{model_str}"
+        completion = await asyncio.to_thread(openai.ChatCompletion.create, **kwargs)
+    else:
+        client = _client("openai", os.environ["OPENAI_API_KEY"])
+        if stop_on is not None:
+            return await _stream_openai(client, stop_on, **kwargs)
+        completion = await client.chat.completions.create(**kwargs)
+    return completion.choices[0].message.content, usage_from_response(completion)
+
+
+async def _query_with_retries(model_str, prompt, system_prompt, tries, timeout, temp, print_cost, version, max_tokens, stop, stop_on, scope):
+    global _inflight
+    if _inflight is None:
+        _inflight = asyncio.Semaphore(MAX_INFLIGHT_REQUESTS)
+    # retries and admission are scheduled per provider, timeout is the backoff scale
+    admission = provider_admission(MODEL_ENDPOINTS[model_str][0])
+    est_tokens = (len(system_prompt) + len(prompt)) // 4
+    for _attempt in range(tries):
+        sent = False
+        try:
+            await admission.acquire(est_tokens)
+            async with _inflight:
+                sent = True
+                answer, usage = await _completion(model_str, prompt, system_prompt, temp, version, max_tokens, stop, stop_on)
+            admission.record_success()
+
+            if usage is None:
+                usage = count_text_tokens(system_prompt + prompt, model_str), count_text_tokens(answer, model_str), 0
+            if stop_on is not None and stop_on(answer) is not None:
+                # drop anything after the command block, e.g. when the response was not streamed
+                answer = answer[:stop_on(answer)]
+            admission.settle(est_tokens, usage[0] + usage[1])
+            TOKEN_ACCOUNTING.record(model_str, usage[0], usage[1], usage[2], phase=scope[0], agent=scope[1])
+            if print_cost:
+                print(f"Current experiment cost = ${curr_cost_est()}, ** Approximate values, may not reflect true cost")
+                if usage[2] > 0: print(f"Prompt cache: {usage[2]} of {usage[0]} prompt tokens were cached by the provider")
+            return answer
+        except asyncio.CancelledError:
+            admission.record_cancel()
+            if sent:
+                # the provider bills the prompt of a request cancelled in flight, e.g. a lost hedge
+                TOKEN_ACCOUNTING.record(model_str, est_tokens, 0, phase=scope[0], agent=scope[1])
+            raise
+        except Exception as e:
+            kind = classify_error(e)
+            print(f"Inference Exception ({kind}):", e)
+            admission.record_failure(kind)
+            if kind == "fatal":
+                raise
+            delay = retry_delay(e, kind, _attempt, base=timeout)
+            if kind == "rate_limit":
+                admission.pause(delay)
+            if _attempt < tries - 1:
+                await asyncio.sleep(delay)
+    raise Exception("Max retries: timeout")
+
+
+async def _timed_query(model_str, *args):
+    start = time.monotonic()
+    answer = await _query_with_retries(model_str, *args)
+    hedging.HEDGE_POLICY.latency.observe(model_str, time.monotonic() - start)
+    return answer
+
+
+async def _hedged_query(model_str, *args):
+    """
+    Send a duplicate request once the call is slower than the hedging percentile, first valid answer wins
+    @return: (tuple) answer and the model that produced it
+    """
+    policy = hedging.HEDGE_POLICY
+    primary = asyncio.ensure_future(_timed_query(model_str, *args))
+    pending = {primary}
+    try:
+        delay = policy.hedge_after(model_str)
+        if delay is not None:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if len(done) > 0:
+                return primary.result(), model_str
+            hedge_model = MODEL_ALIASES.get(policy.hedge_model(model_str), policy.hedge_model(model_str))
+            hedge = asyncio.ensure_future(_timed_query(hedge_model, *args))
+            pending.add(hedge)
+            print(f"Hedging {model_str} call after {delay:.1f}s with {hedge_model}")
+            error = None
+            while len(pending) > 0:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        policy.record_race(hedge_won=task is hedge)
+                        return task.result(), hedge_model if task is hedge else model_str
+                    error = task.exception()
+            raise error
+        return await primary, model_str
+    finally:
+        # cancel the loser, or both calls if the caller was cancelled
+        for task in pending:
+            task.cancel()
+
+
+async def _aquery_model(model_str, prompt, system_prompt, openai_api_key, anthropic_api_key, tries, timeout, temp, print_cost, version, use_cache, max_tokens=None, stop=None, stop_on=None, scope=(None, None)):
+    model_str = MODEL_ALIASES.get(model_str, model_str)
+    cache_key = None
+    if use_cache and RESPONSE_CACHE.should_cache(temp):
+        cache_key = RESPONSE_CACHE.make_key(model_str, system_prompt, prompt, temp, version=version, max_tokens=max_tokens, stop=stop, stop_on=None if stop_on is None else repr(stop_on))
+        answer = RESPONSE_CACHE.get(cache_key)
+        if answer is not None:
+            return answer
+    if model_str not in MODEL_ENDPOINTS:
+        raise Exception(f"Unknown model in query_model function: {model_str}")
     preloaded_api = os.getenv('OPENAI_API_KEY')
     if openai_api_key is None and preloaded_api is not None:
         openai_api_key = preloaded_api
@@ -36,111 +346,35 @@ def query_model(model_str, prompt, system_prompt, openai_api_key=None, anthropic
         os.environ["OPENAI_API_KEY"] = openai_api_key
     if anthropic_api_key is not None:
         os.environ["ANTHROPIC_API_KEY"] = anthropic_api_key
-    for _ in range(tries):
-        try:
-            if model_str == "gpt-4o-mini" or model_str == "gpt4omini" or model_str == "gpt-4omini" or model_str == "gpt4o-mini":
-                model_str = "gpt-4o-mini"
-                messages = [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": prompt}]
-                if version == "0.28":
-                    if temp is None:
-                        completion = openai.ChatCompletion.create(
-                            model=f"{model_str}",  # engine = "deployment_name".
-                            messages=messages
-                        )
-                    else:
-                        completion = openai.ChatCompletion.create(
-                            model=f"{model_str}",  # engine = "deployment_name".
-                            messages=messages, temperature=temp
-                        )
-                else:
-                    client = OpenAI()
-                    if temp is None:
-                        completion = client.chat.completions.create(
-                            model="gpt-4o-mini-2024-07-18", messages=messages, )
-                    else:
-                        completion = client.chat.completions.create(
-                            model="gpt-4o-mini-2024-07-18", messages=messages, temperature=temp)
-                answer = completion.choices[0].message.content
-            elif model_str == "claude-3.5-sonnet":
-                client = anthropic.Anthropic(api_key=os.environ["ANTHROPIC_API_KEY"])
-                message = client.messages.create(
-                    model="claude-3-5-sonnet-latest",
-                    system=system_prompt,
-                    messages=[{"role": "user", "content": prompt}])
-                answer = json.loads(message.to_json())["content"][0]["text"]
-            elif model_str == "gpt4o" or model_str == "gpt-4o":
-                model_str = "gpt-4o"
-                messages = [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": prompt}]
-                if version == "0.28":
-                    if temp is None:
-                        completion = openai.ChatCompletion.create(
-                            model=f"{model_str}",  # engine = "deployment_name".
-                            messages=messages
-                        )
-                    else:
-                        completion = openai.ChatCompletion.create(
-                            model=f"{model_str}",  # engine = "deployment_name".
-                            messages=messages, temperature=temp
-                        )
-
-                else:
-                    client = OpenAI()
-                    if temp is None:
-                        completion = client.chat.completions.create(
-                            model="gpt-4o-2024-08-06", messages=messages, )
-                    else:
-                        completion = client.chat.completions.create(
-                            model="gpt-4o-2024-08-06", messages=messages, temperature=temp)
-                answer = completion.choices[0].message.content
-            elif model_str == "o1-mini":
-                model_str = "o1-mini"
-                messages = [
-                    {"role": "user", "content": system_prompt + prompt}]
-                if version == "0.28":
-                    completion = openai.ChatCompletion.create(
-                        model=f"{model_str}",  # engine = "deployment_name".
-                        messages=messages
-                    )
-                else:
-                    client = OpenAI()
-                    completion = client.chat.completions.create(
-                        model="o1-mini-2024-09-12", messages=messages)
-                answer = completion.choices[0].message.content
-            elif model_str == "o1-preview":
-                model_str = "o1-preview"
-                messages = [
-                    {"role": "user", "content": system_prompt + prompt}]
-                if version == "0.28":
-                    completion = openai.ChatCompletion.create(
-                        model=f"{model_str}",  # engine = "deployment_name".
-                        messages=messages
-                    )
-                else:
-                    client = OpenAI()
-                    completion = client.chat.completions.create(
-                        model="o1-preview", messages=messages)
-                answer = completion.choices[0].message.content
-
-            if model_str in ["o1-preview", "o1-mini", "claude-3.5-sonnet"]:
-                encoding = tiktoken.encoding_for_model("gpt-4o")
-            else: encoding = tiktoken.encoding_for_model(model_str)
-            if model_str not in TOKENS_IN:
-                TOKENS_IN[model_str] = 0
-                TOKENS_OUT[model_str] = 0
-            TOKENS_IN[model_str] += len(encoding.encode(system_prompt + prompt))
-            TOKENS_OUT[model_str] += len(encoding.encode(answer))
-            if print_cost:
-                print(f"Current experiment cost = ${curr_cost_est()}, ** Approximate values, may not reflect true cost")
-            return answer
-        except Exception as e:
-            print("Inference Exception:", e)
-            time.sleep(timeout)
-            continue
-    raise Exception("Max retries: timeout")
+    args = (prompt, system_prompt, tries, timeout, temp, print_cost, version, max_tokens, stop, stop_on, scope)
+    if hedging.HEDGE_POLICY.enabled:
+        answer, answer_model = await _hedged_query(model_str, *args)
+    else:
+        answer, answer_model = await _query_with_retries(model_str, *args), model_str
+    # an answer from a fallback model is not stored under this model's key
+    if cache_key is not None and answer_model == model_str:
+        RESPONSE_CACHE.put(cache_key, model_str, answer)
+    return answer
+
+
+async def aquery_model(model_str, prompt, system_prompt, openai_api_key=None, anthropic_api_key=None, tries=5, timeout=5.0, temp=None, print_cost=True, version="1.5", use_cache=True, max_tokens=None, stop=None, stop_on=None):
+    """
+    Coroutine version of query_model, can be awaited from any event loop
+    @param max_tokens: (int) optional completion token limit
+    @param stop: (list) optional provider stop sequences
+    @param stop_on: (callable) optional stop condition, e.g. FencedBlockStop("EDIT"), which streams the completion and closes it early
+    @return: (str) model response
+    """
+    loop = _event_loop()
+    coro = _aquery_model(model_str, prompt, system_prompt, openai_api_key, anthropic_api_key, tries, timeout, temp, print_cost, version, use_cache, max_tokens, stop, stop_on, current_scope())
+    if asyncio.get_running_loop() is loop:
+        return await coro
+    # provider clients are bound to the inference loop
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, loop))
+
+
+def query_model(model_str, prompt, system_prompt, openai_api_key=None, anthropic_api_key=None, tries=5, timeout=5.0, temp=None, print_cost=True, version="1.5", use_cache=True, max_tokens=None, stop=None, stop_on=None):
+    return run_coroutine(_aquery_model(model_str, prompt, system_prompt, openai_api_key, anthropic_api_key, tries, timeout, temp, print_cost, version, use_cache, max_tokens, stop, stop_on, current_scope()))
 
 
 #print(query_model(model_str="o1-mini", prompt="hi", system_prompt="hey"))
\ No newline at end of file
@@ -7,21 +7,79 @@ from abc import abstractmethod
 
 from tools import *
 from inference import *
+import score_cascade
 from pathlib import Path
 
 
 from contextlib import contextmanager
 import sys, os
+import io
+import ast
+import time
+import hashlib
+import queue
+import shutil
+import tempfile
+import threading
+import contextvars
+import concurrent.futures
+
+
+class _ThreadStdout(io.TextIOBase):
+    def __init__(self, target) -> None:
+        """
+        sys.stdout replacement that drops what suppressed threads print and passes everything else through,
+        so a candidate being processed in one thread does not silence the main thread or the other candidates
+        @param target: (io.TextIOBase) stream the output of the other threads goes to
+        """
+        self.target = target
+        self.local = threading.local()
+
+    def suppressed(self):
+        return getattr(self.local, "depth", 0) > 0
+
+    def writable(self):
+        return True
+
+    def write(self, s):
+        if self.suppressed():
+            return len(s)
+        return self.target.write(s)
+
+    def flush(self):
+        self.target.flush()
+
+    def __getattr__(self, name):
+        # encoding, fileno, isatty... of the real stream
+        return getattr(self.target, name)
+
+
+_suppress_lock = threading.Lock()
+_suppress_users = 0
+
 
 @contextmanager
 def suppress_stdout():
-    with open(os.devnull, "w") as devnull:
-        old_stdout = sys.stdout
-        sys.stdout = devnull
-        try:
-            yield
-        finally:
-            sys.stdout = old_stdout
+    """
+    Silence what the calling thread prints, other threads keep printing. Generated code runs in separate
+    processes whose output is captured there, this only covers the solver's own per-candidate messages.
+    """
+    global _suppress_users
+    with _suppress_lock:
+        if not isinstance(sys.stdout, _ThreadStdout):
+            sys.stdout = _ThreadStdout(sys.stdout)
+        stream = sys.stdout
+        _suppress_users += 1
+    stream.local.depth = getattr(stream.local, "depth", 0) + 1
+    try:
+        yield
+    finally:
+        stream.local.depth -= 1
+        with _suppress_lock:
+            _suppress_users -= 1
+            # restored once no thread needs it, unless something else replaced sys.stdout meanwhile
+            if _suppress_users == 0 and sys.stdout is stream:
+                sys.stdout = stream.target
 
 
 os.environ["JOBLIB_VERBOSITY"] = "0"
@@ -33,11 +91,92 @@ logging.getLogger('sklearn.model_selection').setLevel(logging.WARNING)
 
 
 GLOBAL_REPAIR_ATTEMPTS = 2
+# proposals waiting for an executor, the LLM runs at most this far ahead of code execution
+PIPELINE_DEPTH = 2
+
+
+class CandidateMemo:
+    def __init__(self) -> None:
+        """
+        Execution outputs and scores of candidate code, keyed by the canonical syntax tree of the code and the
+        dataset code, so candidates that only differ in whitespace or comments are not executed or scored again.
+        Concurrent requests for the same key wait for the first one.
+        """
+        self._lock = threading.Lock()
+        self._entries = dict()
+        self.stats = {"exec_hits": 0, "exec_misses": 0, "score_hits": 0, "score_misses": 0}
+
+    @staticmethod
+    def key(code, dataset_code):
+        try:
+            canonical = ast.dump(ast.parse(code))
+        except SyntaxError:
+            canonical = code
+        dataset_hash = hashlib.sha256(dataset_code.encode("utf-8")).hexdigest()
+        return hashlib.sha256(f"{dataset_hash}\n{canonical}".encode("utf-8")).hexdigest()
+
+    def get_or_compute(self, kind, key, compute, cacheable=lambda result: True):
+        """
+        @param kind: (str) "exec" or "score"
+        @param key: (str) output of CandidateMemo.key
+        @param compute: (callable) produces the result on a miss
+        @param cacheable: (callable) result -> whether it may be reused (e.g. not a timeout)
+        @return: result of compute, possibly from an earlier call
+        """
+        with self._lock:
+            future = self._entries.get((kind, key))
+            owner = future is None
+            if owner:
+                future = concurrent.futures.Future()
+                self._entries[(kind, key)] = future
+            self.stats[f"{kind}_{'misses' if owner else 'hits'}"] += 1
+        if not owner:
+            return future.result()
+        try:
+            result = compute()
+        except BaseException as e:
+            with self._lock:
+                del self._entries[(kind, key)]
+            future.set_exception(e)
+            raise
+        if not cacheable(result):
+            with self._lock:
+                del self._entries[(kind, key)]
+        future.set_result(result)
+        return result
+
+    def summary(self):
+        """
+        @return: (dict) hits and misses with hit rates
+        """
+        with self._lock:
+            stats = dict(self.stats)
+        for kind in ["exec", "score"]:
+            total = stats[f"{kind}_hits"] + stats[f"{kind}_misses"]
+            stats[f"{kind}_hit_rate"] = stats[f"{kind}_hits"] / total if total > 0 else 0.0
+        return stats
 
 
 class Command:
-    def __init__(self):
+    def __init__(self, memo=None):
         self.cmd_type = "OTHER"
+        self.memo = memo
+
+    def run_code(self, code, dataset_code, cwd=None):
+        """
+        Execute candidate code after the dataset code, through the memo if the command has one
+        @return: (str) code return
+        """
+        # doomed code (syntax errors, undefined names, missing modules) is rejected without running it
+        preflight_error = preflight_check(code, setup_code=dataset_code)
+        if preflight_error is not None:
+            return preflight_error
+        if self.memo is None:
+            return execute_code(code, setup_code=dataset_code, cwd=cwd)
+        # timeouts and crashes depend on the machine load, they are not reused
+        return self.memo.get_or_compute(
+            "exec", CandidateMemo.key(code, dataset_code), lambda: execute_code(code, setup_code=dataset_code, cwd=cwd),
+            cacheable=lambda code_ret: "exceeded the timeout limit" not in code_ret and "process crashed" not in code_ret)
 
     @abstractmethod
     def docstring(self) -> str:
@@ -63,8 +202,8 @@ class Command:
 """
 
 class Replace(Command):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, memo=None):
+        super().__init__(memo)
         self.cmd_type = "CODE-replace"
 
     def docstring(self) -> str:
@@ -84,18 +223,17 @@ class Replace(Command):
         if "```REPLACE" in cmd_str: return True
         return False
 
-    def parse_command(self, *args) -> tuple:
+    def parse_command(self, *args, cwd=None) -> tuple:
         new_code = extract_prompt(args[0], "REPLACE")
-        code_exec = f"{args[1]}\n{new_code}"
-        code_ret = execute_code(code_exec)
+        code_ret = self.run_code(new_code, args[1], cwd=cwd)
         if "[CODE EXECUTION ERROR]" in code_ret: return False, (None, code_ret,)
         return True, (new_code.split("\n"), code_ret)
 
 
 
 class Edit(Command):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, memo=None):
+        super().__init__(memo)
         self.cmd_type = "CODE-edit"
 
     def docstring(self) -> str:
@@ -106,7 +244,7 @@ class Edit(Command):
             "You can edit code using the following command: ```EDIT N M\n<new lines to replace old lines>\n``` EDIT is the word EDIT, N is the first line index you want to replace and M the the last line index you want to replace (everything inbetween will also be removed), and <new lines to replace old lines> will be the new code that is replacing the old code. Before changing the existing code to be your new code, your new code will be tested and if it returns an error it will not replace the existing code. Your changes should significantly change the functionality of the code."
         )
 
-    def execute_command(self, *args) -> str:
+    def execute_command(self, *args, cwd=None) -> str:
         # args[0] -> N (int)
         # args[1] -> M (int)
         # args[2] -> old code
@@ -122,8 +260,7 @@ class Edit(Command):
             for _line in lines_to_add:
                 current_code.insert(args[0], _line)
             new_code = "\n".join(current_code)
-            code_exec = f"{args[4]}\n{new_code}"
-            code_ret = execute_code(code_exec)
+            code_ret = self.run_code(new_code, args[4], cwd=cwd)
             if "CODE EXECUTION ERROR" in code_ret: return (False, None, code_ret)
             return (True, current_code, code_ret)
         except Exception as e:
@@ -148,7 +285,18 @@ class Edit(Command):
             return False, (None, None, None, None, None)
 
 
-def get_score(outlined_plan, code, code_return, REWARD_MODEL_LLM, attempts=3, openai_api_key=None):
+def get_score(outlined_plan, code, code_return, REWARD_MODEL_LLM, attempts=3, openai_api_key=None, best_score=None):
+    """
+    Reward score of research code on a 0-1 scale, through the cheap-first score cascade if it is configured
+    @param best_score: (float) score of the current best code, used to decide whether to escalate
+    @return: (tuple) score, feedback string, whether the score was valid
+    """
+    return score_cascade.SCORE_CASCADE.run(
+        lambda model_str: _get_score(outlined_plan, code, code_return, model_str, attempts, openai_api_key),
+        REWARD_MODEL_LLM, best_score=best_score, score_range=1.0)
+
+
+def _get_score(outlined_plan, code, code_return, REWARD_MODEL_LLM, attempts=3, openai_api_key=None):
     e = str()
     for _attempt in range(attempts):
         try:
@@ -164,7 +312,7 @@ def get_score(outlined_plan, code, code_return, REWARD_MODEL_LLM, attempts=3, op
                 prompt=(
                     f"Outlined in the following text is the research plan that the machine learning engineer was tasked with building: {outlined_plan}\n\n"
                     f"The following text is the research code that the model produced: \n{code}\n\n"
-                    f"The following is the output from the model: {code_return}\n\n"), temp=0.6)
+                    f"The following is the output from the model: {code_return}\n\n"), temp=0.6, stop_on=FencedBlockStop("SCORE"))
             performance = extract_prompt(text=scoring, word="SCORE")
             performance = float(performance)
             return performance, f"The performance of your submission is: {performance}", True
@@ -174,6 +322,9 @@ def get_score(outlined_plan, code, code_return, REWARD_MODEL_LLM, attempts=3, op
 
 
 def code_repair(code, error, ctype, REPAIR_LLM, openai_api_key=None):
+    if "[PROFILE HOTSPOTS]" in error:
+        # a profiled execution, point the repair at the lines that took the time
+        error += "\nThe hotspot table shows where the execution time was spent. If the code is too slow, speed up the lines with the largest cumulative time first (e.g. vectorize loops, reduce data size or epochs) instead of rewriting unrelated code."
     if ctype == "replace":
         repair_sys = (
             "You are an automated code repair tool.\n"
@@ -186,7 +337,7 @@ def code_repair(code, error, ctype, REPAIR_LLM, openai_api_key=None):
             openai_api_key=openai_api_key,
             model_str=f"{REPAIR_LLM}",
             system_prompt=repair_sys,
-            prompt=f"Provided here is the error: {error}\n\nProvided below is the code:\n\n{code}", temp=0.8)
+            prompt=f"Provided here is the error: {error}\n\nProvided below is the code:\n\n{code}", temp=0.8, stop_on=FencedBlockStop("python"))
         return extract_prompt(model_resp, "python")
     elif ctype == "edit":
         repair_sys = (
@@ -206,12 +357,12 @@ def code_repair(code, error, ctype, REPAIR_LLM, openai_api_key=None):
             openai_api_key=openai_api_key,
             model_str=f"{REPAIR_LLM}",
             system_prompt=repair_sys,
-            prompt=f"Provided here is the error: {error}\n\nProvided below is the code:\n\n{code}", temp=0.2)
+            prompt=f"Provided here is the error: {error}\n\nProvided below is the code:\n\n{code}", temp=0.2, stop_on=FencedBlockStop("EDIT"))
         return model_resp
 
 
 class MLESolver:
-    def __init__(self, dataset_code, openai_api_key=None, notes=None, max_steps=10, insights=None, plan=None, llm_str=None):
+    def __init__(self, dataset_code, openai_api_key=None, notes=None, max_steps=10, insights=None, plan=None, llm_str=None, fanout=1):
         if notes is None: self.notes = []
         else: self.notes = notes
         self.dataset_code = dataset_code
@@ -222,6 +373,12 @@ class MLESolver:
         self.max_codes = 2
         self.st_hist_len = 2
         self.min_gen_trials = 2
+        self.fanout = max(1, fanout)
+        self.pipeline_stats = dict()
+        self.memo = CandidateMemo()
+        self._history_lock = threading.Lock()
+        self._reflection = None
+        self._reflect_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
         self.code_lines = str()
         self.st_history = list()
         self.insights = insights
@@ -240,14 +397,14 @@ class MLESolver:
         # @@ Initial CodeGen Commands @@
         # @@@@@@@@@@@@@@@@@@@@@@@@@@@@@@
         self.best_score = None
-        self.commands = [Replace()]
+        self.commands = [Replace(self.memo)]
         self.model = f"{self.llm_str}"
         init_code, init_return, self.best_score = self.gen_initial_code()
         self.best_codes = [(copy(init_code), self.best_score, init_return) for _ in range(1)]
 
         self.code_lines = init_code
         self.model = f"{self.llm_str}"
-        self.commands = [Edit(), Replace()]
+        self.commands = [Edit(self.memo), Replace(self.memo)]
         self.prev_working_code = copy(self.code_lines)
 
     @staticmethod
@@ -273,7 +430,7 @@ class MLESolver:
                 openai_api_key=self.openai_api_key,
                 model_str=self.model,
                 system_prompt=self.system_prompt(),
-                prompt=f"{err_hist}\nYou should now use ```REPLACE to create initial code to solve the challenge. Now please enter the ```REPLACE command below:\n ", temp=1.0)
+                prompt=f"{err_hist}\nYou should now use ```REPLACE to create initial code to solve the challenge. Now please enter the ```REPLACE command below:\n ", temp=1.0, stop_on=FencedBlockStop("REPLACE", "python"))
             model_resp = self.clean_text(model_resp)
             cmd_str, code_lines, prev_code_ret, should_execute_code, score = self.process_command(model_resp)
             print(f"@@@ INIT ATTEMPT: Command Exec // Attempt {num_attempts}: ", str(cmd_str).replace("\n", " | "))
@@ -288,19 +445,11 @@ class MLESolver:
         top_score = None
         self.prev_code_ret = None
         self.should_execute_code = False
-        while True:
-            if len(self.commands) == 2: cmd_app_str = "You must output either the ```EDIT or ```REPLACE command immediately. "
-            else: cmd_app_str = ""
-            model_resp = query_model(
-                openai_api_key=self.openai_api_key,
-                model_str=self.model,
-                system_prompt=self.system_prompt(),
-                prompt=f"The following is your history:{self.history_str()}\n\n{cmd_app_str}Now please enter a command: ", temp=1.0)
-            model_resp = self.clean_text(model_resp)
-            self.code_lines = copy(random.choice(self.best_codes)[0])
-            cmd_str, code_lines, prev_code_ret, should_execute_code, score = self.process_command(model_resp)
-            self.st_history.append([model_resp, prev_code_ret, code_lines, cmd_str])
-            if len(self.st_history) > self.st_hist_len: self.st_history.pop(0)
+        for base_code, model_resp, (cmd_str, code_lines, prev_code_ret, should_execute_code, score) in self.run_pipeline():
+            self.code_lines = base_code
+            with self._history_lock:
+                self.st_history.append([model_resp, prev_code_ret, code_lines, cmd_str])
+                if len(self.st_history) > self.st_hist_len: self.st_history.pop(0)
             if score is not None:
                 if top_score is None:
                     best_pkg = copy(code_lines), copy(prev_code_ret), copy(should_execute_code), copy(model_resp), copy(cmd_str)
@@ -310,7 +459,6 @@ class MLESolver:
                     top_score = score
             print(f"@@@ Command Exec // Attempt {num_attempts}: ", str(cmd_str).replace("\n", " | "))
             print(f"$$$ Score: {score}")
-            if num_attempts >= self.min_gen_trials and top_score is not None: break
             num_attempts += 1
         self.code_lines, self.prev_code_ret, self.should_execute_code, model_resp, cmd_str = best_pkg
         # add top scoring code that was successful to the best codes
@@ -318,26 +466,204 @@ class MLESolver:
             # replace the lowest scoring one
             if len(self.best_codes) >= self.max_codes:
                 self.best_codes.pop(-1)
-                self.code_reflect = self.reflect_code()
+                # runs in the background, the first proposal of the next step waits for it
+                self._reflection = self._reflect_executor.submit(contextvars.copy_context().run, self.reflect_code, copy(self.best_codes))
             self.best_codes.append((copy(self.code_lines), copy(top_score), self.prev_code_ret))
             # sort by score, to make sure lowest are removed in future
             self.best_codes.sort(key=lambda x: x[1], reverse=True)
         return model_resp, cmd_str
 
-    def reflect_code(self):
+    def run_pipeline(self):
+        """
+        Producer/consumer pipeline for one solve step: proposal threads query the LLM and feed a bounded queue,
+        execution threads take proposals off the queue and execute and score them, so the next proposal is
+        generated while the current candidate runs. As in the sequential loop, the step ends once more than
+        min_gen_trials candidates ran and one of them has a score; proposals left in the queue are dropped.
+        With several workers each one executes in its own temporary directory, the output files (e.g. figures)
+        of the best scoring candidate are copied back to the current directory when the step ends.
+        A proposal sees the history of the candidates that finished before it was requested.
+        @return: (generator) (base code lines, model response, process_command result) per candidate
+        """
+        workers = self.fanout
+        proposals = queue.Queue(maxsize=PIPELINE_DEPTH)
+        results = queue.Queue()
+        progress = {"claimed": 0, "finished": 0, "scored": False}
+        stats = {"llm_busy": 0.0, "exec_busy": 0.0, "exec_waiting": 0.0, "proposal_blocked": 0.0, "discarded": 0}
+        lock = threading.Lock()
+        done = threading.Event()
+
+        def enough(count):
+            return count > self.min_gen_trials and progress["scored"]
+
+        def add_stat(key, seconds):
+            with lock:
+                stats[key] += seconds
+
+        def propose():
+            while not done.is_set():
+                with lock:
+                    if enough(progress["claimed"]): break
+                    progress["claimed"] += 1
+                start = time.monotonic()
+                self.await_reflection()
+                if len(self.commands) == 2: cmd_app_str = "You must output either the ```EDIT or ```REPLACE command immediately. "
+                else: cmd_app_str = ""
+                with self._history_lock:
+                    prompt = f"The following is your history:{self.history_str()}\n\n{cmd_app_str}Now please enter a command: "
+                model_resp = query_model(
+                    openai_api_key=self.openai_api_key,
+                    model_str=self.model,
+                    system_prompt=self.system_prompt(),
+                    # concurrent proposals can share the prompt, a cached answer would make them identical
+                    prompt=prompt, temp=1.0, use_cache=workers == 1, stop_on=FencedBlockStop("EDIT", "REPLACE", "python"))
+                model_resp = self.clean_text(model_resp)
+                add_stat("llm_busy", time.monotonic() - start)
+                start = time.monotonic()
+                while not done.is_set():
+                    try:
+                        # blocks while the executors are busy, i.e. backpressure on the LLM calls
+                        proposals.put(model_resp, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                else:
+                    add_stat("discarded", 1)
+                add_stat("proposal_blocked", time.monotonic() - start)
+
+        def execute(cwd):
+            while True:
+                start = time.monotonic()
+                model_resp = proposals.get()
+                add_stat("exec_waiting", time.monotonic() - start)
+                if model_resp is None: break
+                with lock:
+                    if done.is_set() or enough(progress["finished"]):
+                        # already paid for, reported in the occupancy line
+                        stats["discarded"] += 1
+                        continue
+                start = time.monotonic()
+                # as in the research cwd, figures of an earlier candidate must not be taken for this one's
+                if cwd is not None: remove_figures(cwd)
+                try:
+                    base_code = copy(random.choice(self.best_codes)[0])
+                    result = (base_code, model_resp, self.process_command(model_resp, code_lines=base_code, cwd=cwd))
+                except Exception as e:
+                    result = e
+                with lock:
+                    progress["finished"] += 1
+                    if not isinstance(result, Exception) and result[2][4] is not None: progress["scored"] = True
+                add_stat("exec_busy", time.monotonic() - start)
+                with kept_lock:
+                    # in the order solve sees the results, so the files kept are those of the candidate it keeps
+                    if cwd is not None and not isinstance(result, Exception): keep_outputs(cwd, result[2][4])
+                    results.put(result)
+            results.put(None)
+
+        def keep_outputs(cwd, score):
+            if score is None or (kept["score"] is not None and score <= kept["score"]): return
+            kept["score"] = score
+            shutil.rmtree(kept["dir"], ignore_errors=True)
+            shutil.copytree(cwd, kept["dir"])
+
+        # separate working directories, so that concurrent candidates do not overwrite each other's files (e.g. figures)
+        cwds = [None] if workers == 1 else [tempfile.mkdtemp(prefix=f"mlesolver-candidate-{_i}-") for _i in range(workers)]
+        # files of the best candidate so far, copied back to the research cwd at the end of the step
+        kept = {"score": None, "dir": None if workers == 1 else tempfile.mkdtemp(prefix="mlesolver-kept-")}
+        kept_lock = threading.Lock()
+        producers = [threading.Thread(target=contextvars.copy_context().run, args=(propose,), daemon=True) for _ in range(workers)]
+        consumers = [threading.Thread(target=contextvars.copy_context().run, args=(execute, _cwd), daemon=True) for _cwd in cwds]
+
+        def close_queue():
+            for thread in producers: thread.join()
+            for _ in consumers: proposals.put(None)
+
+        wall = time.monotonic()
+        for thread in producers + consumers: thread.start()
+        threading.Thread(target=close_queue, daemon=True).start()
+        try:
+            running = len(consumers)
+            while running > 0:
+                result = results.get()
+                if result is None:
+                    running -= 1
+                elif isinstance(result, Exception):
+                    raise result
+                else:
+                    yield result
+        finally:
+            done.set()
+            for thread in consumers: thread.join()
+            if kept["score"] is not None:
+                remove_figures()
+                shutil.copytree(kept["dir"], os.getcwd(), dirs_exist_ok=True)
+            for _cwd in cwds + [kept["dir"]]:
+                if _cwd is not None: shutil.rmtree(_cwd, ignore_errors=True)
+            wall = time.monotonic() - wall
+            print(f"Pipeline occupancy: LLM {stats['llm_busy'] / (wall * workers):.0%}, execution {stats['exec_busy'] / (wall * workers):.0%}, "
+                  f"executors waiting {stats['exec_waiting']:.1f}s, proposals blocked {stats['proposal_blocked']:.1f}s, "
+                  f"proposals discarded {stats['discarded']}, wall {wall:.1f}s")
+            for key in stats: self.pipeline_stats[key] = self.pipeline_stats.get(key, 0.0) + stats[key]
+            self.pipeline_stats["wall"] = self.pipeline_stats.get("wall", 0.0) + wall
+
+    def await_reflection(self):
+        """
+        Wait for the reflection started at the end of the previous step, if there is one
+        @return: None
+        """
+        with self._history_lock:
+            reflection = self._reflection
+        if reflection is None: return
+        # waited for outside the lock, other proposals only need the history
+        code_reflect = reflection.result()
+        with self._history_lock:
+            if self._reflection is reflection:
+                self.code_reflect = code_reflect
+                self._reflection = None
+
+    def score_code(self, code_lines, code_return):
+        """
+        Reward score of candidate code, a candidate with the same syntax tree and output is only scored once per model.
+        The score cascade itself is not memoized: whether the cheap score is trusted depends on the current best score
+        @param code_lines: (list) candidate code lines
+        @param code_return: (str) output from running the code
+        @return: (tuple) score, feedback string, whether the score was valid
+        """
+        code = "\n".join(code_lines)
+        # the same code can print something else when it runs again, e.g. after a timeout that is not memoized
+        key = f"{CandidateMemo.key(code, self.dataset_code)}:{hashlib.sha256(code_return.encode('utf-8')).hexdigest()}"
+
+        def score_fn(model_str):
+            return self.memo.get_or_compute(
+                "score", f"{key}:{model_str}", lambda: _get_score(self.plan, code, code_return, model_str, openai_api_key=self.openai_api_key),
+                cacheable=lambda result: result[2])
+        return score_cascade.SCORE_CASCADE.run(score_fn, self.llm_str, best_score=self.current_best_score(), score_range=1.0)
+
+    def current_best_score(self):
+        """
+        @return: (float) score of the best code so far, None before the initial code is scored
+        """
+        if not hasattr(self, "best_codes") or len(self.best_codes) == 0: return None
+        return self.best_codes[0][1]
+
+    def reflect_code(self, best_codes=None):
         """
         Provide a reflection on produced behavior for next execution
+        @param best_codes: (list) codes to reflect on, defaults to self.best_codes
         @return: (str) language model-produced reflection
         """
-        code_strs = ("$"*40 + "\n\n").join([self.generate_code_lines(_code[0]) + f"\nCode Return {_code[1]}" for _code in self.best_codes])
+        if best_codes is None: best_codes = self.best_codes
+        code_strs = ("$"*40 + "\n\n").join([self.generate_code_lines(_code[0]) + f"\nCode Return {_code[1]}" for _code in best_codes])
         code_strs = f"Please reflect on the following sets of code: {code_strs} and come up with generalizable insights that will help you improve your performance on this benchmark."
-        syst = self.system_prompt(commands=False) + code_strs
+        prompt = self.system_prompt(commands=False)
+        syst = assemble_prompt([prompt.static], [prompt.volatile, code_strs])
         return query_model(prompt="Please reflect on ideas for how to improve your current code. Examine the provided code and think very specifically (with precise ideas) on how to improve performance, which methods to use, how to improve generalization on the test set with line-by-line examples below:\n", system_prompt=syst, model_str=f"{self.llm_str}", openai_api_key=self.openai_api_key)
 
-    def process_command(self, model_resp):
+    def process_command(self, model_resp, code_lines=None, cwd=None):
         """
         Take command from language model and execute if valid
         @param model_resp: (str) language model output
+        @param code_lines: (list) code the command applies to, defaults to self.code_lines
+        @param cwd: (str) working directory for executing the code, defaults to the current one
         @return: (tuple) tuple containing the following items
             - cmd_str: (str) code execution return and success flag
             - code_lines: (list) list of code lines as strings
@@ -347,8 +673,9 @@ class MLESolver:
         """
         prev_code_ret = self.prev_code_ret
         should_execute_code = self.should_execute_code
-        code_lines = copy(self.code_lines)
-        remove_figures()
+        base_code = copy(self.code_lines) if code_lines is None else copy(code_lines)
+        code_lines = copy(base_code)
+        if cwd is None: remove_figures()
         with suppress_stdout(): # shhh
             for cmd in self.commands:
                 if cmd.matches_command(model_resp):
@@ -358,13 +685,13 @@ class MLESolver:
                         failed = True
                         code_err = str()
                         for _tries in range(GLOBAL_REPAIR_ATTEMPTS):
-                            success, args = cmd.parse_command(model_resp, copy(self.code_lines), self.dataset_code)
+                            success, args = cmd.parse_command(model_resp, copy(base_code), self.dataset_code)
                             if success:
-                                cmd_return = cmd.execute_command(args)
+                                cmd_return = cmd.execute_command(args, cwd=cwd)
                                 code_err = f"Return from executing code: {cmd_return[2]}"
                                 if cmd_return[0]:  # if success
                                     code_lines = copy(cmd_return[1])
-                                    score, cmd_str, is_valid = get_score(self.plan, "\n".join(code_lines), cmd_return[2], openai_api_key=self.openai_api_key, REWARD_MODEL_LLM=self.llm_str)
+                                    score, cmd_str, is_valid = self.score_code(code_lines, cmd_return[2])
                                     if is_valid:
                                         failed = False
                                         break
@@ -387,11 +714,11 @@ class MLESolver:
                         failed = True
                         code_err = str()
                         for _tries in range(GLOBAL_REPAIR_ATTEMPTS):
-                            success, args = cmd.parse_command(model_resp, self.dataset_code)
+                            success, args = cmd.parse_command(model_resp, self.dataset_code, cwd=cwd)
                             code_err = f"Return from executing code: {args[1]}"
                             if success:
                                 code_lines = copy(args[0])
-                                score, cmd_str, is_valid = get_score(self.plan, "\n".join(code_lines), args[1], openai_api_key=self.openai_api_key, REWARD_MODEL_LLM=self.llm_str)
+                                score, cmd_str, is_valid = self.score_code(code_lines, args[1])
                                 if is_valid:
                                     failed = False
                                     break
@@ -432,17 +759,15 @@ class MLESolver:
         """
         Produce a system prompt for the mle-solver to solve ml problems
         @param commands: (bool) whether to use command prompt
-        @return: (str) system prompt
+        @return: (SystemPrompt) system prompt, static segments first so the provider can cache the prefix
         """
-        return (
+        static_segments = [
             # ROLE DESCRIPTION
             f"{self.role_description()}.\n"
             # TASK INSTRUCTIONS
             f"The following are your task instructions: {self.phase_prompt()}\n"
             # LIT REVIEW INSIGHTS
             f"Provided below are some insights from a literature review summary:\n{self.insights}\n"
-            # CODE INSIGHTS
-            f"{self.code_reflect}"
             # NOTES
             f"The following are notes, instructions, and general tips for you: {self.notes}"
             # PLAN DESCRIPTION
@@ -454,10 +779,13 @@ class MLESolver:
             f"Your method MUST not get 0% accuracy. If it does, you have done something wrong and must correct this. Make sure to check your accuracy calculation is correct.\n"
             # transition
             f"Your goal is to solve the research plan as well as possible. You will receive a score after you write the code and should aim to maximize the score by following the plan instructions and writing high quality code.\n"
-            f"Before each experiment please include a print statement explaining exactly what the results are meant to show in great detail before printing the results out.\n"
+            f"Before each experiment please include a print statement explaining exactly what the results are meant to show in great detail before printing the results out.\n",
             # COMMAND SET
-            f"The following are commands you have access to: {self.command_descriptions()}\n. You should try to have a diversity of command responses if appropriate. Do not repeat the same commend too many times. Please consider looking through your history and not repeating commands too many times." if commands else ""
-        )
+            f"The following are commands you have access to: {self.command_descriptions()}\n. You should try to have a diversity of command responses if appropriate. Do not repeat the same commend too many times. Please consider looking through your history and not repeating commands too many times.\n" if commands else ""]
+        volatile_segments = [
+            # CODE INSIGHTS
+            f"{self.code_reflect}"]
+        return assemble_prompt(static_segments, volatile_segments)
 
     def generate_code_lines(self, code):
         """
@@ -480,7 +808,7 @@ class MLESolver:
             code_str = self.generate_code_lines(self.code_lines)
             if "[CODE EXECUTION ERROR]" in code_return:
                 print(f"@@@@ ERROR")  # , {code_return.replace('\n', '')}")
-                reflect_prompt = f"This is your code: {code_str}\n\nYour code returned the following error {code_return}. Please provide a detailed reflection on why this error was returned, which lines in the code caused this error, and exactly (line by line) how you hope to fix this in the next update. This step is mostly meant to reflect in order to help your future self fix the error better. Do not provide entirely new code but provide suggestions on how to fix the bug using LINE EDITS."
+                reflect_prompt = f"This is your code: {code_str}\n\nYour code returned the following error {code_return}. Please provide a detailed reflection on why this error was returned, which lines in the code caused this error, and exactly (line by line) how you hope to fix this in the next update.{' Use the profile hotspot table to identify the lines that made the code slow.' if '[PROFILE HOTSPOTS]' in code_return else ''} This step is mostly meant to reflect in order to help your future self fix the error better. Do not provide entirely new code but provide suggestions on how to fix the bug using LINE EDITS."
             elif os.path.exists("submission.csv"):
                 self.prev_working_code = copy(self.code_lines)
                 grade_return = get_score(self.plan, "\n".join(self.prev_working_code), code_return, openai_api_key=self.openai_api_key)[0]
@@ -0,0 +1,203 @@
+import re
+import json
+import random
+import asyncio
+import hashlib
+
+
+OFFLINE_MODELS = ["offline"]
+
+
+OFFLINE_DATA_CODE = """import numpy as np
+rng = np.random.RandomState(0)
+X_train = rng.randn(200, 8)
+y_train = (X_train[:, 0] + 0.5 * X_train[:, 1] > 0).astype(int)
+X_test = rng.randn(100, 8)
+y_test = (X_test[:, 0] + 0.5 * X_test[:, 1] > 0).astype(int)
+print("Train shape:", X_train.shape, "Test shape:", X_test.shape)"""
+
+OFFLINE_EXPERIMENT_CODE = """import numpy as np
+print("This experiment fits a least squares linear classifier and reports its test accuracy.")
+w = np.linalg.lstsq(X_train, 2 * y_train - 1, rcond=None)[0]
+accuracy = float(((X_test @ w > 0).astype(int) == y_test).mean())
+print(f"Test accuracy: {accuracy:.4f}")"""
+
+OFFLINE_SCAFFOLD = """\\documentclass{article}
+\\title{Research Report: Offline Stand-In Experiment}
+\\author{Agent Laboratory}
+\\begin{document}
+\\maketitle
+\\begin{abstract}
+[ABSTRACT HERE]
+\\end{abstract}
+\\section{Introduction}
+[INTRODUCTION HERE]
+\\section{Background}
+[BACKGROUND HERE]
+\\section{Related Work}
+[RELATED WORK HERE]
+\\section{Methods}
+[METHODS HERE]
+\\section{Experimental Setup}
+[EXPERIMENTAL SETUP HERE]
+\\section{Results}
+[RESULTS HERE]
+\\section{Discussion}
+[DISCUSSION HERE]
+\\end{document}"""
+
+
+class OfflineLLM:
+    def __init__(self, latency=0.0, token_latency=0.0, jitter=0.0, script=None) -> None:
+        """
+        Deterministic in-process stand-in for a remote LLM, answering with templates that follow
+        the command protocol of each phase so that the whole workflow can run without a provider
+        @param latency: (float) seconds added to every call (time to first token)
+        @param token_latency: (float) seconds added per output token
+        @param jitter: (float) max extra seconds per call, derived from the prompt so runs are reproducible
+        @param script: (list) scripted overrides [{"match": regex, "response": str}], tried in order before the templates
+        """
+        self.latency = latency
+        self.token_latency = token_latency
+        self.jitter = jitter
+        self.script = list() if script is None else script
+
+    @staticmethod
+    def load_script(path):
+        """
+        Load scripted overrides from a json file
+        @param path: (str) path to a json list of {"match": regex, "response": str}
+        @return: (list) scripted overrides
+        """
+        with open(path, "r") as f:
+            return json.load(f)
+
+    @staticmethod
+    def _seed(system_prompt, prompt):
+        return int(hashlib.sha256((system_prompt + "\x00" + prompt).encode("utf-8")).hexdigest()[:8], 16)
+
+    @staticmethod
+    def _step(prompt):
+        step = re.search(r"Current Step #(\d+)", prompt)
+        return int(step.group(1)) if step is not None else 0
+
+    @staticmethod
+    def _topic(prompt):
+        topic = re.search(r"perform research on the following topic: (.*)", prompt)
+        return topic.group(1).strip() if topic is not None else "machine learning"
+
+    def respond(self, system_prompt, prompt):
+        """
+        Produce the response for a prompt, the same inputs always give the same output
+        @param system_prompt: (str) system prompt
+        @param prompt: (str) user prompt
+        @return: (str) response
+        """
+        for entry in self.script:
+            if re.search(entry["match"], system_prompt + "\n" + prompt, re.DOTALL) is not None:
+                return entry["response"]
+        rng = random.Random(self._seed(system_prompt, prompt))
+        step = self._step(prompt)
+
+        # reward models
+        if "expert reward model" in system_prompt:
+            return f"```SCORE\n{rng.uniform(0.3, 0.9):.3f}\n```"
+        if "reviewing a paper" in system_prompt:
+            review = {
+                "Summary": "The paper presents an offline stand-in experiment.",
+                "Strengths": ["Reproducible setup."],
+                "Weaknesses": ["Synthetic data only."],
+                "Originality": rng.randint(2, 4), "Quality": rng.randint(2, 4),
+                "Clarity": rng.randint(2, 4), "Significance": rng.randint(2, 4),
+                "Questions": ["How does the method scale?"],
+                "Limitations": ["Results are not representative of real data."],
+                "Ethical Concerns": False,
+                "Soundness": rng.randint(2, 4), "Presentation": rng.randint(2, 4),
+                "Contribution": rng.randint(2, 4), "Overall": rng.randint(3, 8),
+                "Confidence": rng.randint(2, 5), "Decision": "Reject",
+            }
+            return f"THOUGHT:\nThe submission is a template produced offline.\n\nREVIEW JSON:\n```json\n{json.dumps(review, indent=2)}\n```"
+
+        # mle-solver and its repair tool
+        if "automated code repair tool" in system_prompt:
+            if "```EDIT N M" in system_prompt:
+                return f"```EDIT 0 0\n{OFFLINE_EXPERIMENT_CODE.split(chr(10))[0]}\n```"
+            return f"```python\n{OFFLINE_EXPERIMENT_CODE}\n```"
+        if "REWRITE CODE EDITING TOOL" in system_prompt or "Now please enter the ```REPLACE command below" in prompt:
+            return f"```REPLACE\n{OFFLINE_EXPERIMENT_CODE}\n```"
+
+        # paper-solver
+        if "research paper finder" in system_prompt:
+            return "linear classifiers"
+        if "Your goal is to write a research paper" in system_prompt:
+            if "```REPLACE command to create the scaffold" in prompt:
+                return f"```REPLACE\n{OFFLINE_SCAFFOLD}\n```"
+            if "```REPLACE command" in prompt:
+                return f"```REPLACE\nThis section was written offline (variant {rng.randint(0, 999)}) and describes a least squares linear classifier evaluated on synthetic data.\n```"
+            end = re.findall(r"(\d+) \|\\end\{document\}", system_prompt)
+            if len(end) > 0:
+                return f"```EDIT {end[-1]} {end[-1]}\nAdditional discussion written offline (variant {rng.randint(0, 999)}).\n\\end{{document}}\n```"
+
+        # phase agents, selected by the commands advertised in the system prompt
+        if "```SUMMARY" in system_prompt:
+            reviewed = re.findall(r"Papers in your review so far: (.*)", system_prompt)
+            reviewed = reviewed[0].split() if len(reviewed) > 0 else list()
+            for paper_id in re.findall(r"arXiv paper ID: (\S+)", prompt):
+                if paper_id not in reviewed:
+                    return f"```ADD_PAPER\n{paper_id}\nThis paper is relevant to the research topic and reports experimental results.\n```"
+            return f"```SUMMARY\n{self._topic(prompt)}\n```"
+        if "```PLAN" in system_prompt and step > 0:
+            return f"```PLAN\nTrain a least squares linear classifier on a small dataset for the topic {self._topic(prompt)} and report test accuracy.\n```"
+        if "```INTERPRETATION" in system_prompt and step > 0:
+            return "```INTERPRETATION\nThe linear classifier reaches the reported test accuracy, which shows that the signal is mostly linear.\n```"
+        if "```SUBMIT_CODE" in system_prompt and step > 0:
+            return f"```SUBMIT_CODE\n{OFFLINE_DATA_CODE}\n```"
+        if "```SEARCH_HF" in system_prompt:
+            return f"```python\n{OFFLINE_DATA_CODE}\n```"
+        if "Type y and nothing else to go back" in prompt:
+            return "n"
+        if "generate a readme.md" in system_prompt:
+            return "# Offline Stand-In Run\n\nThis repository was produced by the offline LLM stand-in."
+        if "generate a requirements.txt" in system_prompt:
+            return "numpy"
+        if "```DIALOGUE" in system_prompt:
+            return f"```DIALOGUE\nLet us keep the experiment simple (step {step}).\n```"
+        return "This response was produced by the offline LLM stand-in."
+
+    async def acomplete(self, system_prompt, prompt, stop_on=None):
+        """
+        Answer a prompt after the configured latency
+        @param system_prompt: (str) system prompt
+        @param prompt: (str) user prompt
+        @param stop_on: (callable) stop condition, as for streamed provider responses
+        @return: (tuple) (response, (tokens in, tokens out, tokens cached))
+        """
+        answer = self.respond(system_prompt, prompt)
+        if stop_on is not None and stop_on(answer) is not None:
+            answer = answer[:stop_on(answer)]
+        # approximate counts, the stand-in must not need a tokenizer download
+        tokens_in, tokens_out = (len(system_prompt) + len(prompt)) // 4, len(answer) // 4
+        delay = self.latency + self.token_latency * tokens_out
+        if self.jitter > 0:
+            delay += random.Random(self._seed(system_prompt, prompt)).uniform(0.0, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return answer, (tokens_in, tokens_out, 0)
+
+
+OFFLINE_LLM = OfflineLLM()
+
+
+def configure_offline_llm(latency=0.0, token_latency=0.0, jitter=0.0, script_path=None):
+    """
+    Configure the offline LLM stand-in used by the "offline" model
+    @param latency: (float) seconds added to every call
+    @param token_latency: (float) seconds added per output token
+    @param jitter: (float) max extra seconds per call
+    @param script_path: (str) json file with scripted overrides or None
+    @return: (OfflineLLM) the new stand-in
+    """
+    global OFFLINE_LLM
+    script = OfflineLLM.load_script(script_path) if script_path is not None else None
+    OFFLINE_LLM = OfflineLLM(latency=latency, token_latency=token_latency, jitter=jitter, script=script)
+    return OFFLINE_LLM
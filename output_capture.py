@@ -0,0 +1,153 @@
+import io
+import os
+import time
+import itertools
+from collections import deque
+
+
+# every execution streams its full output here, the agent only sees the head and the tail
+OUTPUT_LOG_ENABLED = True
+OUTPUT_LOG_DIR = os.path.join("research_dir", "exec_logs")
+OUTPUT_LOG_MAX_BYTES = 50 * 1024 * 1024
+OUTPUT_LOG_FLUSH_SECONDS = 1.0
+# share of the output budget given to the head, the rest is the tail (final metrics, tracebacks)
+HEAD_FRACTION = 0.3
+
+_log_ids = itertools.count()
+
+
+def configure_output_capture(log=True, directory=None):
+    """
+    @param log: (bool) stream the full output of every execution to a log file
+    @param directory: (str) where the logs are written, defaults to OUTPUT_LOG_DIR
+    @return: None
+    """
+    global OUTPUT_LOG_ENABLED, OUTPUT_LOG_DIR
+    OUTPUT_LOG_ENABLED = log
+    if directory is not None: OUTPUT_LOG_DIR = directory
+
+
+def new_log_path():
+    """
+    @return: (str) absolute path for the output log of the next execution, or None if logging is disabled
+    """
+    if not OUTPUT_LOG_ENABLED:
+        return None
+    os.makedirs(OUTPUT_LOG_DIR, exist_ok=True)
+    return os.path.abspath(os.path.join(OUTPUT_LOG_DIR, f"run_{time.strftime('%Y%m%d-%H%M%S')}_{os.getpid()}_{next(_log_ids)}.log"))
+
+
+def collapse_carriage_returns(text):
+    """
+    Keep only what a terminal would show of lines redrawn with carriage returns (e.g. progress bars)
+    """
+    if "\r" not in text:
+        return text
+    return "\n".join([_line.rstrip("\r").split("\r")[-1] for _line in text.split("\n")])
+
+
+def log_tail(log_path, max_len):
+    """
+    @param log_path: (str) output log of an execution, e.g. one that was killed on timeout
+    @param max_len: (int) characters returned
+    @return: (str) last characters of the log, empty if there is none
+    """
+    try:
+        with open(log_path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - 4 * max_len))
+            text = f.read().decode("utf-8", errors="replace")
+    except (OSError, TypeError):
+        return str()
+    return collapse_carriage_returns(text)[-max_len:]
+
+
+def _marker(elided, log_path):
+    where = f", full output in {log_path}" if log_path is not None else ""
+    return f"\n[... {elided} characters of output elided{where} ...]\n"
+
+
+class BoundedCapture(io.TextIOBase):
+    def __init__(self, max_len=None, log_path=None) -> None:
+        """
+        Replacement for sys.stdout while generated code runs: keeps the first and the last characters of the
+        output in bounded buffers, so memory stays flat however much the code prints, and streams everything
+        to a log file
+        @param max_len: (int) characters kept in memory (head and tail together), None keeps everything
+        @param log_path: (str) file the full output is streamed to, None disables the log
+        """
+        self.max_len = max_len
+        self.head_len = None if max_len is None else int(max_len * HEAD_FRACTION)
+        self.tail_len = None if max_len is None else max_len - self.head_len
+        self.head = list()
+        self.head_size = 0
+        self.tail = deque()
+        self.tail_size = 0
+        self.total = 0
+        self.log_path = log_path
+        self.log = None
+        self.log_size = 0
+        self.last_flush = time.monotonic()
+        if log_path is not None:
+            try:
+                self.log = open(log_path, "w", encoding="utf-8", errors="replace")
+            except OSError:
+                self.log_path = None
+
+    def writable(self):
+        return True
+
+    def write(self, s):
+        if not isinstance(s, str):
+            raise TypeError(f"write() argument must be str, not {type(s).__name__}")
+        self._log(s)
+        self.total += len(s)
+        if self.max_len is None:
+            self.head.append(s)
+            return len(s)
+        taken = 0
+        if self.head_size < self.head_len:
+            taken = min(len(s), self.head_len - self.head_size)
+            self.head.append(s[:taken])
+            self.head_size += taken
+        if taken < len(s) and self.tail_len > 0:
+            rest = s[taken:][-self.tail_len:]
+            self.tail.append(rest)
+            self.tail_size += len(rest)
+            while self.tail_size - len(self.tail[0]) >= self.tail_len:
+                self.tail_size -= len(self.tail.popleft())
+        return len(s)
+
+    def _log(self, s):
+        if self.log is None:
+            return
+        if self.log_size + len(s) > OUTPUT_LOG_MAX_BYTES:
+            self.log.write(s[:max(0, OUTPUT_LOG_MAX_BYTES - self.log_size)] + "\n[log truncated]\n")
+            self.log.close()
+            self.log = None
+            return
+        self.log.write(s)
+        self.log_size += len(s)
+        # flushed periodically, a killed execution still leaves most of its log behind
+        if time.monotonic() - self.last_flush >= OUTPUT_LOG_FLUSH_SECONDS:
+            self.log.flush()
+            self.last_flush = time.monotonic()
+
+    def flush(self):
+        if self.log is not None:
+            self.log.flush()
+
+    def close_log(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+    def getvalue(self):
+        """
+        @return: (str) the output if it fit, otherwise its head, an elision marker and its tail
+        """
+        head = "".join(self.head)
+        if self.max_len is None or self.total <= self.max_len:
+            return collapse_carriage_returns(head + "".join(self.tail))
+        tail = "".join(self.tail)[-self.tail_len:] if self.tail_len > 0 else str()
+        return collapse_carriage_returns(head) + _marker(self.total - self.head_size - len(tail), self.log_path) + collapse_carriage_returns(tail)
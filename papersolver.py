@@ -8,6 +8,7 @@ from pathlib import Path
 from copy import deepcopy
 from common_imports import *
 from agents import get_score
+from batch_api import LLMBatch
 from abc import abstractmethod
 
 from contextlib import contextmanager
@@ -284,7 +285,8 @@ class PaperSolver:
                 system_prompt=self.system_prompt(),
                 prompt=f"\nNow please enter a command: ",
                 temp=1.0,
-                openai_api_key=self.openai_api_key)
+                openai_api_key=self.openai_api_key,
+                stop_on=FencedBlockStop("EDIT"))
             #print(model_resp)
             model_resp = self.clean_text(model_resp)
             cmd_str, paper_lines, prev_paper_ret, score = self.process_command(model_resp)
@@ -310,6 +312,13 @@ class PaperSolver:
             self.best_report.sort(key=lambda x: x[1], reverse=True)
         return model_resp, cmd_str
 
+    def current_best_score(self):
+        """
+        @return: (float) score of the best report so far, None before the initial report exists
+        """
+        if not hasattr(self, "best_report") or len(self.best_report) == 0: return None
+        return self.best_report[0][1]
+
     def initial_solve(self):
         """
         Initialize the solver and get an initial set of papers and a return
@@ -334,14 +343,26 @@ class PaperSolver:
         text = text.replace("```\n", "```")
         return text
 
+    def search_query_prompt(self, att_str=""):
+        return f"Given the following research topic {self.topic} and research plan: \n\n{self.plan}\n\nPlease come up with a search query to find relevant papers on arXiv. Respond only with the search query and nothing else. This should be a a string that will be used to find papers with semantically similar content. {att_str}"
+
+    @staticmethod
+    def search_query_system_prompt(section):
+        return f"You are a research paper finder. You must find papers for the section {section}. Query must be text nothing else."
+
     def gen_initial_report(self):
         num_attempts = 0
         arx = ArxivSearch()
         section_scaffold = str()
+        search_sections = ["introduction", "related work", "background", "methods", "discussion"]
+        # the first search query of every section does not depend on anything else, send them as one batch
+        batch = LLMBatch()
+        first_queries = {_section: batch.submit(model_str=f"{self.llm_str}", prompt=self.search_query_prompt(), system_prompt=self.search_query_system_prompt(_section), openai_api_key=self.openai_api_key) for _section in search_sections}
+        batch.flush()
         #  1. Abstract 2. Introduction, 3. Background, 4. Methods, 5. Experimental Setup 6. Results, and 7. Discussion
         for _section in ["scaffold", "abstract", "introduction", "related work", "background", "methods", "experimental setup", "results", "discussion"]:
             section_complete = False
-            if _section in ["introduction", "related work", "background", "methods", "discussion"]:
+            if _section in search_sections:
                 attempts = 0
                 papers = str()
                 first_attempt = True
@@ -351,7 +372,9 @@ class PaperSolver:
                         break
                     if not first_attempt:
                         att_str = "This is not your first attempt please try to come up with a simpler search query."
-                    search_query = query_model(model_str=f"{self.llm_str}", prompt=f"Given the following research topic {self.topic} and research plan: \n\n{self.plan}\n\nPlease come up with a search query to find relevant papers on arXiv. Respond only with the search query and nothing else. This should be a a string that will be used to find papers with semantically similar content. {att_str}", system_prompt=f"You are a research paper finder. You must find papers for the section {_section}. Query must be text nothing else.", openai_api_key=self.openai_api_key)
+                        search_query = query_model(model_str=f"{self.llm_str}", prompt=self.search_query_prompt(att_str), system_prompt=self.search_query_system_prompt(_section), openai_api_key=self.openai_api_key)
+                    else:
+                        search_query = first_queries[_section].result()
                     search_query.replace('"', '')
                     papers = arx.find_papers_by_str(query=search_query, N=10)
                     first_attempt = False
@@ -374,7 +397,8 @@ class PaperSolver:
                     system_prompt=self.system_prompt(section=_section),
                     prompt=f"{prompt}",
                     temp=0.8,
-                    openai_api_key=self.openai_api_key)
+                    openai_api_key=self.openai_api_key,
+                    stop_on=FencedBlockStop("REPLACE"))
                 model_resp = self.clean_text(model_resp)
                 if _section == "scaffold":
                     # minimal scaffold (some other sections can be combined)
@@ -437,7 +461,7 @@ class PaperSolver:
                         else:
                             paper_lines = copy(args[1]) #
                             if scoring:
-                                score, cmd_str, is_valid = get_score(self.plan, "\n".join(paper_lines), reward_model_llm=self.llm_str)
+                                score, cmd_str, is_valid = get_score(self.plan, "\n".join(paper_lines), reward_model_llm=self.llm_str, best_score=self.current_best_score())
                             else:
                                 score, cmd_str, is_valid = 0.0, "Paper scored successfully", True
                             if is_valid: failed = False
@@ -459,7 +483,7 @@ class PaperSolver:
                     if success:
                         paper_lines = copy(args[0]) #
                         if scoring:
-                            score, cmd_str, is_valid = get_score(self.plan, "\n".join(paper_lines), reward_model_llm=self.llm_str)
+                            score, cmd_str, is_valid = get_score(self.plan, "\n".join(paper_lines), reward_model_llm=self.llm_str, best_score=self.current_best_score())
                         else:
                             score, cmd_str, is_valid = 0.0, "Paper scored successfully", True
                         if is_valid: failed = False
@@ -489,7 +513,7 @@ class PaperSolver:
         """
         Produce a system prompt for the paper-solver
         @param commands: (bool) whether to use command prompt
-        @return: (str) system prompt
+        @return: (SystemPrompt) system prompt, static segments first so the provider can cache the prefix
         """
         if section == "abstract": length = "This section should be ONLY 1 paragraph."
         else: length = "This section should be approximately 2-4 paragraphs and so your output should be several paragraphs of latex."
@@ -528,7 +552,7 @@ class PaperSolver:
             ref_papers = f"Here is a reference paper that is high quality:\n{refpapers}\n\n\n"
         lit_review_str = str(self.lit_review)[:20000]
         #print(len(f"{self.exp_results}"), len(f"{self.exp_code}"), len(f"{self.plan}"), len(f"{self.lit_review}"), len(f"{self.role_description()}"), len(f"{self.phase_prompt()}"), len(f"{self.generate_paper_lines(self.paper_lines)}"), len(f"{section_cmd}"), len(f"{cmd_set}"), len(f"{ref_papers}"))
-        return (
+        static_segments = [
             f"{ref_papers}"
             # ROLE DESCRIPTION
             f"{self.role_description()}.\n"
@@ -548,14 +572,17 @@ class PaperSolver:
             f"Provided was an interpretation of the experimental results:\n{self.insights}\n"
             f"Your writing style should be boring and objective.\n"
             # transition
-            f"Your goal is to write a research paper as well as possible. You will receive a score after you write the paper and should aim to maximize the score by writing a high quality research paper. The paper length should be 8 pages or 4000 words in total. It should be quite long and comprehensive. Remember, the paper MUST BE LONG. {paper_progress}\n"
+            f"Your goal is to write a research paper as well as possible. You will receive a score after you write the paper and should aim to maximize the score by writing a high quality research paper. The paper length should be 8 pages or 4000 words in total. It should be quite long and comprehensive. Remember, the paper MUST BE LONG.\n"
             # COMMAND SET
-            f"{cmd_set}\n"
+            f"{cmd_set}\n"]
+        volatile_segments = [
+            # PAPER PROGRESS
+            f"{paper_progress}\n"
             # PAPER
             f"Provided here is your current paper {self.generate_paper_lines(self.paper_lines)}"
             # optional section command
-            f"{section_cmd}"
-        )
+            f"{section_cmd}"]
+        return assemble_prompt(static_segments, volatile_segments)
 
     def command_descriptions(self):
         """
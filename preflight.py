@@ -0,0 +1,139 @@
+import ast
+import builtins
+import importlib.util
+
+
+# (pattern, message) pairs, generated code containing the pattern is never executed
+BANNED_PATTERNS = [
+    ("load_dataset('pubmed", "pubmed Download took way too long. Program terminated"),
+    ("exit(", "The exit() command is not allowed you must remove this."),
+]
+# names that exist when code is run as a script
+MODULE_NAMES = {"__name__", "__file__", "__doc__", "__builtins__", "__spec__", "__loader__", "__package__", "__annotations__"}
+# handlers that make an import optional
+IMPORT_ERRORS = {"ImportError", "ModuleNotFoundError", "Exception", "BaseException"}
+# match statement captures, Python 3.10+
+MATCH_CAPTURES = tuple(getattr(ast, _name) for _name in ("MatchAs", "MatchStar") if hasattr(ast, _name))
+
+
+def banned_pattern_error(code_str):
+    """
+    @param code_str: (str) code
+    @return: (str) error in the code execution format, or None if no banned pattern is used
+    """
+    for pattern, message in BANNED_PATTERNS:
+        if pattern in code_str:
+            return f"[CODE EXECUTION ERROR] {message}"
+    return None
+
+
+def bound_names(tree):
+    """
+    Every name the code binds in any scope, a superset of what is defined where a name is read
+    @param tree: (ast.Module) parsed code
+    @return: (set) names, or None if the code uses a star import
+    """
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            names.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, ast.arg):
+            names.add(node.arg)
+        elif isinstance(node, ast.ExceptHandler) and node.name is not None:
+            names.add(node.name)
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            names.update(node.names)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                if alias.name == "*":
+                    return None
+                names.add(alias.asname if alias.asname is not None else alias.name.split(".")[0])
+        elif isinstance(node, MATCH_CAPTURES) and node.name is not None:
+            names.add(node.name)
+        elif getattr(node, "rest", None) is not None:
+            # match mapping "**rest"
+            names.add(node.rest)
+    return names
+
+
+def _required_imports(tree):
+    """
+    @return: (list) (top-level module, line) for every absolute import that is not guarded by an import error handler
+    """
+    optional = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Try):
+            handled = set()
+            for handler in node.handlers:
+                if handler.type is None:
+                    handled.add("BaseException")
+                for exc in (handler.type.elts if isinstance(handler.type, ast.Tuple) else [handler.type]):
+                    if isinstance(exc, ast.Name):
+                        handled.add(exc.id)
+            if len(handled & IMPORT_ERRORS) > 0:
+                for stmt in node.body:
+                    optional.update(id(_n) for _n in ast.walk(stmt))
+    imports = list()
+    for node in ast.walk(tree):
+        if id(node) in optional:
+            continue
+        if isinstance(node, ast.Import):
+            imports += [(alias.name.split(".")[0], node.lineno) for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module is not None:
+            imports.append((node.module.split(".")[0], node.lineno))
+    return imports
+
+
+def preflight_check(code_str, setup_code=None):
+    """
+    Static checks run before generated code is executed: banned patterns, syntax, names that are never
+    defined and imports of modules that are not installed
+    @param code_str: (str) code to check
+    @param setup_code: (str) code that runs before code_str in the same namespace (e.g. the dataset code)
+    @return: (str) diagnostics in the code execution error format, or None if the code may be executed
+    """
+    full_code = code_str if setup_code is None else f"{setup_code}\n{code_str}"
+    banned = banned_pattern_error(full_code)
+    if banned is not None:
+        return banned
+    try:
+        # a full compile, some errors (e.g. "return" outside a function) are only raised after parsing
+        compile(code_str, "<string>", "exec")
+        tree = ast.parse(code_str)
+    except SyntaxError as e:
+        line = f"\n    {e.text.rstrip()}" if e.text else ""
+        return f"[CODE EXECUTION ERROR]: {e.msg} (line {e.lineno}){line}"
+    except ValueError as e:
+        # e.g. null bytes in the source
+        return f"[CODE EXECUTION ERROR]: {str(e)}"
+    diagnostics = list()
+    defined = bound_names(tree)
+    if defined is not None and setup_code is not None:
+        try:
+            setup_names = bound_names(ast.parse(setup_code))
+            defined = None if setup_names is None else defined | setup_names
+        except SyntaxError:
+            defined = None
+    if defined is not None:
+        defined |= set(dir(builtins)) | MODULE_NAMES
+        reported = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load) and node.id not in defined and node.id not in reported:
+                reported.add(node.id)
+                diagnostics.append((node.lineno, f"name '{node.id}' is not defined"))
+    reported = set()
+    for module, lineno in _required_imports(tree):
+        if module in reported:
+            continue
+        reported.add(module)
+        try:
+            spec = importlib.util.find_spec(module)
+        except (ImportError, ValueError):
+            spec = None
+        if spec is None:
+            diagnostics.append((lineno, f"No module named '{module}'"))
+    if len(diagnostics) == 0:
+        return None
+    return "\n".join([f"[CODE EXECUTION ERROR]: {message} (line {lineno})" for lineno, message in sorted(diagnostics)])
@@ -0,0 +1,136 @@
+import os
+import sys
+import json
+import time
+import itertools
+import threading
+
+
+# opt-in, sampling the executing code slows it down slightly
+PROFILE_ENABLED = False
+PROFILE_TOP_N = 10
+PROFILE_INTERVAL = 0.01
+# the profile is rewritten this often, so that it survives the execution being killed on timeout
+PROFILE_FLUSH_SECONDS = 1.0
+PROFILE_DIR = os.path.join("research_dir", "profiles")
+# frames of the executor itself, sampled stacks are cut at the first of them
+EXECUTOR_FILES = {os.path.join(os.path.dirname(os.path.abspath(__file__)), _name) for _name in ("code_executor.py", "incremental_exec.py", "profiler.py")}
+
+_profile_ids = itertools.count()
+
+
+def configure_profiling(enabled=False, top_n=10, directory=None, interval=0.01):
+    """
+    Profile every execution of generated code and append its hotspots to the output
+    @param enabled: (bool) run executions under the sampling profiler
+    @param top_n: (int) rows of the hotspot table
+    @param directory: (str) where full profiles are written, defaults to PROFILE_DIR
+    @param interval: (float) seconds between samples
+    @return: None
+    """
+    global PROFILE_ENABLED, PROFILE_TOP_N, PROFILE_DIR, PROFILE_INTERVAL
+    PROFILE_ENABLED = enabled
+    PROFILE_TOP_N = top_n
+    PROFILE_INTERVAL = interval
+    if directory is not None: PROFILE_DIR = directory
+
+
+def new_profile_path():
+    """
+    @return: (str) absolute path for the profile of the next execution, or None if profiling is disabled
+    """
+    if not PROFILE_ENABLED:
+        return None
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    return os.path.abspath(os.path.join(PROFILE_DIR, f"profile_{time.strftime('%Y%m%d-%H%M%S')}_{os.getpid()}_{next(_profile_ids)}.json"))
+
+
+class SamplingProfiler:
+    def __init__(self, path, interval=None) -> None:
+        """
+        Statistical profiler for the thread that executes generated code: a background thread samples its stack
+        and counts, per (function, file, line), the samples in which it was on the stack (cumulative) and on top
+        of it (self). Unlike cProfile it adds no per-call overhead and its profile is flushed to disk while the
+        code runs, so even an execution killed on timeout leaves a profile behind.
+        @param path: (str) JSON file the profile is written to
+        @param interval: (float) seconds between samples, defaults to PROFILE_INTERVAL
+        """
+        self.path = path
+        self.interval = PROFILE_INTERVAL if interval is None else interval
+        self.samples = 0
+        self.cumulative = dict()
+        self.self_samples = dict()
+        self.started = None
+        self._thread_id = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        # also resumes a stopped profiler, e.g. after a fork, which must not happen while the sampling thread runs
+        self._thread_id = threading.get_ident()
+        if self.started is None: self.started = time.monotonic()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample_loop, name="code-profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+
+    def _sample_loop(self):
+        last_flush = time.monotonic()
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = list()
+            while frame is not None and frame.f_code.co_filename not in EXECUTOR_FILES:
+                stack.append((frame.f_code.co_name, frame.f_code.co_filename, frame.f_lineno))
+                frame = frame.f_back
+            # only samples taken inside the generated code, not in the executor's own bookkeeping
+            if len(stack) == 0 or stack[-1][1] != "<string>":
+                continue
+            self.samples += 1
+            self.self_samples[stack[0]] = self.self_samples.get(stack[0], 0) + 1
+            # recursion counts once per sample
+            for entry in set(stack):
+                self.cumulative[entry] = self.cumulative.get(entry, 0) + 1
+            if time.monotonic() - last_flush >= PROFILE_FLUSH_SECONDS:
+                self.flush()
+                last_flush = time.monotonic()
+
+    def flush(self):
+        entries = [[name, filename, line, count, self.self_samples.get((name, filename, line), 0)]
+                   for (name, filename, line), count in sorted(self.cumulative.items(), key=lambda x: -x[1])]
+        profile = {"interval": self.interval, "samples": self.samples, "seconds": time.monotonic() - self.started, "entries": entries}
+        try:
+            with open(self.path + ".tmp", "w") as f:
+                json.dump(profile, f)
+            os.replace(self.path + ".tmp", self.path)
+        except OSError:
+            pass
+
+
+def hotspot_table(path, top_n=None):
+    """
+    Compact table of the slowest lines of a profiled execution, for the agent
+    @param path: (str) profile written by SamplingProfiler
+    @param top_n: (int) number of rows, defaults to PROFILE_TOP_N
+    @return: (str) hotspot table, empty if there is no profile
+    """
+    try:
+        with open(path) as f:
+            profile = json.load(f)
+    except (OSError, ValueError):
+        return str()
+    if profile["samples"] == 0:
+        return str()
+    top_n = PROFILE_TOP_N if top_n is None else top_n
+    # seconds per sample, measured, the sampling interval is a lower bound
+    scale = profile["seconds"] / profile["samples"]
+    rows = [f"[PROFILE HOTSPOTS]: where {profile['seconds']:.1f} s of execution were spent (cumulative includes callees, full profile: {path})",
+            f"{'cumulative':>10} {'self':>8}  function (file:line)"]
+    for name, filename, line, count, self_count in profile["entries"][:top_n]:
+        filename = filename if filename.startswith("<") else os.path.basename(filename)
+        rows.append(f"{count * scale:>9.1f}s {self_count * scale:>7.1f}s  {name} ({filename}:{line})")
+    return "\n" + "\n".join(rows)
@@ -0,0 +1,40 @@
+class SystemPrompt(str):
+    """
+    System prompt string that remembers which leading part is stable between calls.
+    It behaves exactly like the rendered str, so it can be passed anywhere a prompt is expected.
+    """
+    def __new__(cls, static_segments, volatile_segments=()):
+        static = "".join(static_segments)
+        volatile = "".join(volatile_segments)
+        prompt = super().__new__(cls, static + volatile)
+        prompt.static = static
+        prompt.volatile = volatile
+        return prompt
+
+    def __getnewargs__(self):
+        return (self.static, self.volatile)
+
+
+def assemble_prompt(static_segments, volatile_segments=()):
+    """
+    Build a system prompt with every static segment ahead of the volatile ones,
+    so that the provider can reuse its cached prefix between calls
+    @param static_segments: (list) segments that are identical from call to call
+    @param volatile_segments: (list) segments that change between calls
+    @return: (SystemPrompt) assembled prompt
+    """
+    return SystemPrompt(list(static_segments), list(volatile_segments))
+
+
+def anthropic_system_blocks(system_prompt):
+    """
+    Render a system prompt as Anthropic content blocks, marking the static prefix as cacheable
+    @param system_prompt: (str or SystemPrompt) system prompt
+    @return: (list or str) system blocks, or the plain string if nothing is marked static
+    """
+    if not isinstance(system_prompt, SystemPrompt) or len(system_prompt.static) == 0:
+        return str(system_prompt)
+    blocks = [{"type": "text", "text": system_prompt.static, "cache_control": {"type": "ephemeral"}}]
+    if len(system_prompt.volatile) > 0:
+        blocks.append({"type": "text", "text": system_prompt.volatile})
+    return blocks
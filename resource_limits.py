@@ -0,0 +1,165 @@
+import os
+import math
+import time
+import signal
+try:
+    import resource
+except ImportError:
+    # not available on Windows, runs are measured by wall time only
+    resource = None
+
+
+# per-run limits of generated code, None means unlimited
+MEMORY_LIMIT_MB = None
+CPU_LIMIT_SECONDS = None
+FILE_SIZE_LIMIT_MB = None
+# existing cgroup v2 directory (e.g. /sys/fs/cgroup/agentlab) that executor processes join
+CGROUP_PATH = None
+REPORT_USAGE = True
+
+
+def configure_resource_limits(memory_mb=None, cpu_seconds=None, file_size_mb=None, cgroup=None, report=True):
+    """
+    Limits applied to every execution of generated code, must be set before the executors start
+    @param memory_mb: (float) address space limit (RLIMIT_AS) of the executing process, in MB
+    @param cpu_seconds: (float) CPU time limit per execution, in seconds
+    @param file_size_mb: (float) largest file the code may write (RLIMIT_FSIZE), in MB
+    @param cgroup: (str) cgroup v2 directory the executor processes are moved to, its limits are set by the operator
+    @param report: (bool) append peak memory, CPU time and wall time to the output
+    @return: None
+    """
+    global MEMORY_LIMIT_MB, CPU_LIMIT_SECONDS, FILE_SIZE_LIMIT_MB, CGROUP_PATH, REPORT_USAGE
+    MEMORY_LIMIT_MB = memory_mb
+    CPU_LIMIT_SECONDS = cpu_seconds
+    FILE_SIZE_LIMIT_MB = file_size_mb
+    CGROUP_PATH = cgroup
+    REPORT_USAGE = report
+
+
+def current_limits():
+    """
+    @return: (dict) configured limits, passed to spawned executor processes
+    """
+    return {"memory_mb": MEMORY_LIMIT_MB, "cpu_seconds": CPU_LIMIT_SECONDS, "file_size_mb": FILE_SIZE_LIMIT_MB,
+            "cgroup": CGROUP_PATH, "report": REPORT_USAGE}
+
+
+def set_limits(limits):
+    """
+    Adopt limits in a spawned executor process, where the configuration of the orchestrator is not inherited
+    @param limits: (dict) output of current_limits
+    @return: None
+    """
+    configure_resource_limits(limits["memory_mb"], limits["cpu_seconds"], limits["file_size_mb"], limits["cgroup"], limits["report"])
+
+
+def _cpu_time_exceeded(signum, frame):
+    raise Exception(f"CPU time limit of {CPU_LIMIT_SECONDS} seconds exceeded. You must reduce the time complexity of your code.")
+
+
+def setup_executor_process():
+    """
+    Once per executor process: join the cgroup and turn limit signals into Python exceptions
+    @return: None
+    """
+    if CGROUP_PATH is not None:
+        try:
+            with open(os.path.join(CGROUP_PATH, "cgroup.procs"), "w") as f:
+                f.write(str(os.getpid()))
+        except OSError as e:
+            print(f"Could not join cgroup {CGROUP_PATH}: {e}")
+    if resource is None:
+        return
+    # exceeding RLIMIT_FSIZE raises OSError instead of killing the process
+    signal.signal(signal.SIGXFSZ, signal.SIG_IGN)
+    signal.signal(signal.SIGXCPU, _cpu_time_exceeded)
+
+
+def _peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    # kilobytes on Linux, bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024 * 1024) if os.uname().sysname == "Darwin" else maxrss / 1024
+
+
+def _cpu_seconds():
+    if resource is None:
+        return None
+    usage = [resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)]
+    return sum([_u.ru_utime + _u.ru_stime for _u in usage])
+
+
+def _set_soft_limit(kind, soft):
+    _, hard = resource.getrlimit(kind)
+    if soft is None or (hard != resource.RLIM_INFINITY and soft > hard):
+        soft = hard
+    try:
+        resource.setrlimit(kind, (soft, hard))
+    except (ValueError, OSError):
+        pass
+
+
+class ResourceMeter:
+    def __init__(self) -> None:
+        """
+        Apply the configured limits for one execution in the current process and measure what it used.
+        Only soft limits are set, so a long-lived worker can lift them again after the execution.
+        """
+        self.wall = None
+        self.cpu = None
+        self.usage = None
+
+    def start(self):
+        try:
+            # resets the peak RSS (VmHWM) of this process, Linux only
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+        except OSError:
+            pass
+        self.cpu = _cpu_seconds()
+        if resource is not None:
+            if MEMORY_LIMIT_MB is not None:
+                _set_soft_limit(resource.RLIMIT_AS, int(MEMORY_LIMIT_MB * 1024 * 1024))
+            if FILE_SIZE_LIMIT_MB is not None:
+                _set_soft_limit(resource.RLIMIT_FSIZE, int(FILE_SIZE_LIMIT_MB * 1024 * 1024))
+            if CPU_LIMIT_SECONDS is not None:
+                # RLIMIT_CPU counts the whole life of the process, so the limit is relative to what it used so far
+                used = resource.getrusage(resource.RUSAGE_SELF)
+                _set_soft_limit(resource.RLIMIT_CPU, math.ceil(used.ru_utime + used.ru_stime + CPU_LIMIT_SECONDS))
+        self.wall = time.monotonic()
+        return self
+
+    def stop(self):
+        """
+        Lift the limits and record the usage of the execution
+        @return: (dict) peak_rss_mb, cpu_seconds and wall_seconds (None when they cannot be measured)
+        """
+        wall = time.monotonic() - self.wall
+        if resource is not None:
+            for kind in [resource.RLIMIT_AS, resource.RLIMIT_FSIZE, resource.RLIMIT_CPU]:
+                _set_soft_limit(kind, None)
+        cpu = _cpu_seconds()
+        self.usage = {"peak_rss_mb": _peak_rss_mb(), "cpu_seconds": None if cpu is None else cpu - self.cpu, "wall_seconds": wall}
+        return self.usage
+
+    def summary(self):
+        """
+        @return: (str) line appended to the output the agent sees, empty if reporting is off
+        """
+        if not REPORT_USAGE or self.usage is None:
+            return str()
+        parts = list()
+        if self.usage["peak_rss_mb"] is not None:
+            parts.append(f"peak memory {self.usage['peak_rss_mb']:.1f} MB" + (f" (limit {MEMORY_LIMIT_MB:g} MB)" if MEMORY_LIMIT_MB is not None else ""))
+        if self.usage["cpu_seconds"] is not None:
+            parts.append(f"CPU time {self.usage['cpu_seconds']:.1f} s" + (f" (limit {CPU_LIMIT_SECONDS:g} s)" if CPU_LIMIT_SECONDS is not None else ""))
+        parts.append(f"wall time {self.usage['wall_seconds']:.1f} s")
+        return f"\n[RESOURCE USAGE]: {', '.join(parts)}"
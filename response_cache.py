@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+CACHE_POLICIES = ["off", "deterministic", "all"]
+# puts between two expiry sweeps, the size limit is checked on every put against a running total
+EVICT_INTERVAL = 100
+
+
+class ResponseCache:
+    def __init__(self, path="state_saves/llm_cache.sqlite", policy="deterministic", max_bytes=512 * 1024 * 1024, max_age=30 * 24 * 3600) -> None:
+        """
+        On-disk, content-addressed cache of LLM responses
+        @param path: (str) location of the sqlite database
+        @param policy: (str) "off", "deterministic" (temp 0 or None only) or "all"
+        @param max_bytes: (int) evict least recently used entries above this size
+        @param max_age: (float) evict entries older than this many seconds
+        """
+        if policy not in CACHE_POLICIES:
+            raise Exception(f"Invalid cache policy: {policy}, choose from {CACHE_POLICIES}")
+        self.path = path
+        self.policy = policy
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # bytes of the stored responses, re-counted on every eviction (other processes may share the database)
+        self._total_bytes = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            dir_path = os.path.dirname(self.path)
+            if dir_path:
+                os.makedirs(dir_path, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30.0, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, model TEXT, response TEXT, size INTEGER, "
+                "created REAL, accessed REAL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed)")
+            self._evict()
+        return self._conn
+
+    @staticmethod
+    def make_key(model_str, system_prompt, prompt, temp, **kwargs):
+        """
+        Hash of the normalized request
+        @param model_str: (str) canonical model name
+        @param kwargs: any other request parameters that change the response
+        @return: (str) hex digest
+        """
+        request = {"model": model_str, "system_prompt": system_prompt, "prompt": prompt,
+                   "temp": None if temp is None else float(temp)}
+        request.update({_k: _v for _k, _v in kwargs.items() if _v is not None})
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def should_cache(self, temp):
+        if self.policy == "off": return False
+        if self.policy == "all": return True
+        return temp is None or float(temp) == 0.0
+
+    def get(self, key):
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            now = time.time()
+            if row is None or now - row[1] > self.max_age:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, model_str, response):
+        with self._lock:
+            conn = self._connect()
+            now = time.time()
+            size = len(response.encode("utf-8"))
+            replaced = conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, size, created, accessed) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model_str, response, size, now, now))
+            conn.commit()
+            self._total_bytes += size - (replaced[0] if replaced is not None else 0)
+            self._puts += 1
+            if self._total_bytes > self.max_bytes or self._puts % EVICT_INTERVAL == 0:
+                self._evict()
+
+    def _evict(self):
+        """
+        Remove expired entries, then least recently used entries until under max_bytes, and re-count the
+        running total (caller holds the lock)
+        """
+        conn = self._conn
+        cur = conn.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.max_age,))
+        self.evictions += cur.rowcount
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total > self.max_bytes:
+            for key, size in conn.execute("SELECT key, size FROM responses ORDER BY accessed ASC").fetchall():
+                if total <= self.max_bytes: break
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                total -= size
+                self.evictions += 1
+        conn.commit()
+        self._total_bytes = total
+
+    def stats(self):
+        """
+        Hit/miss counters for this process
+        @return: (dict) cache statistics
+        """
+        lookups = self.hits + self.misses
+        return {
+            "policy": self.policy,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+        }
+
+    def clear(self):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM responses")
+            conn.commit()
+            self._total_bytes = 0
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,241 @@
+import time
+import random
+import asyncio
+import email.utils
+
+
+MAX_BACKOFF = 60.0
+
+# requests and tokens per minute admitted per provider, None means unlimited
+PROVIDER_LIMITS = {
+    "openai": {"rpm": None, "tpm": None},
+    "anthropic": {"rpm": None, "tpm": None},
+}
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, provider, retry_in):
+        super().__init__(f"Circuit open for provider {provider}, retrying in {retry_in:.1f} seconds")
+        self.retry_in = retry_in
+
+
+def classify_error(e):
+    """
+    Sort an inference exception into a retry class
+    @param e: (Exception) exception raised by a provider call
+    @return: (str) "rate_limit", "server", "circuit_open", "fatal" or "other" (e.g. a malformed response)
+    """
+    if isinstance(e, CircuitOpenError):
+        return "circuit_open"
+    status = getattr(e, "status_code", None)
+    if status == 429:
+        return "rate_limit"
+    if status is not None and status >= 500:
+        return "server"
+    if status is not None and status in [400, 401, 403, 404, 422]:
+        # bad request, auth or unknown model, retrying will not help
+        return "fatal"
+    name = type(e).__name__
+    if "Connection" in name or "Timeout" in name:
+        return "server"
+    return "other"
+
+
+def retry_after(e):
+    """
+    Delay requested by the server through Retry-After headers
+    @param e: (Exception) exception raised by a provider call
+    @return: (float) seconds to wait or None if not provided
+    """
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers is None:
+        return None
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return float(headers.get("retry-after-ms")) / 1000.0
+        value = headers.get("retry-after")
+        if value is None:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+def backoff_delay(attempt, base=1.0, cap=MAX_BACKOFF):
+    """
+    Exponential backoff with full jitter
+    @param attempt: (int) zero-indexed retry attempt
+    @param base: (float) delay scale in seconds
+    @param cap: (float) max delay in seconds
+    @return: (float) seconds to wait
+    """
+    return random.uniform(0.0, min(cap, base * (2 ** attempt)))
+
+
+class TokenBucket:
+    def __init__(self, per_minute) -> None:
+        """
+        Async token bucket refilled continuously at per_minute / 60 tokens per second
+        @param per_minute: (float) bucket capacity and refill per minute
+        """
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount=1.0):
+        # a single request larger than the bucket is admitted once the bucket is full
+        amount = min(float(amount), self.capacity)
+        while True:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def adjust(self, amount):
+        """
+        Charge (or refund, if negative) tokens after the real usage is known, may go into debt
+        """
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, cooldown=30.0) -> None:
+        """
+        Stop sending requests to a provider after repeated server failures
+        @param failure_threshold: (int) consecutive failures that open the circuit
+        @param cooldown: (float) seconds before a single probe request is let through
+        """
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def check(self, provider):
+        if self.opened_at is None:
+            return
+        remaining = self.opened_at + self.cooldown - time.monotonic()
+        if remaining > 0 or self.probing:
+            raise CircuitOpenError(provider, max(remaining, 1.0))
+        # half-open, let one probe through
+        self.probing = True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probing or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self.probing = False
+
+
+class ProviderAdmission:
+    def __init__(self, provider, rpm=None, tpm=None) -> None:
+        """
+        Admission control for one provider: rate buckets, server pauses and a circuit breaker
+        @param provider: (str) provider name
+        @param rpm: (int) requests per minute or None
+        @param tpm: (int) tokens per minute or None
+        """
+        self.provider = provider
+        self.requests = TokenBucket(rpm) if rpm is not None else None
+        self.tokens = TokenBucket(tpm) if tpm is not None else None
+        self.breaker = CircuitBreaker()
+        self.paused_until = 0.0
+
+    async def acquire(self, est_tokens):
+        """
+        Wait until a request of est_tokens tokens may be sent
+        """
+        self.breaker.check(self.provider)
+        pause = self.paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        if self.requests is not None:
+            await self.requests.acquire(1)
+        if self.tokens is not None:
+            await self.tokens.acquire(est_tokens)
+
+    def settle(self, est_tokens, used_tokens):
+        if self.tokens is not None:
+            self.tokens.adjust(used_tokens - est_tokens)
+
+    def pause(self, delay):
+        """
+        Hold back every request to this provider, e.g. after a 429
+        """
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+    def record_success(self):
+        self.breaker.record_success()
+
+    def record_cancel(self):
+        # a cancelled probe says nothing about the provider, let the next request probe
+        self.breaker.probing = False
+
+    def record_failure(self, kind):
+        if kind == "server":
+            self.breaker.record_failure()
+        elif kind != "circuit_open" and self.breaker.probing:
+            # the probe got an answer from the provider, so it is up again
+            self.breaker.record_success()
+
+
+_admissions = dict()
+
+
+def provider_admission(provider):
+    """
+    Process-wide admission controller for a provider (only used on the inference loop)
+    @param provider: (str) provider name
+    @return: (ProviderAdmission) admission controller
+    """
+    if provider not in _admissions:
+        limits = PROVIDER_LIMITS.get(provider, dict())
+        _admissions[provider] = ProviderAdmission(provider, rpm=limits.get("rpm"), tpm=limits.get("tpm"))
+    return _admissions[provider]
+
+
+def configure_rate_limits(provider, rpm=None, tpm=None):
+    """
+    Set the requests and tokens per minute admitted for a provider
+    @param provider: (str) provider name, e.g. "openai"
+    @param rpm: (int) requests per minute or None for unlimited
+    @param tpm: (int) tokens per minute or None for unlimited
+    @return: None
+    """
+    PROVIDER_LIMITS[provider] = {"rpm": rpm, "tpm": tpm}
+    _admissions.pop(provider, None)
+
+
+def retry_delay(e, kind, attempt, base=1.0):
+    """
+    How long to wait before retrying a failed call
+    @param e: (Exception) exception raised by a provider call
+    @param kind: (str) retry class from classify_error
+    @param attempt: (int) zero-indexed retry attempt
+    @param base: (float) backoff scale in seconds
+    @return: (float) seconds to wait
+    """
+    if kind == "circuit_open":
+        return e.retry_in
+    server_delay = retry_after(e)
+    if server_delay is not None:
+        # small jitter so that parallel callers do not all come back at once
+        return server_delay + random.uniform(0.0, min(1.0, base))
+    return backoff_delay(attempt, base=base)
@@ -0,0 +1,77 @@
+import threading
+
+
+class ScoreCascade:
+    def __init__(self, cheap_model=None, margin=0.1) -> None:
+        """
+        Cheap-first reward scoring: a cheap model scores every candidate and the expensive
+        model is only asked when the candidate could change the current best
+        @param cheap_model: (str) model used for the first pass, None disables the cascade
+        @param margin: (float) escalate when the cheap score is within margin * score range below the best (or above it)
+        """
+        self.cheap_model = cheap_model
+        self.margin = margin
+        self._lock = threading.Lock()
+        self.stats = {"cheap_only": 0, "escalated_near_best": 0, "escalated_parse": 0, "compared": 0, "same_side": 0, "abs_diff": 0.0}
+
+    @property
+    def enabled(self):
+        return self.cheap_model is not None
+
+    def _count(self, key, amount=1):
+        with self._lock:
+            self.stats[key] += amount
+
+    def run(self, score_fn, model_str, best_score=None, score_range=1.0):
+        """
+        Score a candidate through the cascade
+        @param score_fn: (callable) model_str -> (score, feedback str, is_valid)
+        @param model_str: (str) expensive model, the phase backbone
+        @param best_score: (float) current best score or None if there is nothing to compare to yet
+        @param score_range: (float) width of the score scale, e.g. 1.0 or 10.0
+        @return: (tuple) score_fn result of the model that was trusted
+        """
+        if not self.enabled or self.cheap_model == model_str:
+            return score_fn(model_str)
+        cheap = score_fn(self.cheap_model)
+        if not cheap[2] or cheap[0] is None:
+            self._count("escalated_parse")
+            return score_fn(model_str)
+        if best_score is None or cheap[0] < best_score - self.margin * score_range:
+            self._count("cheap_only")
+            return cheap
+        self._count("escalated_near_best")
+        full = score_fn(model_str)
+        if full[2] and full[0] is not None:
+            self._count("compared")
+            self._count("abs_diff", abs(full[0] - cheap[0]))
+            # did both models agree on whether the candidate beats the best
+            if (cheap[0] > best_score) == (full[0] > best_score): self._count("same_side")
+            print(f"Score cascade: {self.cheap_model} {cheap[0]:.3f} vs {model_str} {full[0]:.3f} (best {best_score:.3f})")
+        return full
+
+    def summary(self):
+        """
+        @return: (dict) call counts and agreement between the cheap and expensive model
+        """
+        with self._lock:
+            stats = dict(self.stats)
+        if stats["compared"] > 0:
+            stats["mean_abs_diff"] = stats["abs_diff"] / stats["compared"]
+            stats["agreement"] = stats["same_side"] / stats["compared"]
+        return stats
+
+
+SCORE_CASCADE = ScoreCascade()
+
+
+def configure_score_cascade(cheap_model, margin=0.1):
+    """
+    Score solver candidates with a cheap model first
+    @param cheap_model: (str) model for the first pass, None disables the cascade
+    @param margin: (float) fraction of the score range below the current best that still escalates
+    @return: (ScoreCascade) the new cascade
+    """
+    global SCORE_CASCADE
+    SCORE_CASCADE = ScoreCascade(cheap_model=cheap_model, margin=margin)
+    return SCORE_CASCADE
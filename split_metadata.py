@@ -0,0 +1,140 @@
+import os
+import json
+import time
+import threading
+import concurrent.futures
+from psutil._common import bytes2human
+from datasets import load_dataset_builder
+
+
+# split names, sizes and example counts of huggingface datasets, by dataset id
+SPLIT_METADATA_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "agentlab", "split_metadata.json")
+SPLIT_METADATA_WORKERS = 8
+SPLIT_METADATA_TTL_SECONDS = 7 * 24 * 3600
+# failed lookups are often transient (rate limits, timeouts), they are retried sooner
+SPLIT_METADATA_FAILURE_TTL_SECONDS = 3600
+# answer from the cache only, e.g. without network access
+SPLIT_METADATA_OFFLINE = os.environ.get("HF_HUB_OFFLINE", "0").lower() in ("1", "true", "yes")
+
+
+def configure_split_metadata(offline=False, workers=8, ttl_hours=168, cache_path=None):
+    """
+    @param offline: (bool) never query the hub, unknown datasets are reported without split information
+    @param workers: (int) hub lookups that run at once
+    @param ttl_hours: (float) age after which a cached entry is looked up again
+    @param cache_path: (str) JSON file of the cache, defaults to SPLIT_METADATA_CACHE
+    @return: None
+    """
+    global _store, SPLIT_METADATA_OFFLINE, SPLIT_METADATA_WORKERS, SPLIT_METADATA_TTL_SECONDS, SPLIT_METADATA_CACHE
+    with _store_lock:
+        SPLIT_METADATA_OFFLINE = offline
+        SPLIT_METADATA_WORKERS = workers
+        SPLIT_METADATA_TTL_SECONDS = ttl_hours * 3600
+        if cache_path is not None: SPLIT_METADATA_CACHE = cache_path
+        _store = None
+
+
+def split_fields(splits):
+    """
+    @param splits: (dict) split name -> [num_bytes, num_examples], or None if unknown
+    @return: (dict) has_test_set, has_train_set and the test/train download and element sizes of a search result
+    """
+    fields = {"has_test_set": False, "has_train_set": False, "test_download_size": None, "test_element_size": None,
+              "train_download_size": None, "train_element_size": None}
+    if splits is None:
+        return fields
+    for split in ["test", "train"]:
+        if split in splits:
+            num_bytes, num_examples = splits[split]
+            fields[f"has_{split}_set"] = True
+            fields[f"{split}_download_size"] = bytes2human(num_bytes) if num_bytes is not None else None
+            fields[f"{split}_element_size"] = num_examples
+    return fields
+
+
+def _fetch_splits(dataset_id):
+    """
+    @return: (dict) split name -> [num_bytes, num_examples], None if the builder has no split information
+    """
+    splits = load_dataset_builder(dataset_id, trust_remote_code=True).info.splits
+    if splits is None:
+        return None
+    return {name: [split.num_bytes, split.num_examples] for name, split in splits.items()}
+
+
+class SplitMetadataStore:
+    def __init__(self, cache_path=None, workers=None, ttl_seconds=None, offline=None) -> None:
+        """
+        Split metadata of huggingface datasets, looked up on the hub in parallel and kept in a local cache
+        @param cache_path: (str) JSON file of the cache, defaults to SPLIT_METADATA_CACHE
+        @param workers: (int) hub lookups that run at once, defaults to SPLIT_METADATA_WORKERS
+        @param ttl_seconds: (float) age after which an entry is looked up again, defaults to SPLIT_METADATA_TTL_SECONDS
+        @param offline: (bool) answer from the cache only, defaults to SPLIT_METADATA_OFFLINE
+        """
+        self.cache_path = SPLIT_METADATA_CACHE if cache_path is None else cache_path
+        self.workers = SPLIT_METADATA_WORKERS if workers is None else workers
+        self.ttl_seconds = SPLIT_METADATA_TTL_SECONDS if ttl_seconds is None else ttl_seconds
+        self.offline = SPLIT_METADATA_OFFLINE if offline is None else offline
+        self.stats = {"hits": 0, "lookups": 0, "failures": 0}
+        self._lock = threading.Lock()
+        self._entries = dict()
+        try:
+            with open(self.cache_path) as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def _fresh(self, entry):
+        ttl = self.ttl_seconds if entry["ok"] else SPLIT_METADATA_FAILURE_TTL_SECONDS
+        return time.time() - entry["fetched"] <= ttl
+
+    def lookup(self, dataset_ids):
+        """
+        @param dataset_ids: (list(str)) huggingface dataset ids
+        @return: (dict) dataset id -> split_fields of the dataset
+        """
+        with self._lock:
+            entries = {_id: self._entries.get(_id) for _id in set(dataset_ids)}
+            # offline, even expired entries are better than nothing
+            missing = [_id for _id, entry in entries.items() if entry is None or (not self.offline and not self._fresh(entry))]
+            self.stats["hits"] += len(entries) - len(missing)
+        if len(missing) > 0 and not self.offline:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.workers, len(missing))) as pool:
+                futures = {pool.submit(_fetch_splits, _id): _id for _id in missing}
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        entry = {"ok": True, "splits": future.result(), "fetched": time.time()}
+                    except Exception:
+                        entry = {"ok": False, "splits": None, "fetched": time.time()}
+                    entries[futures[future]] = entry
+            with self._lock:
+                self.stats["lookups"] += len(missing)
+                self.stats["failures"] += len([_id for _id in missing if not entries[_id]["ok"]])
+                self._entries.update({_id: entries[_id] for _id in missing})
+                self._save()
+        return {_id: split_fields(entry["splits"] if entry is not None else None) for _id, entry in entries.items()}
+
+    def _save(self):
+        tmp_path = f"{self.cache_path}.tmp{os.getpid()}"
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump(self._entries, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            print(f"Could not save the split metadata cache: {e}")
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def split_metadata_store():
+    """
+    @return: (SplitMetadataStore) process-wide store, loaded on first use
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = SplitMetadataStore()
+        return _store
@@ -0,0 +1,31 @@
+import os
+import time
+import threading
+
+import pytest
+
+code_executor = pytest.importorskip("code_executor")
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="snapshots need fork")
+def test_snapshot_setup_does_not_block_the_pool_lock(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    code_executor.configure_code_executor(workers=1, prewarm=[], snapshot=True)
+    started = threading.Event()
+
+    def build():
+        started.set()
+        code_executor.snapshot_executor("import time\ntime.sleep(2)\nx = 1")
+
+    thread = threading.Thread(target=build)
+    thread.start()
+    started.wait(5)
+    time.sleep(0.2)
+    start = time.monotonic()
+    code_executor.execution_stats()
+    assert time.monotonic() - start < 1.0
+    thread.join()
+    snapshot = code_executor.snapshot_executor("import time\ntime.sleep(2)\nx = 1")
+    assert snapshot is not None
+    assert "1" in snapshot.run("print(x)")
+    code_executor.configure_code_executor(workers=1, prewarm=[], snapshot=False)
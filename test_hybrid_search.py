@@ -0,0 +1,53 @@
+import math
+
+import pytest
+
+np = pytest.importorskip("numpy")
+hybrid_search = pytest.importorskip("hybrid_search")
+from scipy.sparse import csr_matrix
+
+
+def clustered_vectors(n=5000, dim=32, clusters=40, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim))
+    vectors = centers[rng.integers(0, clusters, n)] + 0.5 * rng.normal(size=(n, dim))
+    queries = centers[rng.integers(0, clusters, 50)] + 0.5 * rng.normal(size=(50, dim))
+    return hybrid_search._normalize_rows(vectors).astype(np.float32), hybrid_search._normalize_rows(queries).astype(np.float32)
+
+
+def ivf_top(index, queries, k, nprobe):
+    top = list()
+    for candidates, sims in index.search(queries, nprobe):
+        top.append(set(candidates[np.argsort(-sims)[:k]].tolist()))
+    return top
+
+
+def test_bm25_matrix_matches_formula():
+    counts = np.array([[2, 0, 1], [0, 1, 0], [1, 1, 3]], dtype=np.float64)
+    bm25 = hybrid_search.bm25_matrix(csr_matrix(counts), k1=1.5, b=0.75).toarray()
+    lengths = counts.sum(axis=1)
+    for d in range(3):
+        for t in range(3):
+            df = (counts[:, t] > 0).sum()
+            idf = math.log(1 + (3 - df + 0.5) / (df + 0.5))
+            tf = counts[d, t]
+            expected = idf * tf * 2.5 / (tf + 1.5 * (0.25 + 0.75 * lengths[d] / lengths.mean()))
+            assert bm25[d, t] == pytest.approx(expected, rel=1e-5)
+
+
+def test_ivf_recall():
+    vectors, queries = clustered_vectors()
+    index = hybrid_search.IVFIndex.build(vectors)
+    exact = [set(np.argsort(-(vectors @ _q))[:10].tolist()) for _q in queries]
+    approx = ivf_top(index, queries, 10, nprobe=hybrid_search.IVF_NPROBE)
+    recall = np.mean([len(_a & _e) / 10 for _a, _e in zip(approx, exact)])
+    assert recall >= 0.9
+    # probing every list is exact
+    assert ivf_top(index, queries, 10, nprobe=len(index.centroids)) == exact
+
+
+def test_ivf_lists_partition_the_vectors():
+    vectors, _ = clustered_vectors(n=1000)
+    index = hybrid_search.IVFIndex.build(vectors)
+    assert sorted(index.order.tolist()) == list(range(1000))
+    assert index.offsets[0] == 0 and index.offsets[-1] == 1000
@@ -0,0 +1,176 @@
+import os
+import sys
+import time
+import itertools
+import threading
+
+import pytest
+
+mlesolver = pytest.importorskip("mlesolver")
+
+
+def test_suppress_stdout_only_silences_calling_thread(capsys):
+    entered, release = threading.Event(), threading.Event()
+
+    def candidate():
+        with mlesolver.suppress_stdout():
+            print("candidate noise")
+            entered.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=candidate)
+    thread.start()
+    entered.wait(5)
+    print("main thread line")
+    release.set()
+    thread.join()
+    out = capsys.readouterr().out
+    assert "main thread line" in out
+    assert "candidate noise" not in out
+    assert not isinstance(sys.stdout, mlesolver._ThreadStdout)
+
+
+def test_suppress_stdout_nested():
+    with mlesolver.suppress_stdout():
+        with mlesolver.suppress_stdout():
+            assert sys.stdout.suppressed()
+        assert sys.stdout.suppressed()
+    assert not isinstance(sys.stdout, mlesolver._ThreadStdout)
+
+
+def test_pipeline_with_two_workers_keeps_main_thread_output(monkeypatch, capsys):
+    def fake_execute_code(code, setup_code=None, cwd=None):
+        print("candidate execution noise")
+        time.sleep(0.05)
+        return "accuracy 0.9"
+
+    monkeypatch.setattr(mlesolver, "execute_code", fake_execute_code)
+    monkeypatch.setattr(mlesolver, "query_model", lambda **kwargs: "```REPLACE\nprint('accuracy')\n```")
+    solver = mlesolver.MLESolver("x = 1", llm_str="offline", fanout=2)
+    solver.model = "offline"
+    solver.commands = [mlesolver.Edit(solver.memo), mlesolver.Replace(solver.memo)]
+    solver.best_codes = [(["print(0)"], 0.1, "0")]
+    monkeypatch.setattr(solver, "system_prompt", lambda commands=True: "system")
+    monkeypatch.setattr(solver, "score_code", lambda code_lines, code_return: (0.5, "score 0.5", True))
+    candidates = 0
+    for _, _, (cmd_str, _, _, _, score) in solver.run_pipeline():
+        # printed by the main thread while the other worker may still be executing a candidate
+        print(f"$$$ Score: {score}")
+        candidates += 1
+    out = capsys.readouterr().out
+    assert candidates > solver.min_gen_trials
+    assert out.count("$$$ Score: 0.5") == candidates
+    assert "Pipeline occupancy" in out and "proposals discarded" in out
+    assert "candidate execution noise" not in out
+    assert not isinstance(sys.stdout, mlesolver._ThreadStdout)
+
+
+def test_pipeline_copies_the_figures_of_the_kept_candidate(monkeypatch, tmp_path):
+    proposals = itertools.count(1)
+    cwds = set()
+
+    def fake_execute_code(code, setup_code=None, cwd=None):
+        cwds.add(cwd)
+        with open(os.path.join(cwd, "Figure_1.png"), "w") as f:
+            f.write(code)
+        if code == "print(1)":
+            with open(os.path.join(cwd, "Figure_2.png"), "w") as f:
+                f.write(code)
+        time.sleep(0.02)
+        return code
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "Figure_2.png").write_text("figure of an earlier step")
+    monkeypatch.setattr(mlesolver, "execute_code", fake_execute_code)
+    monkeypatch.setattr(mlesolver, "query_model", lambda **kwargs: f"```REPLACE\nprint({next(proposals)})\n```")
+    solver = mlesolver.MLESolver("x = 1", llm_str="offline", fanout=2)
+    solver.model = "offline"
+    solver.commands = [mlesolver.Edit(solver.memo), mlesolver.Replace(solver.memo)]
+    solver.best_codes = [(["print(0)"], 0.1, "0")]
+    monkeypatch.setattr(solver, "system_prompt", lambda commands=True: "system")
+    # later proposals score higher, except every third one
+    monkeypatch.setattr(solver, "score_code", lambda code_lines, code_return: (
+        (-1 if int(code_return[6:-1]) % 3 == 0 else int(code_return[6:-1])), "score", True))
+    kept, top_score = None, None
+    for _, _, (_, code_lines, _, _, score) in solver.run_pipeline():
+        if top_score is None or score > top_score:
+            kept, top_score = code_lines, score
+    assert (tmp_path / "Figure_1.png").read_text() == "\n".join(kept)
+    # figures the kept candidate did not write are not left over from an earlier step or candidate
+    assert not (tmp_path / "Figure_2.png").exists()
+    assert len(cwds) == 2 and not any(os.path.exists(_cwd) for _cwd in cwds)
+
+
+def test_await_reflection_does_not_hold_the_history_lock():
+    solver = mlesolver.MLESolver("x = 1", llm_str="offline")
+    release = threading.Event()
+    solver._reflection = solver._reflect_executor.submit(lambda: release.wait(5) and "insights")
+    waiter = threading.Thread(target=solver.await_reflection)
+    waiter.start()
+    time.sleep(0.05)
+    # another proposal can read the history while the reflection is still running
+    assert solver._history_lock.acquire(timeout=1)
+    solver._history_lock.release()
+    release.set()
+    waiter.join()
+    assert solver.code_reflect == "insights" and solver._reflection is None
+
+
+def test_candidate_memo_key_ignores_formatting_and_comments():
+    key = mlesolver.CandidateMemo.key("x = 1\nprint(x)", "data = 0")
+    assert key == mlesolver.CandidateMemo.key("x=1  # one\n\nprint( x )\n", "data = 0")
+    assert key != mlesolver.CandidateMemo.key("x = 2\nprint(x)", "data = 0")
+    assert key != mlesolver.CandidateMemo.key("x = 1\nprint(x)", "data = 1")
+
+
+def test_candidate_memo_computes_once_for_concurrent_requests():
+    memo = mlesolver.CandidateMemo()
+    calls = list()
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.1)
+        return "output"
+
+    threads = [threading.Thread(target=memo.get_or_compute, args=("exec", "key", compute)) for _ in range(4)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert len(calls) == 1
+    assert memo.summary()["exec_hits"] == 3
+
+
+def test_candidate_memo_does_not_keep_uncacheable_results_or_errors():
+    memo = mlesolver.CandidateMemo()
+    results = iter(["timeout", "output"])
+    assert memo.get_or_compute("exec", "key", lambda: next(results), cacheable=lambda r: r != "timeout") == "timeout"
+    assert memo.get_or_compute("exec", "key", lambda: next(results), cacheable=lambda r: r != "timeout") == "output"
+
+    def fail():
+        raise ValueError("crash")
+
+    with pytest.raises(ValueError):
+        memo.get_or_compute("score", "key", fail)
+    assert memo.get_or_compute("score", "key", lambda: (0.5, "", True)) == (0.5, "", True)
+
+
+def test_score_code_memoizes_per_model_and_reruns_the_cascade(monkeypatch):
+    calls = list()
+
+    def fake_get_score(plan, code, code_return, model_str, attempts=3, openai_api_key=None):
+        calls.append(model_str)
+        score = 0.5 if model_str == "cheap" else 0.6
+        return score, f"score {score}", True
+
+    monkeypatch.setattr(mlesolver, "_get_score", fake_get_score)
+    monkeypatch.setattr(mlesolver.score_cascade, "SCORE_CASCADE", mlesolver.score_cascade.ScoreCascade("cheap", margin=0.1))
+    solver = mlesolver.MLESolver("x = 1", llm_str="expensive")
+    solver.best_codes = [(["print(0)"], 0.9, "0")]
+    # far below the best, the cheap score is trusted
+    assert solver.score_code(["print(1)"], "1")[0] == 0.5
+    solver.best_codes = [(["print(0)"], 0.55, "0")]
+    # same code near a lower best escalates, the cheap score is reused
+    assert solver.score_code(["print(1)"], "1")[0] == 0.6
+    assert calls == ["cheap", "expensive"]
+    # the same code with another output is scored again
+    solver.score_code(["print(1)"], "2")
+    assert calls == ["cheap", "expensive", "cheap", "expensive"]
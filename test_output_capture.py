@@ -0,0 +1,73 @@
+import output_capture
+from output_capture import BoundedCapture, collapse_carriage_returns, log_tail
+
+
+def test_short_output_is_kept_whole():
+    capture = BoundedCapture(max_len=100)
+    capture.write("hello\n")
+    capture.write("world\n")
+    assert capture.getvalue() == "hello\nworld\n"
+
+
+def test_long_output_keeps_head_and_tail():
+    capture = BoundedCapture(max_len=100)
+    text = "".join(f"line {_i}\n" for _i in range(1000))
+    for line in text.splitlines(keepends=True):
+        capture.write(line)
+    value = capture.getvalue()
+    head, tail = value.split("\n[... ")[0], value.split(" ...]\n")[-1]
+    assert head == text[:30]
+    assert tail == text[-70:]
+    assert f"{len(text) - 100} characters of output elided" in value
+
+
+def test_head_and_tail_from_a_single_large_write():
+    capture = BoundedCapture(max_len=10)
+    capture.write("abcdefghijklmnopqrstuvwxyz")
+    assert capture.getvalue().startswith("abc\n[... 16 characters")
+    assert capture.getvalue().endswith(" ...]\ntuvwxyz")
+
+
+def test_memory_stays_bounded():
+    capture = BoundedCapture(max_len=1000)
+    for _ in range(100000):
+        capture.write("x" * 10)
+    assert capture.head_size == 300
+    assert capture.tail_size < 700 + 10
+    assert capture.total == 1000000
+
+
+def test_unbounded_capture():
+    capture = BoundedCapture(max_len=None)
+    capture.write("a" * 5000)
+    assert capture.getvalue() == "a" * 5000
+
+
+def test_carriage_returns_are_collapsed():
+    assert collapse_carriage_returns("10%\r50%\r100%\ndone") == "100%\ndone"
+    capture = BoundedCapture(max_len=100)
+    capture.write("epoch 1\r")
+    capture.write("epoch 2\n")
+    assert capture.getvalue() == "epoch 2\n"
+
+
+def test_full_output_is_logged(tmp_path):
+    path = str(tmp_path / "run.log")
+    capture = BoundedCapture(max_len=20, log_path=path)
+    text = "".join(f"line {_i}\n" for _i in range(100))
+    capture.write(text)
+    capture.close_log()
+    assert open(path).read() == text
+    assert path in capture.getvalue()
+    assert log_tail(path, 8) == "line 99\n"
+    assert log_tail(str(tmp_path / "missing.log"), 8) == ""
+
+
+def test_log_is_truncated(tmp_path, monkeypatch):
+    monkeypatch.setattr(output_capture, "OUTPUT_LOG_MAX_BYTES", 50)
+    path = str(tmp_path / "run.log")
+    capture = BoundedCapture(max_len=20, log_path=path)
+    for _ in range(10):
+        capture.write("0123456789")
+    capture.close_log()
+    assert open(path).read() == "0123456789" * 5 + "\n[log truncated]\n"
@@ -0,0 +1,74 @@
+import pytest
+
+from preflight import banned_pattern_error, bound_names, preflight_check
+
+
+@pytest.mark.parametrize("code", [
+    "import os\nprint(os.getcwd())",
+    # names bound later, in other scopes or by the setup code are not undefined
+    "def f():\n    return g()\ndef g():\n    return 1\nprint(f())",
+    "class A:\n    x = 1\n    def m(self):\n        return self.x\nprint(A().m())",
+    "print([y for y in range(3)])",
+    "try:\n    pass\nexcept Exception as err:\n    print(err)",
+    "with open(__file__) as fh:\n    print(fh)",
+    "import numpy.linalg\nprint(numpy.linalg)",
+    "def f():\n    global counter\n    counter = 1\nf()\nprint(counter)",
+    "lam = lambda v, *args, **kw: (v, args, kw)\nprint(lam(1))",
+    # optional imports are guarded
+    "try:\n    import not_a_real_module_xyz\nexcept ImportError:\n    not_a_real_module_xyz = None",
+    # relative imports are not resolved
+    "from . import sibling",
+    # a star import can define anything
+    "from os.path import *\nprint(join('a', 'b'))",
+    "print(__name__, __file__)",
+])
+def test_valid_code_passes(code):
+    assert preflight_check(code) is None
+
+
+def test_setup_code_names_are_defined():
+    assert preflight_check("print(train_data)", setup_code="train_data = 1") is None
+    assert preflight_check("print(train_data)") == "[CODE EXECUTION ERROR]: name 'train_data' is not defined (line 1)"
+
+
+@pytest.mark.skipif(not hasattr(__import__("ast"), "MatchAs"), reason="match statements need Python 3.10")
+def test_match_captures_are_bound():
+    code = "value = {'a': 1}\nmatch value:\n    case {'a': x, **rest}:\n        print(x, rest)\n    case [first, *others]:\n        print(first, others)\n    case other:\n        print(other)"
+    assert preflight_check(code) is None
+
+
+def test_syntax_error_is_reported_with_line():
+    error = preflight_check("x = 1\nif x\n    print(x)")
+    assert error.startswith("[CODE EXECUTION ERROR]:") and "line 2" in error
+
+
+def test_compile_only_errors_are_reported():
+    assert "outside function" in preflight_check("return 1")
+
+
+def test_undefined_name_is_reported_once():
+    error = preflight_check("print(acuracy)\nprint(acuracy)")
+    assert error == "[CODE EXECUTION ERROR]: name 'acuracy' is not defined (line 1)"
+
+
+def test_missing_module_is_reported():
+    error = preflight_check("import os\nimport not_a_real_module_xyz\nfrom not_a_real_module_xyz import thing")
+    assert error == "[CODE EXECUTION ERROR]: No module named 'not_a_real_module_xyz' (line 2)"
+
+
+def test_diagnostics_are_sorted_by_line():
+    error = preflight_check("import not_a_real_module_xyz\nprint(undefined_thing)")
+    assert error.split("\n") == ["[CODE EXECUTION ERROR]: No module named 'not_a_real_module_xyz' (line 1)",
+                                 "[CODE EXECUTION ERROR]: name 'undefined_thing' is not defined (line 2)"]
+
+
+def test_banned_patterns():
+    assert banned_pattern_error("exit(0)") is not None
+    assert preflight_check("print(1)", setup_code="ds = load_dataset('pubmed')") is not None
+    assert banned_pattern_error("print('fine')") is None
+
+
+def test_bound_names_star_import():
+    import ast
+    assert bound_names(ast.parse("from math import *")) is None
+    assert {"a", "b", "f", "arg"} <= bound_names(ast.parse("a = b = 1\ndef f(arg): pass"))
@@ -0,0 +1,54 @@
+import time
+
+import response_cache
+from response_cache import ResponseCache
+
+
+def test_key_normalization():
+    key = ResponseCache.make_key("gpt-4o", "system", "prompt", 0, stop="```")
+    assert key == ResponseCache.make_key("gpt-4o", "system", "prompt", 0.0, stop="```", seed=None)
+    assert key != ResponseCache.make_key("gpt-4o", "system", "prompt", 0.5, stop="```")
+    assert key != ResponseCache.make_key("gpt-4o-mini", "system", "prompt", 0, stop="```")
+    assert ResponseCache.make_key("gpt-4o", "s", "p", None, a=1, b=2) == ResponseCache.make_key("gpt-4o", "s", "p", None, b=2, a=1)
+
+
+def test_policies():
+    assert not ResponseCache(policy="off").should_cache(0.0)
+    assert ResponseCache(policy="deterministic").should_cache(None)
+    assert not ResponseCache(policy="deterministic").should_cache(0.7)
+    assert ResponseCache(policy="all").should_cache(1.0)
+
+
+def test_get_put_and_expiry(tmp_path):
+    cache = ResponseCache(path=str(tmp_path / "cache.sqlite"), max_age=0.2)
+    assert cache.get("k") is None
+    cache.put("k", "gpt-4o", "answer")
+    assert cache.get("k") == "answer"
+    time.sleep(0.3)
+    assert cache.get("k") is None
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 2
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = ResponseCache(path=str(tmp_path / "cache.sqlite"), max_bytes=250)
+    for i in range(2):
+        cache.put(f"k{i}", "gpt-4o", "x" * 100)
+        time.sleep(0.01)
+    # k0 is the oldest, but was just used
+    assert cache.get("k0") is not None
+    cache.put("k2", "gpt-4o", "x" * 100)
+    assert cache.get("k1") is None
+    assert cache.get("k0") is not None and cache.get("k2") is not None
+    assert cache.evictions == 1
+
+
+def test_running_total_tracks_replacements(tmp_path, monkeypatch):
+    monkeypatch.setattr(response_cache, "EVICT_INTERVAL", 1000)
+    cache = ResponseCache(path=str(tmp_path / "cache.sqlite"))
+    cache.put("k", "gpt-4o", "x" * 100)
+    cache.put("k", "gpt-4o", "x" * 40)
+    cache.put("other", "gpt-4o", "é" * 10)
+    total = cache._conn.execute("SELECT SUM(size) FROM responses").fetchone()[0]
+    assert cache._total_bytes == total == 60
+    cache.clear()
+    assert cache._total_bytes == 0
@@ -0,0 +1,134 @@
+import time
+import random
+import asyncio
+import email.utils
+
+import pytest
+
+from retry_scheduler import (CircuitBreaker, CircuitOpenError, ProviderAdmission, TokenBucket, backoff_delay,
+                             classify_error, retry_after, retry_delay)
+
+
+class Response:
+    def __init__(self, headers) -> None:
+        self.headers = headers
+
+
+class APIError(Exception):
+    def __init__(self, status_code=None, headers=None) -> None:
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+        self.response = Response(headers) if headers is not None else None
+
+
+class APIConnectionError(Exception):
+    pass
+
+
+class ReadTimeout(Exception):
+    pass
+
+
+@pytest.mark.parametrize("error, kind", [
+    (APIError(429), "rate_limit"),
+    (APIError(500), "server"),
+    (APIError(503), "server"),
+    (APIError(400), "fatal"),
+    (APIError(401), "fatal"),
+    (APIError(404), "fatal"),
+    (APIConnectionError(), "server"),
+    (ReadTimeout(), "server"),
+    (CircuitOpenError("openai", 3.0), "circuit_open"),
+    (ValueError("could not parse"), "other"),
+    (APIError(409), "other"),
+])
+def test_classify_error(error, kind):
+    assert classify_error(error) == kind
+
+
+def test_retry_after_headers():
+    assert retry_after(APIError(429, {"retry-after-ms": "1500"})) == 1.5
+    assert retry_after(APIError(429, {"retry-after": "7"})) == 7.0
+    date = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 25 <= retry_after(APIError(429, {"retry-after": date})) <= 31
+    assert retry_after(APIError(429, {"retry-after": "soon-ish"})) is None
+    assert retry_after(APIError(429, {})) is None
+    assert retry_after(APIError(429)) is None
+
+
+def test_backoff_is_jittered_and_capped():
+    random.seed(0)
+    for attempt in range(12):
+        delays = [backoff_delay(attempt, base=1.0, cap=60.0) for _ in range(50)]
+        assert all(0.0 <= _d <= min(60.0, 2 ** attempt) for _d in delays)
+    assert len(set(round(backoff_delay(5), 6) for _ in range(20))) > 1
+
+
+def test_retry_delay_prefers_the_server_delay():
+    assert 10.0 <= retry_delay(APIError(429, {"retry-after": "10"}), "rate_limit", attempt=0) <= 11.0
+    assert retry_delay(CircuitOpenError("openai", 4.0), "circuit_open", attempt=3) == 4.0
+    assert retry_delay(APIError(500), "server", attempt=2, base=1.0) <= 4.0
+
+
+def test_circuit_breaker_opens_probes_and_closes(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker(failure_threshold=2, cooldown=10.0)
+    breaker.record_failure()
+    breaker.check("openai")
+    breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.check("openai")
+    now[0] += 11.0
+    # half-open: one probe, the next caller waits for its outcome
+    breaker.check("openai")
+    with pytest.raises(CircuitOpenError):
+        breaker.check("openai")
+    breaker.record_success()
+    breaker.check("openai")
+    assert breaker.failures == 0
+
+
+def test_failed_probe_reopens_the_circuit(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker(failure_threshold=1, cooldown=10.0)
+    breaker.record_failure()
+    now[0] += 11.0
+    breaker.check("openai")
+    breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.check("openai")
+
+
+def test_answer_to_probe_closes_the_circuit_unless_server_error(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    admission = ProviderAdmission("openai")
+    for _ in range(admission.breaker.failure_threshold):
+        admission.record_failure("server")
+    now[0] += admission.breaker.cooldown + 1.0
+    admission.breaker.check("openai")
+    # a 400 is an answer, the provider is up
+    admission.record_failure("fatal")
+    admission.breaker.check("openai")
+    assert admission.breaker.opened_at is None
+
+
+def test_token_bucket_waits_for_refill():
+    async def run():
+        bucket = TokenBucket(per_minute=600)
+        await bucket.acquire(600)
+        start = time.monotonic()
+        await bucket.acquire(2)
+        return time.monotonic() - start
+
+    assert 0.15 <= asyncio.run(run()) <= 1.0
+
+
+def test_token_bucket_refund_is_capped():
+    bucket = TokenBucket(per_minute=60)
+    bucket.adjust(-1000)
+    assert bucket.tokens == bucket.capacity
+    bucket.adjust(100)
+    assert bucket.tokens < 0
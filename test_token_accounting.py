@@ -0,0 +1,55 @@
+import pytest
+
+tiktoken = pytest.importorskip("tiktoken")
+import token_accounting
+from token_accounting import TokenAccounting, accounting_scope, encoder_for, usage_from_response
+
+
+@pytest.fixture
+def known_models(monkeypatch):
+    # only gpt-4o is registered, tiktoken would download the real encodings
+    encodings = {"gpt-4o": object()}
+
+    def encoding_for_model(model_str):
+        if model_str not in encodings:
+            raise KeyError(model_str)
+        return encodings[model_str]
+
+    monkeypatch.setattr(tiktoken, "encoding_for_model", encoding_for_model)
+    encoder_for.cache_clear()
+    yield encodings
+    encoder_for.cache_clear()
+
+
+def test_unknown_model_is_reported_once(capsys, known_models):
+    assert encoder_for("my-local-llama") is known_models["gpt-4o"]
+    encoder_for("my-local-llama")
+    assert capsys.readouterr().out.count("my-local-llama") == 1
+
+
+def test_known_families_fall_back_silently(capsys, known_models):
+    for model in ["claude-3.5-sonnet", "o1-mini", "offline"]:
+        assert encoder_for(model) is known_models["gpt-4o"]
+    assert capsys.readouterr().out == ""
+
+
+def test_usage_from_response_counts_anthropic_cache_tokens():
+    class Usage:
+        input_tokens, output_tokens, cache_read_input_tokens, cache_creation_input_tokens = 10, 5, 100, 20
+
+    class Response:
+        usage = Usage()
+
+    assert usage_from_response(Response()) == (130, 5, 100)
+
+
+def test_record_attributes_to_scope():
+    accounting = TokenAccounting()
+    with accounting_scope(phase="data preparation", agent="PhDStudentAgent"):
+        accounting.record("gpt-4o", 1000, 100)
+    accounting.record("gpt-4o", 1000, 100, price_factor=token_accounting.BATCH_PRICE_FACTOR)
+    summary = accounting.summary()
+    assert summary["model"]["gpt-4o"]["calls"] == 2
+    assert summary["phase"]["data preparation"]["in"] == 1000
+    assert summary["agent"]["PhDStudentAgent"]["out"] == 100
+    assert accounting.cost() == pytest.approx(1.5 * (1000 * 2.5 + 100 * 10.0) / 1000000)
@@ -0,0 +1,125 @@
+import shutil
+
+import pytest
+
+np = pytest.importorskip("numpy")
+datasets = pytest.importorskip("datasets")
+tools = pytest.importorskip("tools")
+import split_metadata
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics.pairwise import linear_kernel
+
+QUERIES = ["image classification of animals", "sentiment of movie reviews", "speech recognition audio", "medical question answering"]
+
+
+def synthetic_metadata(size=400, seed=0):
+    rng = np.random.default_rng(seed)
+    topics = [["image", "classification", "animals", "photos", "cats", "dogs"],
+              ["sentiment", "movie", "reviews", "text", "opinions", "polarity"],
+              ["speech", "recognition", "audio", "spoken", "transcripts", "asr"],
+              ["medical", "question", "answering", "clinical", "biomedical", "qa"]]
+    filler = [f"word{_i}" for _i in range(300)]
+    descriptions, likes, downloads = list(), list(), list()
+    for i in range(size):
+        topic = topics[i % len(topics)]
+        words = list(rng.choice(topic, rng.integers(1, 5))) + list(rng.choice(filler, rng.integers(3, 20)))
+        descriptions.append(" ".join(words) if i % 37 != 0 else " ")
+        likes.append(None if i % 23 == 0 else int(rng.integers(0, 50)))
+        downloads.append(None if i % 29 == 0 else int(rng.integers(0, 5000)))
+    return datasets.Dataset.from_dict({"id": [f"user/dataset-{_i}" for _i in range(size)], "description": descriptions,
+                                       "likes": likes, "downloads": downloads})
+
+
+@pytest.fixture(autouse=True)
+def offline_split_metadata(monkeypatch, tmp_path):
+    # split information is answered from an empty cache, without the hub
+    monkeypatch.setattr(split_metadata, "_store", split_metadata.SplitMetadataStore(cache_path=str(tmp_path / "splits.json"), offline=True))
+
+
+def ids(results):
+    return [[_d["id"] for _d in _r] for _r in results]
+
+
+def test_filter_matches_per_row_filter():
+    ds = synthetic_metadata()
+    indices, likes, downloads = tools.filter_hf_datasets(ds.data, 3, 50)
+    expected = [_i for _i, _d in enumerate(ds) if (_d["likes"] or 0) >= 3 and (_d["downloads"] or 0) >= 50 and _d["description"].strip()]
+    assert list(indices) == expected
+    assert list(likes) == [ds[_i]["likes"] for _i in expected]
+    assert list(downloads) == [ds[_i]["downloads"] for _i in expected]
+
+
+def test_saved_index_gives_identical_rankings(tmp_path, monkeypatch):
+    ds = synthetic_metadata()
+    built = tools.HFDataSearch(like_thr=3, dwn_thr=50, index_dir=str(tmp_path), source=ds)
+    assert built.index_saved
+
+    def no_rebuild(self):
+        raise AssertionError("the saved index was not loaded")
+
+    monkeypatch.setattr(tools.HFDataSearch, "_build_index", no_rebuild)
+    loaded = tools.HFDataSearch(like_thr=3, dwn_thr=50, index_dir=str(tmp_path), source=ds)
+    for weights in [dict(), dict(sim_w=0.5, like_w=0.3, dwn_w=0.2)]:
+        assert ids(loaded.retrieve_many(QUERIES, N=10, **weights)) == ids(built.retrieve_many(QUERIES, N=10, **weights))
+
+
+def test_retrieve_ds_equals_retrieve_many(tmp_path):
+    search = tools.HFDataSearch(like_thr=3, dwn_thr=50, index_dir=str(tmp_path), source=synthetic_metadata())
+    many = search.retrieve_many(QUERIES, N=7, sim_w=0.7, like_w=0.2, dwn_w=0.1)
+    for query, results in zip(QUERIES, many):
+        assert search.retrieve_ds(query, N=7, sim_w=0.7, like_w=0.2, dwn_w=0.1) == results
+
+
+def test_ranking_matches_tfidf_linear_kernel(tmp_path):
+    # the scores of the original retrieve_ds, fitted and transformed with scikit-learn
+    search = tools.HFDataSearch(like_thr=3, dwn_thr=50, index_dir=str(tmp_path), source=synthetic_metadata())
+    descriptions = search.ds["description"]
+    vectorizer = TfidfVectorizer()
+    vectors = vectorizer.fit_transform(descriptions)
+    for query, results in zip(QUERIES, search.retrieve_many(QUERIES, N=10)):
+        scores = linear_kernel(vectorizer.transform([query]), vectors).flatten()
+        returned = [scores[descriptions.index(_d["description"])] for _d in results]
+        assert np.allclose(returned, np.sort(scores)[::-1][:10])
+
+
+def test_hybrid_ranking_survives_save_and_load(tmp_path):
+    ds = synthetic_metadata()
+    built = tools.HFDataSearch(like_thr=3, dwn_thr=50, index_dir=str(tmp_path), source=ds)
+    weights = dict(sim_w=0.0, bm25_w=0.5, lsa_w=0.5)
+    expected = ids(built.retrieve_many(QUERIES, N=10, **weights))
+    assert built.hybrid
+    loaded = tools.HFDataSearch(like_thr=3, dwn_thr=50, index_dir=str(tmp_path), source=ds)
+    assert ids(loaded.retrieve_many(QUERIES, N=10, **weights)) == expected
+    # loaded from the files, not rebuilt
+    assert isinstance(loaded.hybrid.lsa_columns, np.memmap)
+    assert all(_r[0].startswith("user/dataset-") for _r in expected)
+
+
+def test_hybrid_index_of_another_snapshot_is_not_loaded(tmp_path):
+    ds = synthetic_metadata()
+    built = tools.HFDataSearch(like_thr=3, dwn_thr=50, index_dir=str(tmp_path), source=ds)
+    built.retrieve_many(QUERIES, N=5, bm25_w=1.0)
+    stale = tmp_path / "stale"
+    shutil.copytree(built.index_path, stale)
+    other = tools.HFDataSearch(like_thr=3, dwn_thr=50, index_dir=str(tmp_path), source=synthetic_metadata(seed=1))
+    assert other.fingerprint != built.fingerprint
+    # hybrid files of the old snapshot next to the TF-IDF index of the new one
+    for path in stale.iterdir():
+        if path.name not in ("meta.json", "metadata") and not (tmp_path / "v1_like3_dwn50" / path.name).exists():
+            shutil.copy(path, other.index_path)
+    assert tools.HybridIndex.load(other.index_path, other.fingerprint, other.description_vectors.shape) is None
+    assert tools.HybridIndex.load(other.index_path, built.fingerprint, built.description_vectors.shape) is None
+    # rebuilt for the new snapshot, the directory now holds the new TF-IDF index
+    other.retrieve_many(QUERIES, N=5, bm25_w=1.0)
+    assert tools.HybridIndex.load(other.index_path, other.fingerprint, other.description_vectors.shape) is not None
+
+
+def test_hybrid_index_is_not_saved_next_to_a_stale_index(tmp_path, monkeypatch):
+    ds = synthetic_metadata()
+    tools.HFDataSearch(like_thr=3, dwn_thr=50, index_dir=str(tmp_path), source=ds)
+    monkeypatch.setattr(tools.HFDataSearch, "_save_index", lambda self, fingerprint: False)
+    unsaved = tools.HFDataSearch(like_thr=3, dwn_thr=50, index_dir=str(tmp_path), source=synthetic_metadata(seed=1))
+    assert not unsaved.index_saved
+    unsaved.retrieve_many(QUERIES, N=5, bm25_w=1.0)
+    assert unsaved.hybrid
+    assert not (tmp_path / "v1_like3_dwn50" / "hybrid.json").exists()
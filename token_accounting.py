@@ -0,0 +1,172 @@
+import threading
+import contextvars
+from functools import lru_cache
+from contextlib import contextmanager
+
+
+COSTMAP_IN = {
+    "gpt-4o": 2.50 / 1000000,
+    "gpt-4o-mini": 0.150 / 1000000,
+    "o1-preview": 15.00 / 1000000,
+    "o1-mini": 3.00 / 1000000,
+    "claude-3.5-sonnet": 3.00 / 1000000,
+}
+COSTMAP_OUT = {
+    "gpt-4o": 10.00/ 1000000,
+    "gpt-4o-mini": 0.6 / 1000000,
+    "o1-preview": 60.00 / 1000000,
+    "o1-mini": 12.00 / 1000000,
+    "claude-3.5-sonnet": 12.00 / 1000000,
+}
+
+# provider batch endpoints are billed at half the list price
+BATCH_PRICE_FACTOR = 0.5
+# model families approximated with the gpt-4o tokenizer without a warning
+ENCODER_FALLBACK_FAMILIES = ("gpt-", "o1", "o3", "claude", "offline")
+
+_phase = contextvars.ContextVar("accounting_phase", default=None)
+_agent = contextvars.ContextVar("accounting_agent", default=None)
+
+
+@contextmanager
+def accounting_scope(phase=None, agent=None):
+    """
+    Attribute LLM calls made inside this block to a phase and/or agent
+    @param phase: (str) research phase, e.g. "data preparation"
+    @param agent: (str) agent name, e.g. "PhDStudentAgent"
+    """
+    tokens = list()
+    if phase is not None: tokens.append((_phase, _phase.set(phase)))
+    if agent is not None: tokens.append((_agent, _agent.set(agent)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+def set_accounting_phase(phase):
+    """
+    Attribute all following LLM calls in this context to a phase
+    @param phase: (str) research phase
+    @return: None
+    """
+    _phase.set(phase)
+
+
+def current_scope():
+    """
+    @return: (tuple) phase and agent of the calling context
+    """
+    return _phase.get(), _agent.get()
+
+
+@lru_cache(maxsize=None)
+def encoder_for(model_str):
+    """
+    Memoized, lazily loaded tiktoken encoder for a model
+    @param model_str: (str) model name
+    @return: (tiktoken.Encoding) encoder, the gpt-4o one for models tiktoken does not know
+    """
+    import tiktoken
+    try:
+        return tiktoken.encoding_for_model(model_str)
+    except KeyError:
+        # o1 and claude models are not registered with tiktoken, gpt-4o counts are close enough for them
+        if not model_str.startswith(ENCODER_FALLBACK_FAMILIES):
+            # memoized, so printed once per model
+            print(f"No tokenizer is known for model {model_str}, its token counts are approximated with the gpt-4o tokenizer.")
+        return tiktoken.encoding_for_model("gpt-4o")
+
+
+def count_text_tokens(text, model_str):
+    return len(encoder_for(model_str).encode(text))
+
+
+def usage_from_response(response):
+    """
+    Exact token counts from the provider usage fields
+    @param response: OpenAI completion or Anthropic message
+    @return: (tuple) (tokens in, tokens out, tokens in read from the provider prompt cache) or None if not reported
+    """
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return None
+    if getattr(usage, "prompt_tokens", None) is not None:
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = getattr(details, "cached_tokens", None) or 0
+        return usage.prompt_tokens, usage.completion_tokens, cached
+    if getattr(usage, "input_tokens", None) is not None:
+        # anthropic input_tokens excludes the tokens read from or written to the cache
+        cached = getattr(usage, "cache_read_input_tokens", None) or 0
+        created = getattr(usage, "cache_creation_input_tokens", None) or 0
+        return usage.input_tokens + cached + created, usage.output_tokens, cached
+    return None
+
+
+class TokenAccounting:
+    def __init__(self) -> None:
+        """
+        Thread-safe token counters per model, per phase and per agent
+        """
+        self._lock = threading.Lock()
+        self.by_model = dict()
+        self.by_phase = dict()
+        self.by_agent = dict()
+
+    @staticmethod
+    def _add(table, key, tokens_in, tokens_out, tokens_cached, cost):
+        if key not in table:
+            table[key] = {"in": 0, "out": 0, "cached": 0, "calls": 0, "cost": 0.0}
+        table[key]["in"] += tokens_in
+        table[key]["out"] += tokens_out
+        table[key]["cached"] += tokens_cached
+        table[key]["calls"] += 1
+        table[key]["cost"] += cost
+
+    def record(self, model_str, tokens_in, tokens_out, tokens_cached=0, phase=None, agent=None, price_factor=1.0):
+        """
+        Record the tokens used by one LLM call
+        @param model_str: (str) canonical model name
+        @param tokens_in: (int) prompt tokens
+        @param tokens_out: (int) completion tokens
+        @param tokens_cached: (int) prompt tokens served from the provider prompt cache
+        @param phase: (str) research phase, defaults to the current accounting scope
+        @param agent: (str) agent name, defaults to the current accounting scope
+        @param price_factor: (float) multiplier on the list price, e.g. BATCH_PRICE_FACTOR
+        @return: None
+        """
+        if phase is None: phase = _phase.get()
+        if agent is None: agent = _agent.get()
+        cost = price_factor * (COSTMAP_IN.get(model_str, 0.0) * tokens_in + COSTMAP_OUT.get(model_str, 0.0) * tokens_out)
+        with self._lock:
+            self._add(self.by_model, model_str, tokens_in, tokens_out, tokens_cached, cost)
+            if phase is not None: self._add(self.by_phase, phase, tokens_in, tokens_out, tokens_cached, cost)
+            if agent is not None: self._add(self.by_agent, agent, tokens_in, tokens_out, tokens_cached, cost)
+
+    def cost(self):
+        """
+        @return: (float) approximate cost in dollars of all recorded calls
+        """
+        with self._lock:
+            return sum([_c["cost"] for _c in self.by_model.values()])
+
+    def summary(self):
+        """
+        @return: (dict) copy of all counters
+        """
+        with self._lock:
+            return {
+                "model": {_k: dict(_v) for _k, _v in self.by_model.items()},
+                "phase": {_k: dict(_v) for _k, _v in self.by_phase.items()},
+                "agent": {_k: dict(_v) for _k, _v in self.by_agent.items()},
+            }
+
+    def reset(self):
+        with self._lock:
+            self.by_model.clear()
+            self.by_phase.clear()
+            self.by_agent.clear()
+
+
+TOKEN_ACCOUNTING = TokenAccounting()
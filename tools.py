@@ -1,62 +1,117 @@
 from utils import *
 
 import time
+import json
 import arxiv
+import shutil
 import os, re
 import io, sys
+import threading
 import numpy as np
+import pyarrow as pa
 import concurrent.futures
+import pyarrow.compute as pc
 from pypdf import PdfReader
-from datasets import load_dataset
-from psutil._common import bytes2human
-from datasets import load_dataset_builder
+from scipy.sparse import csr_matrix
+from datasets import load_dataset, load_from_disk
+import split_metadata
+from split_metadata import split_metadata_store
+from hybrid_search import HybridIndex
 from semanticscholar import SemanticScholar
-from sklearn.metrics.pairwise import linear_kernel
-from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.feature_extraction.text import TfidfVectorizer, CountVectorizer
 
 import traceback
 import concurrent.futures
+from code_executor import execution_pool, snapshot_executor, configure_code_executor
+from preflight import banned_pattern_error, preflight_check
+from profiler import new_profile_path, hotspot_table
+from output_capture import new_log_path, log_tail
+
+
+HF_DATASETS_SOURCE = "nkasmanoff/huggingface-datasets"
+# persisted search index, one per pair of thresholds
+HF_INDEX_DIR = os.path.join(os.path.expanduser("~"), ".cache", "agentlab", "hf_data_search")
+# how often a persisted index checks the source for a new snapshot
+HF_INDEX_CHECK_SECONDS = 7 * 24 * 3600
+HF_INDEX_VERSION = 1
+# default ranking weights: TF-IDF cosine, likes, downloads, BM25 and latent-semantic (LSA) similarity
+HF_SEARCH_WEIGHTS = {"sim_w": 1.0, "like_w": 0.0, "dwn_w": 0.0, "bm25_w": 0.0, "lsa_w": 0.0}
+
+
+def configure_hf_search(sim_w=1.0, like_w=0.0, dwn_w=0.0, bm25_w=0.0, lsa_w=0.0):
+    """
+    Default ranking weights of HFDataSearch, a positive bm25_w or lsa_w enables the hybrid ranking
+    @param sim_w: (float) weight of the TF-IDF cosine similarity
+    @param like_w: (float) weight of likes
+    @param dwn_w: (float) weight of downloads
+    @param bm25_w: (float) weight of the BM25 score
+    @param lsa_w: (float) weight of the latent-semantic similarity
+    @return: None
+    """
+    HF_SEARCH_WEIGHTS.update({"sim_w": sim_w, "like_w": like_w, "dwn_w": dwn_w, "bm25_w": bm25_w, "lsa_w": lsa_w})
+
+
+def filter_hf_datasets(table, like_thr, dwn_thr):
+    """
+    Vectorized filter of the huggingface datasets metadata: enough likes and downloads (missing counts are 0)
+    and a description that is not blank
+    @param table: (pyarrow.Table) metadata with likes, downloads and description columns
+    @param like_thr: (int) minimum likes
+    @param dwn_thr: (int) minimum downloads
+    @return: (tuple) indices of the kept rows, their likes and their downloads, as numpy arrays
+    """
+    likes = pc.fill_null(table.column("likes"), 0).to_numpy().astype(np.int64)
+    downloads = pc.fill_null(table.column("downloads"), 0).to_numpy().astype(np.int64)
+    mask = (likes >= like_thr) & (downloads >= dwn_thr)
+    descriptions = table.column("description")
+    if pa.types.is_string(descriptions.type) or pa.types.is_large_string(descriptions.type):
+        has_description = pc.greater(pc.utf8_length(pc.utf8_trim_whitespace(descriptions)), 0)
+        mask &= pc.fill_null(has_description, False).to_numpy(zero_copy_only=False)
+    else:
+        # e.g. a column that is entirely null
+        mask[:] = False
+    indices = np.flatnonzero(mask)
+    return indices, likes[indices], downloads[indices]
 
 
 class HFDataSearch:
-    def __init__(self, like_thr=3, dwn_thr=50) -> None:
+    def __init__(self, like_thr=3, dwn_thr=50, index_dir=None, source=None) -> None:
         """
-        Class for finding relevant huggingface datasets
+        Class for finding relevant huggingface datasets. The filtered metadata and the TF-IDF matrix are
+        persisted in memory-mappable files, so they are only built on first use or for a new source snapshot
         :param like_thr:
         :param dwn_thr:
+        :param index_dir: where the index is persisted, defaults to HF_INDEX_DIR
+        :param source: (Dataset) metadata to index instead of HF_DATASETS_SOURCE, e.g. for benchmarks
         """
         self.dwn_thr = dwn_thr
         self.like_thr = like_thr
-        self.ds = load_dataset("nkasmanoff/huggingface-datasets")["train"]
-
-        # Initialize lists to collect filtered data
-        filtered_indices = []
-        filtered_descriptions = []
-        filtered_likes = []
-        filtered_downloads = []
-
-        # Iterate over the dataset and filter based on criteria
-        for idx, item in enumerate(self.ds):
-            # Get likes and downloads, handling None values
-            likes = int(item['likes']) if item['likes'] is not None else 0
-            downloads = int(item['downloads']) if item['downloads'] is not None else 0
-
-            # Check if likes and downloads meet the thresholds
-            if likes >= self.like_thr and downloads >= self.dwn_thr:
-                # Check if the description is a non-empty string
-                description = item['description']
-                if isinstance(description, str) and description.strip():
-                    # Collect the data
-                    filtered_indices.append(idx)
-                    filtered_descriptions.append(description)
-                    filtered_likes.append(likes)
-                    filtered_downloads.append(downloads)
+        self.index_path = os.path.join(HF_INDEX_DIR if index_dir is None else index_dir, f"v{HF_INDEX_VERSION}_like{like_thr}_dwn{dwn_thr}")
+        # same tokenization as the TfidfVectorizer the index was fitted with
+        self.analyzer = TfidfVectorizer().build_analyzer()
+        self._source = source
+        # snapshot the index was built from, and whether index_path holds this very index
+        self.fingerprint = None
+        self.index_saved = False
+        # BM25 and LSA sides, built or loaded on the first hybrid search
+        self.hybrid = None
+        self._hybrid_lock = threading.Lock()
+        if not self._load_index():
+            self._build_index()
+
+    def _build_index(self):
+        self.ds = load_dataset(HF_DATASETS_SOURCE)["train"] if self._source is None else self._source
+        fingerprint = self.ds._fingerprint
+
+        # Filter on the Arrow columns, without materializing a dict per row
+        if self.ds._indices is not None:
+            self.ds = self.ds.flatten_indices()
+        filtered_indices, filtered_likes, filtered_downloads = filter_hf_datasets(self.ds.data, self.like_thr, self.dwn_thr)
 
         # Check if any datasets meet all criteria
-        if not filtered_indices:
+        if len(filtered_indices) == 0:
             print("No datasets meet the specified criteria.")
             self.ds = []
-            self.descriptions = []
             self.likes_norm = []
             self.downloads_norm = []
             self.description_vectors = None
@@ -64,19 +119,163 @@ class HFDataSearch:
 
         # Filter the datasets using the collected indices
         self.ds = self.ds.select(filtered_indices)
+        filtered_descriptions = self.ds["description"]
 
-        # Update descriptions, likes, and downloads
-        self.descriptions = filtered_descriptions
-        self.likes = np.array(filtered_likes)
-        self.downloads = np.array(filtered_downloads)
+        # Update likes and downloads
+        self.likes = filtered_likes
+        self.downloads = filtered_downloads
 
         # Normalize likes and downloads
         self.likes_norm = self._normalize(self.likes)
         self.downloads_norm = self._normalize(self.downloads)
 
         # Vectorize the descriptions
-        self.vectorizer = TfidfVectorizer()
-        self.description_vectors = self.vectorizer.fit_transform(self.descriptions)
+        vectorizer = TfidfVectorizer()
+        self.description_vectors = vectorizer.fit_transform(filtered_descriptions).tocsr()
+        self.vocabulary = vectorizer.vocabulary_
+        self.idf = vectorizer.idf_
+        self.fingerprint = fingerprint
+        self.index_saved = self._save_index(fingerprint)
+
+    def _save_index(self, fingerprint):
+        """
+        :return: (bool) whether the index was saved
+        """
+        tmp_path = f"{self.index_path}.tmp{os.getpid()}"
+        try:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            os.makedirs(tmp_path)
+            # Arrow files, memory-mapped again by load_from_disk
+            self.ds.save_to_disk(os.path.join(tmp_path, "metadata"))
+            arrays = {"data": self.description_vectors.data, "indices": self.description_vectors.indices, "indptr": self.description_vectors.indptr,
+                      "idf": self.idf, "likes": self.likes, "downloads": self.downloads}
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp_path, f"{name}.npy"), array)
+            terms = [None] * len(self.vocabulary)
+            for term, col in self.vocabulary.items():
+                terms[col] = term
+            # tokens never contain newlines
+            with open(os.path.join(tmp_path, "vocabulary.txt"), "w", encoding="utf-8") as f:
+                f.write("\n".join(terms))
+            with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+                json.dump({"version": HF_INDEX_VERSION, "like_thr": self.like_thr, "dwn_thr": self.dwn_thr, "fingerprint": fingerprint,
+                           "checked": time.time(), "shape": list(self.description_vectors.shape)}, f)
+            shutil.rmtree(self.index_path, ignore_errors=True)
+            os.replace(tmp_path, self.index_path)
+        except Exception as e:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            print(f"Could not save the dataset search index: {e}")
+            return False
+        return True
+
+    def _load_index(self):
+        """
+        Load the persisted index, checking the source for a new snapshot if the last check is too old
+        :return: (bool) whether the index was loaded
+        """
+        meta_path = os.path.join(self.index_path, "meta.json")
+        if not os.path.exists(meta_path):
+            return False
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta["version"] != HF_INDEX_VERSION or meta["like_thr"] != self.like_thr or meta["dwn_thr"] != self.dwn_thr:
+                return False
+            if self._source is not None or time.time() - meta["checked"] > HF_INDEX_CHECK_SECONDS:
+                source = self._source
+                # offline, the saved index is used as it is
+                if source is None and not split_metadata.SPLIT_METADATA_OFFLINE:
+                    try:
+                        source = load_dataset(HF_DATASETS_SOURCE)["train"]
+                    except Exception as e:
+                        print(f"Could not check the huggingface datasets metadata for a new snapshot, using the saved search index: {e}")
+                if source is not None and source._fingerprint != meta["fingerprint"]:
+                    print("New snapshot of the huggingface datasets metadata, rebuilding the search index.")
+                    self._source = source
+                    return False
+                if source is not None:
+                    meta["checked"] = time.time()
+                    with open(meta_path, "w") as f:
+                        json.dump(meta, f)
+            ds = load_from_disk(os.path.join(self.index_path, "metadata"))
+            arrays = {name: np.load(os.path.join(self.index_path, f"{name}.npy"), mmap_mode="r")
+                      for name in ["data", "indices", "indptr", "idf", "likes", "downloads"]}
+            with open(os.path.join(self.index_path, "vocabulary.txt"), encoding="utf-8") as f:
+                terms = f.read().split("\n")
+        except Exception as e:
+            print(f"Could not load the dataset search index, rebuilding it: {e}")
+            return False
+        self.ds = ds
+        self.vocabulary = {term: col for col, term in enumerate(terms)}
+        self.idf = arrays["idf"]
+        self.description_vectors = csr_matrix((arrays["data"], arrays["indices"], arrays["indptr"]), shape=tuple(meta["shape"]), copy=False)
+        self.likes = arrays["likes"]
+        self.downloads = arrays["downloads"]
+        self.likes_norm = self._normalize(self.likes)
+        self.downloads_norm = self._normalize(self.downloads)
+        self.fingerprint = meta["fingerprint"]
+        self.index_saved = True
+        return True
+
+    def _query_counts(self, queries):
+        """
+        :param queries: (list(str)) search queries
+        :return: (csr_matrix) counts of the index vocabulary terms in each query
+        """
+        rows, cols, vals = list(), list(), list()
+        for row, query in enumerate(queries):
+            counts = dict()
+            for token in self.analyzer(query):
+                col = self.vocabulary.get(token)
+                if col is not None:
+                    counts[col] = counts.get(col, 0) + 1
+            rows += [row] * len(counts)
+            cols += list(counts)
+            vals += list(counts.values())
+        return csr_matrix((np.array(vals, dtype=np.float64), (rows, cols)), shape=(len(queries), len(self.vocabulary)))
+
+    def _query_vectors(self, query_counts):
+        """
+        TF-IDF vectors of queries, as TfidfVectorizer.transform would compute them with the index vocabulary
+        :param query_counts: (csr_matrix) output of _query_counts
+        :return: (csr_matrix) one l2-normalized row per query
+        """
+        vectors = csr_matrix(query_counts.multiply(np.asarray(self.idf)[None, :]))
+        norms = np.sqrt(np.asarray(vectors.multiply(vectors).sum(axis=1)).ravel())
+        norms[norms == 0] = 1.0
+        return csr_matrix(vectors.multiply(1.0 / norms[:, None]))
+
+    def _hybrid_index(self):
+        """
+        :return: (HybridIndex) BM25 and LSA index, loaded from the persisted index or built once, None if it cannot be built
+        """
+        with self._hybrid_lock:
+            if self.hybrid is None and self.index_saved:
+                self.hybrid = HybridIndex.load(self.index_path, self.fingerprint, self.description_vectors.shape)
+            if self.hybrid is None:
+                print("Building the hybrid (BM25 + LSA) dataset search index, this is only done once.")
+                try:
+                    counts = CountVectorizer(vocabulary=self.vocabulary).transform(self.ds["description"])
+                    self.hybrid = HybridIndex.build(counts, self.description_vectors)
+                except Exception as e:
+                    print(f"Could not build the hybrid dataset search index, using TF-IDF only: {e}")
+                    self.hybrid = False
+                    return None
+                # only next to the TF-IDF index it was built from
+                if self.index_saved:
+                    try:
+                        self.hybrid.save(self.index_path, self.fingerprint)
+                    except OSError as e:
+                        print(f"Could not save the hybrid dataset search index: {e}")
+            return self.hybrid if self.hybrid is not False else None
+
+    def _normalize_rows(self, scores):
+        """
+        Min-max normalization of each row, as _normalize for a single query
+        """
+        min_val = scores.min(axis=1, keepdims=True)
+        val_range = scores.max(axis=1, keepdims=True) - min_val
+        return np.divide(scores - min_val, val_range, out=np.zeros(scores.shape, dtype=np.float64), where=val_range != 0)
 
     def _normalize(self, arr):
         min_val = arr.min()
@@ -85,74 +284,93 @@ class HFDataSearch:
             return np.zeros_like(arr, dtype=float)
         return (arr - min_val) / (max_val - min_val)
 
-    def retrieve_ds(self, query, N=10, sim_w=1.0, like_w=0.0, dwn_w=0.0):
+    def retrieve_ds(self, query, N=10, sim_w=None, like_w=None, dwn_w=None, bm25_w=None, lsa_w=None):
         """
         Retrieves the top N datasets matching the query, weighted by likes and downloads.
+        Weights that are not given default to HF_SEARCH_WEIGHTS.
         :param query: The search query string.
         :param N: The number of results to return.
         :param sim_w: Weight for cosine similarity.
         :param like_w: Weight for likes.
         :param dwn_w: Weight for downloads.
+        :param bm25_w: Weight for the BM25 score.
+        :param lsa_w: Weight for the latent-semantic (LSA) similarity.
         :return: List of top N dataset items.
         """
+        return self.retrieve_many([query], N=N, sim_w=sim_w, like_w=like_w, dwn_w=dwn_w, bm25_w=bm25_w, lsa_w=lsa_w)[0]
+
+    def retrieve_many(self, queries, N=10, sim_w=None, like_w=None, dwn_w=None, bm25_w=None, lsa_w=None):
+        """
+        Retrieves the top N datasets for several queries at once (e.g. reformulations of a search), with one
+        sparse matrix product for all of them and a partial sort per query.
+        Weights that are not given default to HF_SEARCH_WEIGHTS.
+        :param queries: (list(str)) search query strings.
+        :param N: The number of results to return per query.
+        :param sim_w: Weight for cosine similarity.
+        :param like_w: Weight for likes.
+        :param dwn_w: Weight for downloads.
+        :param bm25_w: Weight for the BM25 score.
+        :param lsa_w: Weight for the latent-semantic (LSA) similarity.
+        :return: List with the list of top N dataset items of each query.
+        """
         if not self.ds or self.description_vectors is None:
             print("No datasets available to search.")
-            return []
-
-        query_vector = self.vectorizer.transform([query])
-        cosine_similarities = linear_kernel(query_vector, self.description_vectors).flatten()
-        # Normalize cosine similarities
-        cosine_similarities_norm = self._normalize(cosine_similarities)
+            return [[] for _ in queries]
+        given = {"sim_w": sim_w, "like_w": like_w, "dwn_w": dwn_w, "bm25_w": bm25_w, "lsa_w": lsa_w}
+        weights = {name: HF_SEARCH_WEIGHTS[name] if weight is None else weight for name, weight in given.items()}
+        top_indices = self._top_indices(queries, N, **weights)
+        # datasets found by several queries are only looked up once
+        split_info = self._split_info(sorted(set(int(_i) for _row in top_indices for _i in _row)))
+        results = list()
+        for row in top_indices:
+            top_datasets = list()
+            for i in row:
+                dataset = self.ds[int(i)]
+                dataset.update(split_info[int(i)])
+                top_datasets.append(dataset)
+            results.append(top_datasets)
+        return results
+
+    def _top_indices(self, queries, N, sim_w, like_w, dwn_w, bm25_w=0.0, lsa_w=0.0):
+        """
+        :return: (np.ndarray) indices of the top N datasets per query, best first, shape (queries, min(N, datasets))
+        """
+        query_counts = self._query_counts(queries)
+        query_vectors = self._query_vectors(query_counts)
+        # (datasets x queries), multiplying this way around does not copy the transposed description matrix
+        cosine_similarities = (self.description_vectors @ query_vectors.T).toarray().T
         # Compute final scores
         final_scores = (
-                sim_w * cosine_similarities_norm +
-                like_w * self.likes_norm +
-                dwn_w * self.downloads_norm
+                sim_w * self._normalize_rows(cosine_similarities) +
+                like_w * self.likes_norm[None, :] +
+                dwn_w * self.downloads_norm[None, :]
         )
-        # Get top N indices
-        top_indices = final_scores.argsort()[-N:][::-1]
-        # Convert indices to Python ints
-        top_indices = [int(i) for i in top_indices]
-        top_datasets = [self.ds[i] for i in top_indices]
-        # check if dataset has a test & train set
-        has_test_set = list()
-        has_train_set = list()
-        ds_size_info = list()
-        for i in top_indices:
-            try:
-                dbuilder = load_dataset_builder(self.ds[i]["id"], trust_remote_code=True).info
-            except Exception as e:
-                has_test_set.append(False)
-                has_train_set.append(False)
-                ds_size_info.append((None, None, None, None))
-                continue
-
-            if dbuilder.splits is None:
-                has_test_set.append(False)
-                has_train_set.append(False)
-                ds_size_info.append((None, None, None, None))
-                continue
-            # Print number of examples for
-            has_test, has_train = "test" in dbuilder.splits, "train" in dbuilder.splits
-            has_test_set.append(has_test)
-            has_train_set.append(has_train)
-            test_dwn_size, test_elem_size = None, None
-            train_dwn_size, train_elem_size = None, None
-            if has_test:
-                test_dwn_size = bytes2human(dbuilder.splits["test"].num_bytes)
-                test_elem_size = dbuilder.splits["test"].num_examples
-            if has_train:
-                train_dwn_size = bytes2human(dbuilder.splits["train"].num_bytes)
-                train_elem_size = dbuilder.splits["train"].num_examples
-            ds_size_info.append((test_dwn_size, test_elem_size, train_dwn_size, train_elem_size))
-        for _i in range(len(top_datasets)):
-            top_datasets[_i]["has_test_set"] = has_test_set[_i]
-            top_datasets[_i]["has_train_set"] = has_train_set[_i]
-            top_datasets[_i]["test_download_size"] = ds_size_info[_i][0]
-            top_datasets[_i]["test_element_size"] = ds_size_info[_i][1]
-            top_datasets[_i]["train_download_size"] = ds_size_info[_i][2]
-            top_datasets[_i]["train_element_size"] = ds_size_info[_i][3]
-        return top_datasets
+        hybrid = self._hybrid_index() if bm25_w != 0 or lsa_w != 0 else None
+        if hybrid is not None:
+            # lexical and latent-semantic matches blended, each normalized per query like the cosine similarity
+            bm25_scores, lsa_scores = hybrid.scores(query_counts, query_vectors)
+            final_scores = final_scores + bm25_w * self._normalize_rows(bm25_scores) + lsa_w * self._normalize_rows(lsa_scores)
+        elif bm25_w != 0 or lsa_w != 0:
+            # without the hybrid index its weight goes to the TF-IDF similarity
+            final_scores = final_scores + (bm25_w + lsa_w) * self._normalize_rows(cosine_similarities)
+        k = min(N, final_scores.shape[1])
+        if k <= 0:
+            return np.zeros((len(queries), 0), dtype=np.int64)
+        # top k in linear time, then only those k are sorted
+        top = np.argpartition(-final_scores, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(final_scores, top, axis=1), axis=1, kind="stable")
+        return np.take_along_axis(top, order, axis=1)
+
+    def _split_info(self, indices):
+        """
+        Check if the datasets have a test & train set and how large they are
+        :param indices: (list(int)) dataset indices
+        :return: (dict) index -> has_test_set, has_train_set, test/train download and element sizes
+        """
+        dataset_ids = {i: self.ds[i]["id"] for i in indices}
+        # parallel hub lookups, cached across searches and runs
+        info = split_metadata_store().lookup(list(dataset_ids.values()))
+        return {i: info[dataset_ids[i]] for i in indices}
 
     def results_str(self, results):
         """
@@ -176,6 +394,22 @@ class HFDataSearch:
         return result_strs
 
 
+_hf_data_search = dict()
+_hf_data_search_lock = threading.Lock()
+
+
+def hf_data_search(like_thr=3, dwn_thr=50):
+    """
+    @param like_thr: (int) minimum likes of a dataset
+    @param dwn_thr: (int) minimum downloads of a dataset
+    @return: (HFDataSearch) process-wide search index for the thresholds, loaded on first use
+    """
+    with _hf_data_search_lock:
+        if (like_thr, dwn_thr) not in _hf_data_search:
+            _hf_data_search[(like_thr, dwn_thr)] = HFDataSearch(like_thr=like_thr, dwn_thr=dwn_thr)
+        return _hf_data_search[(like_thr, dwn_thr)]
+
+
 class SemanticScholarSearch:
     def __init__(self):
         self.sch_engine = SemanticScholar(retry=False)
@@ -310,50 +544,40 @@ import sys
 import traceback
 
 
-def execute_code(code_str, timeout=60, MAX_LEN=1000):
-    #print(code_str)
-
-    # prevent plotting errors
-    import matplotlib
-    matplotlib.use('Agg')  # Use the non-interactive Agg backend
-    import matplotlib.pyplot as plt
-
+def execute_code(code_str, timeout=60, MAX_LEN=1000, setup_code=None, cwd=None):
+    """
+    Execute generated code in a pre-warmed worker process of the execution pool
+    @param code_str: (str) code to execute, in a fresh namespace
+    @param timeout: (float) seconds before the worker is killed
+    @param MAX_LEN: (int) length of the returned output, longer output keeps its head and tail and the full
+        output is written to a log file
+    @param setup_code: (str) code that runs before code_str (e.g. the dataset code), it is run once and
+        forked for every call with the same setup_code instead of being re-run each time
+    @param cwd: (str) working directory of the execution, defaults to the current one
+    @return: (str) captured output, followed by a hotspot table if profiling is enabled
+    """
+    full_code = code_str if setup_code is None else f"{setup_code}\n{code_str}"
     # Preventing execution of certain resource-intensive datasets
-    if "load_dataset('pubmed" in code_str:
-        return "[CODE EXECUTION ERROR] pubmed Download took way too long. Program terminated"
-    if "exit(" in code_str:
-        return "[CODE EXECUTION ERROR] The exit() command is not allowed you must remove this."
-    #print(code_str)
-    # Capturing the output
-    output_capture = io.StringIO()
-    sys.stdout = output_capture
-
-    # Create a new global context for exec
-    exec_globals = globals()
-
-    def run_code():
-        try:
-            # Executing the code in the global namespace
-            exec(code_str, exec_globals)
-        except Exception as e:
-            output_capture.write(f"[CODE EXECUTION ERROR]: {str(e)}\n")
-            traceback.print_exc(file=output_capture)
-
+    banned = banned_pattern_error(full_code)
+    if banned is not None:
+        return banned
+    profile_path = new_profile_path()
+    log_path = new_log_path()
     try:
-        # Running code in a separate thread with a timeout
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            future = executor.submit(run_code)
-            future.result(timeout=timeout)
-    except concurrent.futures.TimeoutError:
-        return f"[CODE EXECUTION ERROR]: Code execution exceeded the timeout limit of {timeout} seconds. You must reduce the time complexity of your code."
+        output = None
+        if setup_code is not None:
+            snapshot = snapshot_executor(setup_code)
+            if snapshot is not None:
+                output = snapshot.run(code_str, timeout=timeout, max_len=MAX_LEN, cwd=cwd, profile_path=profile_path, log_path=log_path)
+        if output is None:
+            # no snapshot (disabled, no fork, or the setup code itself fails): run everything together
+            output = execution_pool().run(full_code, timeout=timeout, max_len=MAX_LEN, cwd=cwd, profile_path=profile_path, log_path=log_path)
     except Exception as e:
         return f"[CODE EXECUTION ERROR]: {str(e)}"
-    finally:
-        # Restoring standard output
-        sys.stdout = sys.__stdout__
-
-    # Returning the captured output
-    return output_capture.getvalue()[:MAX_LEN]
-
-
-
+    if "exceeded the timeout limit" in output and log_path is not None:
+        # the killed execution returned nothing, show what it printed last
+        last_output = log_tail(log_path, MAX_LEN // 2)
+        if len(last_output) > 0:
+            output += f"\nLast output before the timeout (full output in {log_path}):\n{last_output}"
+    # also written when the execution timed out, it shows what made the code slow
+    return output if profile_path is None else output + hotspot_table(profile_path)
@@ -1,6 +1,6 @@
 import os, re
 import shutil
-import tiktoken
+from token_accounting import encoder_for
 import subprocess
 
 
@@ -41,15 +41,15 @@ def compile_latex(latex_code, compile=True, output_filename="output.pdf", timeou
 
 
 def count_tokens(messages, model="gpt-4"):
-    enc = tiktoken.encoding_for_model(model)
+    enc = encoder_for(model)
     num_tokens = sum([len(enc.encode(message["content"])) for message in messages])
     return num_tokens
 
-def remove_figures():
-    """Remove a directory if it exists."""
-    for _file in os.listdir("."):
+def remove_figures(path="."):
+    """Remove the figures in a directory, the current one by default."""
+    for _file in os.listdir(path):
         if "Figure_" in _file and ".png" in _file:
-            os.remove(_file)
+            os.remove(os.path.join(path, _file))
 
 def remove_directory(dir_path):
     """Remove a directory if it exists."""
@@ -75,7 +75,7 @@ def save_to_file(location, filename, data):
 
 
 def clip_tokens(messages, model="gpt-4", max_tokens=100000):
-    enc = tiktoken.encoding_for_model(model)
+    enc = encoder_for(model)
     total_tokens = sum([len(enc.encode(message["content"])) for message in messages])
 
     if total_tokens <= max_tokens: